@@ -1,6 +1,17 @@
+import os
 import sys
+import time
+import random
 import argparse
-from obfuscate import obfuscate
+from obfuscate import obfuscate, FLOW_MAX_GROWTH
+from cff import CFF_BLOCK_SIZE
+from package import obfuscate_package
+from vm_obf import DISPATCH_STYLES
+from string_encrypt import SLOT_MODES
+from vm_optimize import IR_PASSES
+from opaque_mba import MBA_MAX_NODES, MBA_MAX_GROWTH
+from tiering import load_profile, overhead_table
+from budget import fit_budget, budget_table, parse_slowdown, stage_overhead, stage_table
 
 def save_file(code, filename):
     with open(filename, "w", encoding="utf-8") as f:
@@ -9,12 +20,60 @@ def save_file(code, filename):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Obfuscate Python code.")
-    parser.add_argument("input_file", help="The Python file to obfuscate.")
-    parser.add_argument("-o", "--output", help="The output file name. Defaults to input_file_obfuscated.py")
+    parser.add_argument("input_file", help="The Python file, or package directory, to obfuscate.")
+    parser.add_argument("-o", "--output", help="The output file name. Defaults to input_file_obfuscated.py, or input_dir_obfuscated for a directory.")
     parser.add_argument("-f", "--functions", nargs="*", help="Functions to obfuscate. Without -f, all functions are obfuscated.")
     parser.add_argument("-v", "--vm-count", type=int, default=0, help="Number of VMs per function (default: random 3-5).")
+    parser.add_argument("--vm-cache", action="store_true", help="Decrypt VM code once on first call and reuse it on later calls.")
+    parser.add_argument("--vm-cache-recheck", type=int, default=0, help="With --vm-cache, re-decrypt and compare the cached code every N calls (default: never).")
+    parser.add_argument("--dispatch", choices=DISPATCH_STYLES, help="VM dispatch strategy for every VM (default: random per VM).")
+    parser.add_argument("--compound-slots", type=int, default=8, help="Superinstructions per function, fused from its most frequent op sequences (default: 8, 0 disables).")
+    parser.add_argument("--vm-profile", action="store_true", help="Instrument the VMs: opcode, segment and dynamic handler "
+                        "counters, written to $MASKPY_VM_PROFILE or vm_profile.json at exit.")
+    parser.add_argument("--ir-passes", nargs="*", choices=IR_PASSES, default=IR_PASSES, help="VM IR optimization passes to run before splitting (default: all; give none to disable).")
+    parser.add_argument("--mba-max-nodes", type=int, default=MBA_MAX_NODES, help=f"Largest size MBA may grow a statement's expression to, in AST nodes (default: {MBA_MAX_NODES}).")
+    parser.add_argument("--mba-max-growth", type=float, default=MBA_MAX_GROWTH, help=f"Most operations a function may end up with after MBA, as a multiple of its own (default: {MBA_MAX_GROWTH:g}).")
+    parser.add_argument("--mba-temps", action="store_true", help="Evaluate operands MBA repeats once, into temporaries.")
+    parser.add_argument("--opaque", action="store_true", help="Wrap ifs and returns in opaque predicates with junk else branches.")
+    parser.add_argument("--cff", action="store_true", help="Flatten control flow into an encoded state machine.")
+    parser.add_argument("--cff-block", type=int, default=CFF_BLOCK_SIZE, help=f"Straight-line statements merged per flattened state (default: {CFF_BLOCK_SIZE}).")
+    parser.add_argument("--flow-max-growth", type=float, default=FLOW_MAX_GROWTH, help="Most operations --opaque and --cff together may grow a function to, "
+                        f"as a multiple of its own (default: {FLOW_MAX_GROWTH:g}).")
+    parser.add_argument("--stage-report", action="store_true", help="Print the operations each AST stage adds to each function, and the "
+                        "slowdown it measures on the sample inputs --max-slowdown uses.")
+    parser.add_argument("--string-slots", choices=SLOT_MODES, help="Decrypt string literals once into a module-level table, on first use (lazy) or at import (eager).")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Worker processes for per-function, or per-file in package mode, obfuscation (default: 1).")
+    parser.add_argument("--seed", type=int, help="Master seed for a reproducible build (default: random).")
+    parser.add_argument("--cache-dir", help="Reuse per-function output from this directory for unchanged functions.")
+    parser.add_argument("--profile", help="Call profile from tiering.py: hot functions get the bytecode trampoline or AST-only transforms instead of VMs.")
+    parser.add_argument("--max-slowdown", type=parse_slowdown, help="Run time budget such as 3x: functions with sample inputs "
+                        "(input.bench.json or a __maskpy_bench__ hook) get weaker protection until they meet it.")
+    parser.add_argument("--timings", action="store_true", help="Print the time spent in each pipeline stage.")
     args = parser.parse_args()
     filename = args.input_file
+    profile = load_profile(args.profile) if args.profile else None
+    if os.path.isdir(filename):
+        if args.functions or args.max_slowdown or args.stage_report:
+            print("\033[91mError: \033[0m-f, --max-slowdown and --stage-report cannot be used with a directory!")
+            sys.exit(1)
+        out_dir = args.output or filename.rstrip("/\\") + "_obfuscated"
+        start = time.perf_counter()
+        try:
+            timings = obfuscate_package(filename, out_dir, jobs=args.jobs, seed=args.seed,
+                                        vm_count=args.vm_count, code_cache=args.vm_cache,
+                                        cache_recheck=args.vm_cache_recheck, dispatch=args.dispatch,
+                                        string_slots=args.string_slots, cache_dir=args.cache_dir,
+                                        compound_slots=args.compound_slots, ir_passes=args.ir_passes,
+                                        profile=profile, vm_profile=args.vm_profile,
+                                        mba_max_nodes=args.mba_max_nodes, mba_max_growth=args.mba_max_growth,
+                                        mba_temps=args.mba_temps, opaque=args.opaque, cff=args.cff,
+                                        cff_block=args.cff_block, flow_max_growth=args.flow_max_growth)
+        except (ValueError, SyntaxError) as e:
+            print(f"\033[91mError: \033[0m{e}")
+            sys.exit(1)
+        print(f"\033[1;32mSuccess:\033[0m {len(timings)} files obfuscated into {out_dir} "
+              f"in {time.perf_counter() - start:.2f}s")
+        sys.exit(0)
     if not filename.endswith(".py"):
         print("\033[91mError: \033[0myou need to choose a python file!")
         sys.exit(1)
@@ -23,9 +82,43 @@ if __name__ == "__main__":
     else:
         obfuscated_filename = filename[:-3] + "_obfuscated.py"
     functions_to_obfuscate = args.functions or []
+    timings = {} if args.timings else None
+    tiers = {} if profile else None
+    op_growth = {}
+    stage_ops = {}
+    fallbacks = {}
+    # the stage report rebuilds the module, with the same seed as the output
+    seed = random.getrandbits(64) if args.seed is None and args.stage_report else args.seed
+    options = dict(vm_count=args.vm_count, code_cache=args.vm_cache, cache_recheck=args.vm_cache_recheck,
+                   dispatch=args.dispatch, string_slots=args.string_slots, jobs=args.jobs,
+                   cache_dir=args.cache_dir, timings=timings, compound_slots=args.compound_slots,
+                   ir_passes=args.ir_passes, profile=profile, tiers=tiers, vm_profile=args.vm_profile,
+                   mba_max_nodes=args.mba_max_nodes, mba_max_growth=args.mba_max_growth,
+                   mba_temps=args.mba_temps, op_growth=op_growth, opaque=args.opaque, cff=args.cff,
+                   cff_block=args.cff_block, flow_max_growth=args.flow_max_growth, stage_ops=stage_ops,
+                   fallbacks=fallbacks)
     try:
-        obfuscated = obfuscate(filename, functions_to_obfuscate, vm_count=args.vm_count)
+        if args.max_slowdown:
+            obfuscated, report = fit_budget(filename, args.max_slowdown, functions_to_obfuscate,
+                                            seed=seed, **options)
+        else:
+            obfuscated = obfuscate(filename, functions_to_obfuscate, seed=seed, **options)
         save_file(obfuscated, obfuscated_filename)
+        for name, why in fallbacks.items():
+            print(f"\033[93mWarning: \033[0m{name} fell back to {why}")
+        for name, (before, after) in op_growth.items():
+            growth = f"x{after / before:.1f}" if before else '-'
+            print(f"{name:<24} {before:>5} -> {after:>6} ops  {growth}")
+        if profile:
+            print(overhead_table(profile, filename, tiers))
+        if args.max_slowdown:
+            print(budget_table(report, args.max_slowdown))
+        if args.stage_report:
+            quiet = dict(options, op_growth=None, stage_ops=None, timings=None, tiers=None, fallbacks=None)
+            overhead = stage_overhead(filename, functions_to_obfuscate, seed=seed, **quiet)
+            print(stage_table(stage_ops, overhead))
+        for stage, seconds in (timings or {}).items():
+            print(f"{stage:>10} {seconds * 1000:9.1f}ms")
     except FileNotFoundError:
         print("\033[91mError: \033[0mfile doesn't exist!")
         sys.exit(1)
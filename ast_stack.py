@@ -0,0 +1,260 @@
+"""AST traversal on an explicit work stack.
+
+Generated modules (long literal tables, elif ladders thousands deep) nest
+far past the interpreter's recursion limit, so the transforms walk trees
+without recursing. StackTransformer is a drop-in ast.NodeTransformer whose
+visit_* methods may be generators: `new = yield child` visits a child and
+receives its replacement, and the method's return value replaces the node.
+Plain methods that return at once work as before.
+
+dump() and fix_missing_locations() are the stdlib functions of the same
+name without recursion, and FlatTree carries a tree through pickle (worker
+processes, the build cache) as a flat list of nodes. The stdlib calls that
+still recurse (ast.parse, compile, ast.unparse) run inside
+recursion_limit(), which raises the limit for the call only.
+"""
+import ast
+import sys
+from types import GeneratorType
+from contextlib import contextmanager
+
+# limit for the stdlib calls above
+DEEP_RECURSION_LIMIT = 10000
+
+
+@contextmanager
+def recursion_limit(limit=DEEP_RECURSION_LIMIT):
+    old = sys.getrecursionlimit()
+    if old < limit:
+        sys.setrecursionlimit(limit)
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(old)
+
+
+class StackTransformer(ast.NodeTransformer):
+    """ast.NodeTransformer without recursion.
+
+    One generator per visited node waits on the stack for its child's
+    result; nodes without fields (contexts, operators) are returned as they
+    are unless a visit_* method asks for them.
+    """
+
+    def visit(self, node):
+        value = self._enter(node)
+        if type(value) is not GeneratorType:
+            return value
+        stack = [value]
+        value = None
+        while True:
+            try:
+                child = stack[-1].send(value)
+            except StopIteration as done:
+                stack.pop()
+                value = done.value
+                if not stack:
+                    return value
+                continue
+            value = self._enter(child)
+            if type(value) is GeneratorType:
+                stack.append(value)
+                value = None
+
+    def _enter(self, node):
+        method = getattr(self, 'visit_' + node.__class__.__name__, None)
+        if method is None:
+            if not node._fields:
+                return node
+            method = self.generic_visit
+        return method(node)
+
+    def generic_visit(self, node):
+        # ast.NodeTransformer.generic_visit, with a yield per child
+        for field, old_value in ast.iter_fields(node):
+            if isinstance(old_value, list):
+                new_values = []
+                for value in old_value:
+                    if isinstance(value, ast.AST):
+                        value = yield value
+                        if value is None:
+                            continue
+                        elif not isinstance(value, ast.AST):
+                            new_values.extend(value)
+                            continue
+                    new_values.append(value)
+                old_value[:] = new_values
+            elif isinstance(old_value, ast.AST):
+                new_node = yield old_value
+                if new_node is None:
+                    delattr(node, field)
+                else:
+                    setattr(node, field, new_node)
+        return node
+
+
+def fix_missing_locations(node):
+    """ast.fix_missing_locations without recursion."""
+    stack = [(node, 1, 0, 1, 0)]
+    while stack:
+        current, lineno, col_offset, end_lineno, end_col_offset = stack.pop()
+        if 'lineno' in current._attributes:
+            if not hasattr(current, 'lineno'):
+                current.lineno = lineno
+            else:
+                lineno = current.lineno
+            if 'end_lineno' in current._attributes:
+                if getattr(current, 'end_lineno', None) is None:
+                    current.end_lineno = end_lineno
+                else:
+                    end_lineno = current.end_lineno
+            if 'col_offset' in current._attributes:
+                if not hasattr(current, 'col_offset'):
+                    current.col_offset = col_offset
+                else:
+                    col_offset = current.col_offset
+            if 'end_col_offset' in current._attributes:
+                if getattr(current, 'end_col_offset', None) is None:
+                    current.end_col_offset = end_col_offset
+                else:
+                    end_col_offset = current.end_col_offset
+        for child in ast.iter_child_nodes(current):
+            stack.append((child, lineno, col_offset, end_lineno, end_col_offset))
+    return node
+
+
+def dump(node):
+    """ast.dump(node) with its default arguments, without recursion."""
+    out = []
+    # text to write out as it is, or (value,) to format in its place
+    stack = [(node,)]
+    while stack:
+        item = stack.pop()
+        if type(item) is str:
+            out.append(item)
+            continue
+        value = item[0]
+        if isinstance(value, ast.AST):
+            cls = type(value)
+            parts = [f'{cls.__name__}(']
+            for name in value._fields:
+                try:
+                    field = getattr(value, name)
+                except AttributeError:
+                    continue
+                if field is None and getattr(cls, name, ...) is None:
+                    continue
+                parts.append(f'{", " if len(parts) > 1 else ""}{name}=')
+                parts.append((field,))
+            parts.append(')')
+            stack.extend(reversed(parts))
+        elif isinstance(value, list):
+            parts = ['[']
+            for element in value:
+                if len(parts) > 1:
+                    parts.append(', ')
+                parts.append((element,))
+            parts.append(']')
+            stack.extend(reversed(parts))
+        else:
+            out.append(repr(value))
+    return ''.join(out)
+
+
+class FlatTree:
+    """Holder for an AST that pickles as a flat list of nodes.
+
+    pickle recurses once per nesting level; this keeps a deep tree to a
+    single level. Nodes reached twice stay shared after loading.
+    """
+
+    def __init__(self, node):
+        self.node = node
+
+    def __reduce__(self):
+        return _load_flat, (_flatten(self.node),)
+
+
+def _flatten(tree):
+    # rows of (type, plain values, children); children are indices into
+    # the rows, lists of them (None kept) for list fields holding nodes
+    index = {id(tree): 0}
+    order = [tree]
+    rows = []
+    for node in order:
+        values = {}
+        children = {}
+        for name in node._fields + node._attributes:
+            try:
+                value = getattr(node, name)
+            except AttributeError:
+                continue
+            items = value if isinstance(value, list) else [value]
+            if not any(isinstance(item, ast.AST) for item in items):
+                values[name] = value
+                continue
+            refs = []
+            for item in items:
+                if item is not None:
+                    key = id(item)
+                    if key not in index:
+                        index[key] = len(order)
+                        order.append(item)
+                    item = index[key]
+                refs.append(item)
+            children[name] = refs if items is value else refs[0]
+        rows.append((type(node), values, children))
+    return rows
+
+
+def _load_flat(rows):
+    nodes = [cls() for cls, _, _ in rows]
+    for node, (_, values, children) in zip(nodes, rows):
+        for name, value in values.items():
+            setattr(node, name, value)
+        for name, ref in children.items():
+            if isinstance(ref, list):
+                setattr(node, name, [None if i is None else nodes[i] for i in ref])
+            else:
+                setattr(node, name, nodes[ref])
+    return FlatTree(nodes[0])
+
+
+if __name__ == '__main__':
+    import pickle
+    import functools
+
+    # 10000 levels, far past the default limit this runs at
+    depth = 10000
+    terms = [ast.Constant(i) if i % 2 else ast.Name(f'a{i % 3}', ast.Load()) for i in range(depth)]
+    expr = functools.reduce(lambda left, right: ast.BinOp(left, ast.Add(), right), terms)
+    tree = ast.Module(body=[ast.Return(value=expr)], type_ignores=[])
+
+    class Doubler(StackTransformer):
+        def visit_Constant(self, node):
+            return ast.Constant(value=node.value * 2)
+
+        def visit_BinOp(self, node):
+            # mixes yield with a plain return value
+            left = yield node.left
+            right = yield node.right
+            return ast.BinOp(left=right, op=node.op, right=left)
+
+    assert sys.getrecursionlimit() < depth
+    swapped = Doubler().visit(tree).body[0].value
+    assert isinstance(swapped.left, ast.Constant) and swapped.left.value == 2 * (depth - 1)
+    assert fix_missing_locations(tree).body[0].value.left.lineno == 1
+
+    # dump matches the stdlib on what it can reach, FlatTree keeps sharing
+    small = ast.parse("def f(x, *, y=None):\n    global g\n    return {1: x, **y}, f'{x!r}', [*x][::2]\n")
+    assert dump(small) == ast.dump(small)
+    assert dump(tree).count('BinOp(') == depth - 1
+    name = ast.Name(id='x', ctx=ast.Load())
+    shared = pickle.loads(pickle.dumps(FlatTree(ast.BinOp(left=name, op=ast.Add(), right=name)))).node
+    assert shared.left is shared.right
+    loaded = pickle.loads(pickle.dumps(FlatTree(tree))).node
+    assert dump(loaded) == dump(tree)
+    assert ast.dump(pickle.loads(pickle.dumps(FlatTree(small))).node, include_attributes=True) == \
+        ast.dump(small, include_attributes=True)
+
+    print('all ast_stack tests passed')
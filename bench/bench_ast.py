@@ -0,0 +1,124 @@
+"""AST transform time and peak memory on very deep trees.
+
+Each of SHAPES is built as AST nodes at every DEPTHS entry (the parser stops
+far short of 10000 levels): 'expr' returns a left-nested sum of int
+parameters and constants, 'ladder' is an if/elif ladder, one branch per
+level, returning a constant, and 'table' is a flat list literal of that many
+constants. Every transform of obfuscate._transform_function then runs on a
+fresh copy at the interpreter's default recursion limit, so a transform that
+still recursed per level would fail with RecursionError ('fail' below).
+mba is both passes with the sharing breaks between them, opaque gets the
+op budget flattening would leave it, and 'all' is the whole
+_transform_function (strings, mba, unfold). Times are the best of REPEAT
+untraced runs; peak is the tracemalloc high-water mark of one more run,
+not counting the tree it starts with.
+
+Usage: python bench/bench_ast.py [-d depth ...] [--shapes shape ...] [--transforms name ...]
+"""
+import os
+import ast
+import sys
+import time
+import random
+import argparse
+import functools
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from obfuscate import _copy_tree, _break_sharing, _transform_function, FLOW_MAX_GROWTH
+from ast_stack import fix_missing_locations
+from opaque_mba import MBATransformer, OpaquePredicateTransformer, count_ops
+from const_unfold import ConstantUnfolder
+from string_encrypt import StringEncryptTransformer
+
+DEPTHS = (1000, 10000)
+SHAPES = ('expr', 'ladder', 'table')
+PARAMS = ('a0', 'a1', 'a2', 'a3')
+REPEAT = 3
+
+
+def _mba(tree):
+    transformer = MBATransformer(list(PARAMS), dict.fromkeys(PARAMS, 'int'))
+    tree = _break_sharing(transformer.visit(tree))
+    return _break_sharing(transformer.visit(tree))
+
+
+TRANSFORMS = {
+    'copy': _copy_tree,
+    'sharing': _break_sharing,
+    'locations': fix_missing_locations,
+    'strings': lambda tree: StringEncryptTransformer().visit(tree),
+    'opaque': lambda tree: OpaquePredicateTransformer(
+        list(PARAMS), op_budget=count_ops(tree) * (FLOW_MAX_GROWTH - 1) / 2).visit(tree),
+    'mba': _mba,
+    'unfold': lambda tree: ConstantUnfolder(probability=0.6).visit(tree),
+    'all': lambda tree: _transform_function(tree.body[0]),
+}
+
+
+def generate(shape, n):
+    """Module holding one function of `shape`, `n` levels deep (or wide for 'table')."""
+    func = ast.parse(f"def f({', '.join(f'{p}: int' for p in PARAMS)}):\n    return 0\n").body[0]
+    if shape == 'expr':
+        terms = [ast.Name(PARAMS[i % 4], ast.Load()) if i % 3 else ast.Constant(i) for i in range(n)]
+        func.body[0].value = functools.reduce(lambda left, right: ast.BinOp(left, ast.Add(), right), terms)
+    elif shape == 'ladder':
+        tail = [ast.Return(ast.Constant('none'))]
+        for i in reversed(range(n)):
+            test = ast.Compare(ast.Name('a0', ast.Load()), [ast.Eq()], [ast.Constant(i)])
+            tail = [ast.If(test, [ast.Return(ast.Constant(f'v{i}'))], tail)]
+        func.body = tail
+    else:
+        func.body[0].value = ast.List([ast.Constant(i * 7919 % 65536) for i in range(n)], ast.Load())
+    return ast.Module(body=[func], type_ignores=[])
+
+
+def measure(fn, tree):
+    # (seconds, peak bytes, ops after), None on RecursionError
+    best = None
+    for _ in range(REPEAT):
+        random.seed(0)
+        copy = _copy_tree(tree)
+        start = time.perf_counter()
+        try:
+            result = fn(copy)
+        except RecursionError:
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    random.seed(0)
+    copy = _copy_tree(tree)
+    tracemalloc.start()
+    try:
+        fn(copy)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, count_ops(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AST transforms on very deep trees.")
+    parser.add_argument("-d", "--depths", nargs="*", type=int, default=list(DEPTHS))
+    parser.add_argument("--shapes", nargs="*", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--transforms", nargs="*", choices=TRANSFORMS, default=list(TRANSFORMS))
+    args = parser.parse_args()
+    print(f"recursion limit {sys.getrecursionlimit()}")
+    print(f"{'shape':<7} {'depth':>6} {'transform':<10} {'ms':>9} {'peak KiB':>9} {'ops':>8}")
+    for shape in args.shapes:
+        for n in args.depths:
+            tree = generate(shape, n)
+            for name in args.transforms:
+                result = measure(TRANSFORMS[name], tree)
+                if result is None:
+                    print(f"{shape:<7} {n:>6} {name:<10} {'fail':>9}", flush=True)
+                    continue
+                elapsed, peak, ops = result
+                print(f"{shape:<7} {n:>6} {name:<10} {elapsed * 1e3:>9.1f} {peak / 1024:>9.0f} {ops:>8}",
+                      flush=True)
+
+
+if __name__ == '__main__':
+    main()
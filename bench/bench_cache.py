@@ -0,0 +1,56 @@
+"""Incremental rebuilds with --cache-dir on a synthetic module.
+
+Builds cold, rebuilds unchanged (warm), then edits one function and
+rebuilds. All builds use the same seed; the unchanged functions must come
+out byte-identical to an uncached build.
+
+Usage: python bench/bench_cache.py [functions]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obfuscate import obfuscate
+from bench_jobs import synthetic_module
+
+
+def _build(path, cache_dir):
+    t = time.perf_counter()
+    out = obfuscate(path, seed=1234, cache_dir=cache_dir)
+    return out, time.perf_counter() - t
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    src = synthetic_module(n)
+    edited = src.replace('return x - 1\n', 'return x - 1 + 0\n', 1)
+    tmp = tempfile.mkdtemp()
+    cache_dir = os.path.join(tmp, 'cache')
+    path = os.path.join(tmp, 'mod.py')
+    try:
+        print(f"{n} functions")
+        with open(path, 'w') as f:
+            f.write(src)
+        plain, t_plain = _build(path, None)
+        cold, t_cold = _build(path, cache_dir)
+        warm, t_warm = _build(path, cache_dir)
+        with open(path, 'w') as f:
+            f.write(edited)
+        edit, t_edit = _build(path, cache_dir)
+        edit_plain, _ = _build(path, None)
+        print(f"{'no cache':>10} {t_plain:>8.2f}s")
+        print(f"{'cold':>10} {t_cold:>8.2f}s")
+        print(f"{'warm':>10} {t_warm:>8.2f}s")
+        print(f"{'1 edited':>10} {t_edit:>8.2f}s")
+        same = plain == cold == warm and edit == edit_plain
+        print("outputs identical" if same else "OUTPUT MISMATCH")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
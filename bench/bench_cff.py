@@ -0,0 +1,164 @@
+"""Run time of control-flow flattened functions against the originals.
+
+Each test corpus module, and a larger loop kernel, is flattened with
+cff.CFFTransformer under every MODES entry: 'chain' dispatches through a
+shuffled if/elif chain or comparison tree, 'table' through a list of
+handler closures, 'auto' picks the table for functions with at least
+cff.TABLE_MIN_STATES states, and the number is the block size
+(straight-line statements merged per state). chain/1 is the
+transformer's default. Per call times are the best of a few batches,
+averaged over SEEDS builds; states counts the dispatch table entries,
+bogus states included. Functions that cannot run as closures fall back
+to the chain, marked with *.
+
+Usage: python bench/bench_cff.py [-m mode ...]
+"""
+import io
+import os
+import ast
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cff import CFFTransformer, _table_safe
+
+KERNEL = '''def mixer(n):
+    acc = 0
+    for i in range(n):
+        a = i * 3
+        b = a + 7
+        c = b ^ i
+        if c & 1:
+            acc += c
+        d = acc % 97
+        e = d * 5
+        if e > 100:
+            acc -= 3
+        f = e + a
+        g = f - b
+        if g < 0:
+            g = -g
+        h = g % 13
+        acc += h
+        if acc > 100000:
+            acc = acc % 1000
+        k = acc ^ h
+        m = k + c
+        if m % 3 == 0:
+            acc += 2
+        else:
+            acc += 4
+    return acc
+'''
+
+# file: [(function, args), ...]; 'kernel' is KERNEL
+SAMPLES = {
+    'tests/test1.py': [('get_sol', (50, 90))],
+    'tests/test2.py': [('get_sol', ('xwethgcx', b'2\x18\r\x1aH#\x0c\x1d'))],
+    'tests/test_edge.py': [
+        ('with_defaults', (3,)), ('with_args', (1, 2, 3)), ('nested_func', (50,)),
+        ('multi_return', (5,)), ('with_try', (7, 0)), ('with_while_break', (30,)),
+        ('with_continue', (60,)), ('with_nested_loops', (12,)), ('with_comprehension', (60,)),
+        ('with_dict_ops', ({'a': 1, 'b': 2, 'c': 3},)), ('with_string_ops', ('hello big world',)),
+        ('with_bool_logic', (True, False)), ('fibonacci', (30,))],
+    'kernel': [('mixer', (200,))],
+}
+# mode: (dispatch, block_size)
+MODES = {
+    'chain/1': ('chain', 1),
+    'chain/8': ('chain', 8),
+    'table/1': ('table', 1),
+    'table/8': ('table', 8),
+    'auto/8': ('auto', 8),
+}
+SEEDS = range(3)
+MIN_BATCH = 0.01
+REPEAT = 3
+
+
+def _per_call(func, args):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_BATCH:
+            break
+        number = max(number * 2, int(number * MIN_BATCH / max(elapsed, 1e-9)))
+    best = elapsed / number
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def _load(tree, path):
+    ns = {'__name__': '__bench__'}
+    with contextlib.redirect_stdout(io.StringIO()):
+        exec(compile(ast.fix_missing_locations(tree), path, 'exec'), ns)
+    return ns
+
+
+def _states(func_node):
+    # the handler index list is the first list literal of the flattened body
+    for stmt in func_node.body:
+        if isinstance(stmt, ast.Assign) and isinstance(stmt.value, ast.List) \
+                and all(isinstance(e, ast.Constant) for e in stmt.value.elts):
+            return len(stmt.value.elts) // 2
+    return 0
+
+
+def _call(func, args):
+    # test1 draws from random, so every build sees the same draws
+    random.seed(0)
+    return func(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flattened vs original run time per function.")
+    parser.add_argument("-m", "--modes", nargs="*", choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+    print(f"{'function':<20} {'original us':>11}" + ''.join(f" {m + ' us':>10} {'x':>6} {'states':>6}" for m in args.modes))
+    for rel, calls in SAMPLES.items():
+        path = os.path.join(ROOT, rel)
+        if rel == 'kernel':
+            source = KERNEL
+        else:
+            with open(path) as f:
+                source = f.read()
+        original = _load(ast.parse(source), path)
+        safe = {n.name: _table_safe(n.body) for n in ast.parse(source).body if isinstance(n, ast.FunctionDef)}
+        builds = {mode: [] for mode in args.modes}
+        for mode in args.modes:
+            dispatch, block_size = MODES[mode]
+            for seed in SEEDS:
+                random.seed(seed)
+                tree = CFFTransformer(block_size, dispatch).visit(ast.parse(source))
+                states = {n.name: _states(n) for n in tree.body if isinstance(n, ast.FunctionDef)}
+                builds[mode].append((_load(tree, path), states))
+        for name, call_args in calls:
+            base = _per_call(original[name], call_args)
+            row = f"{name:<20} {base * 1e6:>11.2f}"
+            for mode in args.modes:
+                elapsed = states = 0
+                for ns, counts in builds[mode]:
+                    if _call(ns[name], call_args) != _call(original[name], call_args):
+                        raise SystemExit(f"{name} returned a different result under {mode}")
+                    elapsed += _per_call(ns[name], call_args)
+                    states += counts[name]
+                elapsed /= len(SEEDS)
+                mark = '*' if MODES[mode][0] != 'chain' and not safe[name] else ''
+                row += f" {elapsed * 1e6:>10.2f} {elapsed / base:>5.1f}x {states / len(SEEDS):>5.0f}{mark or ' '}"
+            print(row, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""VM compile time against function size.
+
+Generated functions of SIZES statements go through VMCompiler.compile_function,
+in three SHAPES: 'flat' is straight-line assignments over distinct constants,
+locals and globals (so pools pass 256 entries and operands take their wide
+form), 'branchy' wraps the same statements in a loop with an if every few
+lines, and 'deep' is a single return of an expression nested SIZES levels
+deep, built as AST nodes since the parser stops far short of that. Times are
+the best of REPEAT runs; per stmt divides by the statement (or nesting) count,
+so a flat column means linear scaling. --full also times the whole VM build
+(vm_obf.vm_obfuscate_function, one VM).
+
+Usage: python bench/bench_compile.py [-s size ...] [--shapes shape ...] [--full]
+"""
+import os
+import ast
+import sys
+import time
+import random
+import argparse
+import functools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vm_compiler import VMCompiler
+from vm_obf import vm_obfuscate_function
+
+SIZES = (1000, 5000, 10000, 20000, 50000)
+SHAPES = ('flat', 'branchy', 'deep')
+REPEAT = 3
+# distinct locals and globals the generated statements cycle through
+LOCALS = 600
+GLOBALS = 300
+
+
+def _statements(n):
+    return [f"v{i % LOCALS} = v{(i * 7) % LOCALS} + g{i % GLOBALS} * {i + 1000}" for i in range(n)]
+
+
+def generate(shape, n):
+    """FunctionDef of `shape` with `n` statements (or nesting levels for 'deep')."""
+    if shape == 'deep':
+        terms = [ast.Name(f"a{i % 4}", ast.Load()) for i in range(n)]
+        expr = functools.reduce(lambda left, right: ast.BinOp(left, ast.Add(), right), terms)
+        func = ast.parse("def f(a0, a1, a2, a3):\n    return 0\n").body[0]
+        func.body[0].value = expr
+        return func
+    init = [f"v{i} = {i}" for i in range(LOCALS)]
+    body = _statements(n)
+    if shape == 'branchy':
+        lines = ["for it in range(n):"]
+        for i, stmt in enumerate(body):
+            if i % 4 == 0:
+                lines.append(f"    if v{i % LOCALS} > it:")
+            lines.append("        " + stmt)
+        body = lines
+    source = "def f(n):\n" + ''.join(f"    {line}\n" for line in init + body + ["return v0"])
+    return ast.parse(source).body[0]
+
+
+def _best(func):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VM compile time on generated functions.")
+    parser.add_argument("-s", "--sizes", nargs="*", type=int, default=list(SIZES))
+    parser.add_argument("--shapes", nargs="*", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--full", action="store_true", help="Also time the whole VM build.")
+    args = parser.parse_args()
+    header = f"{'shape':<8} {'size':>6} {'consts':>7} {'locals':>7} {'names':>6} {'bytes':>8} {'compile ms':>11} {'us/stmt':>8}"
+    print(header + (f" {'build s':>8}" if args.full else ''))
+    for shape in args.shapes:
+        for n in args.sizes:
+            func = generate(shape, n)
+            elapsed, result = _best(lambda: VMCompiler().compile_function(func))
+            row = (f"{shape:<8} {n:>6} {len(result.constants):>7} {result.num_locals:>7} {len(result.names):>6} "
+                   f"{len(result.code):>8} {elapsed * 1e3:>11.1f} {elapsed / n * 1e6:>8.2f}")
+            if args.full:
+                random.seed(0)
+                start = time.perf_counter()
+                vm_obfuscate_function(func, 'f', vm_count=1)
+                row += f" {time.perf_counter() - start:>8.1f}"
+            print(row, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Global-heavy VM code: per-call overhead and per-iteration cost of builtin lookups.
+
+--against DIR runs the same builds with the obfuscator of another checkout
+(e.g. a `git worktree` of the commit before the builtin slot cache, whose
+VMs copied the builtins into globals() on every call) and prints both side
+by side. Both trees then run in subprocesses, alternating for ROUNDS
+rounds, and each keeps its best time.
+
+Usage: python bench/bench_globals.py [calls] [--against DIR]
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLES = {
+    # one builtin lookup per call: dominated by VM entry cost
+    'tiny': '''def tiny(xs: list) -> int:
+    return len(xs)''',
+    # len/range/max/abs looked up on every iteration
+    'hot': '''def hot(xs: list) -> int:
+    best = 0
+    for i in range(len(xs)):
+        best = max(best, abs(xs[i]) + len(xs))
+    return best''',
+}
+ARGS = {'tiny': ([1, 2, 3],), 'hot': (list(range(-100, 100)),)}
+ITERATIONS = {'tiny': 1, 'hot': 200}
+MODES = {'default': {}, 'cache': {'code_cache': True}}
+REPEATS = 5
+ROUNDS = 3
+
+
+def _timed(func, args, calls):
+    t = time.perf_counter()
+    for _ in range(calls):
+        func(*args)
+    return (time.perf_counter() - t) / calls
+
+
+def measure(calls):
+    """[(function, mode, seconds per call)]"""
+    from vm_obf import vm_obfuscate_function
+    results = []
+    for name, src in SAMPLES.items():
+        for label, kwargs in MODES.items():
+            random.seed(3)
+            ns = {}
+            exec(vm_obfuscate_function(src, name, vm_count=3, dispatch='array', **kwargs), ns)
+            func = ns[name]
+            func(*ARGS[name])
+            results.append((name, label, min(_timed(func, ARGS[name], calls) for _ in range(REPEATS))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builtin lookup cost in VM code.")
+    parser.add_argument("calls", nargs="?", type=int, default=200)
+    parser.add_argument("--against", help="Another checkout to compare with.")
+    parser.add_argument("--root", default=ROOT, help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sys.path.insert(0, args.root)
+
+    if args.json:
+        print(json.dumps(measure(args.calls)))
+        return
+    if not args.against:
+        other, results = {}, measure(args.calls)
+    else:
+        best = {}
+        for _ in range(ROUNDS):
+            for root in (args.against, args.root):
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), str(args.calls), '--root', root,
+                                      '--json'], check=True, capture_output=True, text=True).stdout
+                for name, label, per_call in json.loads(out):
+                    key = root, name, label
+                    best[key] = min(best.get(key, per_call), per_call)
+        other = {(name, label): t for (root, name, label), t in best.items() if root == args.against}
+        results = [(name, label, t) for (root, name, label), t in best.items() if root == args.root]
+    print(f"{'function':<10} {'mode':<10} {'tree':<8} {'per call':>12} {'per iter':>12}"
+          + (f" {'speedup':>8}" if other else ''))
+    for name, label, per_call in results:
+        rows = [('against', other[name, label])] if other else []
+        for tree, seconds in rows + [('this', per_call)]:
+            row = f"{name:<10} {label:<10} {tree:<8} {seconds * 1e6:>10.1f}us {seconds / ITERATIONS[name] * 1e9:>10.0f}ns"
+            if other and tree == 'this':
+                row += f" {other[name, label] / per_call:>7.2f}x"
+            print(row, flush=True)
+
+
+if __name__ == '__main__':
+    main()
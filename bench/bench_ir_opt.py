@@ -0,0 +1,85 @@
+"""Bytecode size and dispatched VM instructions per IR optimization pass.
+
+Each pass runs alone, then all of them together, against unoptimized IR.
+Sizes are summed over every function of a file after the AST transforms
+(MBA, constant unfolding), as the VM compiler sees them. Instruction
+counts come from elif builds run as __main__ as in bench_superinstructions,
+with superinstructions off so fusion does not hide what the passes remove,
+averaged over a few build seeds.
+
+Usage: python bench/bench_ir_opt.py [file ...]
+"""
+import ast
+import io
+import os
+import re
+import sys
+import random
+import builtins
+import contextlib
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from obfuscate import obfuscate, _transform_function
+from vm_compiler import VMCompiler, VMUnsupported
+from vm_optimize import IR_PASSES, code_size, optimize_ir
+
+FILES = ['tests/test1.py', 'tests/test_edge.py']
+SEEDS = range(3)
+CONFIGS = [('none', ())] + [(name, (name,)) for name in IR_PASSES] + [('all', IR_PASSES)]
+
+
+def _code_size(path, seed, passes):
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    total = 0
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        random.seed(seed)
+        func_def = _transform_function(ast.unparse(node)).body[0]
+        try:
+            result = VMCompiler().compile_function(func_def)
+        except (VMUnsupported, NotImplementedError, KeyError, SyntaxError):
+            continue
+        total += code_size(optimize_ir(result.ir, result.constants, passes))
+    return total
+
+
+def _count_instructions(path, seed, passes):
+    out = obfuscate(path, dispatch='elif', seed=seed, compound_slots=0, ir_passes=passes)
+    out = re.sub(r'\b_ic\d+ \+= 1', '_ICOUNT[0] += 1', out)
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+        f.write(out)
+    ns = {'__name__': '__main__', '__file__': f.name, '_ICOUNT': [0]}
+    random.seed(0)
+    saved_input = builtins.input
+    builtins.input = lambda prompt='': ''
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(compile(out, f.name, 'exec'), ns)
+    finally:
+        builtins.input = saved_input
+        os.unlink(f.name)
+    return ns['_ICOUNT'][0]
+
+
+def main():
+    files = sys.argv[1:] or [os.path.join(ROOT, f) for f in FILES]
+    for path in files:
+        print(f"{os.path.basename(path)}")
+        print(f"  {'passes':<8} {'bytes':>8} {'saved':>7} {'instrs':>9} {'saved':>7}")
+        base = None
+        for label, passes in CONFIGS:
+            size = sum(_code_size(path, seed, passes) for seed in SEEDS) / len(SEEDS)
+            count = sum(_count_instructions(path, seed, passes) for seed in SEEDS) / len(SEEDS)
+            if base is None:
+                base = size, count
+            print(f"  {label:<8} {size:>8.0f} {1 - size / base[0]:>7.1%} "
+                  f"{count:>9.0f} {1 - count / base[1]:>7.1%}")
+
+
+if __name__ == '__main__':
+    main()
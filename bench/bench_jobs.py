@@ -0,0 +1,57 @@
+"""Scaling of --jobs on a synthetic module with many small functions.
+
+The output for a fixed seed must be identical for every worker count.
+
+Usage: python bench/bench_jobs.py [functions]
+"""
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obfuscate import obfuscate
+
+TEMPLATES = [
+    '''def f{i}(a: int, b: int) -> int:
+    total = 0
+    for k in range(a):
+        total += (k * {i}) ^ b
+    return total''',
+    '''def f{i}(x: int) -> int:
+    if x < {i}:
+        return x * 2 + {i}
+    return x - {i}''',
+    '''def f{i}(s: str) -> str:
+    return s.upper() + "{i}"''',
+]
+
+
+def synthetic_module(n):
+    return '\n\n'.join(TEMPLATES[i % len(TEMPLATES)].format(i=i) for i in range(n)) + '\n'
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+        f.write(synthetic_module(n))
+        path = f.name
+    try:
+        print(f"{n} functions, {os.cpu_count()} cpus")
+        print(f"{'jobs':>4} {'wall':>9} {'speedup':>8}  output")
+        base = None
+        for jobs in (1, 2, 4, 8):
+            t = time.perf_counter()
+            out = obfuscate(path, jobs=jobs, seed=1234)
+            wall = time.perf_counter() - t
+            base = base or wall
+            digest = hashlib.sha1(out.encode()).hexdigest()[:12]
+            print(f"{jobs:>4} {wall:>8.2f}s {base / wall:>7.2f}x  {digest}")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
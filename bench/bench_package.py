@@ -0,0 +1,103 @@
+"""Package mode against a loop of single-file invocations.
+
+Generates a synthetic package whose modules import each other in every
+supported way, obfuscates it once with package mode and once by running
+Maskpy2.py on each file, and checks the package-mode output still runs
+and prints the same as the original.
+
+Usage: python bench/bench_package.py [modules] [jobs]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from package import obfuscate_package
+
+CORE = '''BASE = 7
+
+
+def helper(x: int) -> int:
+    return x * BASE + 1
+
+
+def scale(values, k):
+    return [v * k for v in values]
+'''
+
+UTIL = '''def clamp(x: int, lo: int, hi: int) -> int:
+    if x < lo:
+        return lo
+    if x > hi:
+        return hi
+    return x
+'''
+
+MODULE = '''from .core import helper
+from . import core
+import synth.util as u
+from .util import *
+
+
+def run{i}() -> int:
+    total = 0
+    for k in range({i} % 5 + 3):
+        total += helper(k) + u.clamp(k * {i}, 0, 50) + clamp(k, 1, 2)
+    return total + sum(core.scale([1, 2, 3], core.BASE))
+'''
+
+
+def synthetic_package(path, n):
+    os.makedirs(path)
+    files = {'__init__.py': 'from .core import helper\n', 'core.py': CORE, 'util.py': UTIL}
+    for i in range(n):
+        files[f'm{i}.py'] = MODULE.format(i=i)
+    files['__main__.py'] = ''.join(f'from .m{i} import run{i}\n' for i in range(n)) + \
+        ''.join(f'print(run{i}())\n' for i in range(n))
+    for name, code in files.items():
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(code)
+
+
+def run_package(parent):
+    return subprocess.run([sys.executable, '-m', 'synth'], cwd=parent,
+                          capture_output=True, text=True).stdout
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src', 'synth')
+        synthetic_package(src, n)
+        files = sorted(f for f in os.listdir(src) if f.endswith('.py'))
+
+        t = time.perf_counter()
+        for name in files:
+            subprocess.run([sys.executable, os.path.join(ROOT, 'Maskpy2.py'), os.path.join(src, name),
+                            '-o', os.path.join(tmp, 'loop_' + name), '--seed', '1'],
+                           check=True, capture_output=True)
+        t_loop = time.perf_counter() - t
+
+        out = os.path.join(tmp, 'out', 'synth')
+        t = time.perf_counter()
+        obfuscate_package(src, out, jobs=jobs, seed=1, report=lambda line: None)
+        t_pkg = time.perf_counter() - t
+
+        print(f"{len(files)} files, {jobs} jobs")
+        print(f"{'single-file loop':>18} {t_loop:>8.2f}s")
+        print(f"{'package mode':>18} {t_pkg:>8.2f}s  {t_loop / t_pkg:.2f}x")
+        same = run_package(os.path.dirname(src)) == run_package(os.path.dirname(out))
+        print("output runs identically" if same else "OUTPUT MISMATCH")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Size and load cost of the payloads embedded in VM-protected functions.
+
+Each of SAMPLES goes through vm_obfuscate_function (vm_count=3, seed 0) and
+the generated source is measured:
+  KiB         size of the source
+  compile     compile() of the source
+  import      unmarshalling the compiled module and executing its body,
+              as importing it from a .pyc does
+  call        time per call, in batches of BATCH
+  alloc       tracemalloc peak over one call (after a first call), what
+              building the payload, tables and pools costs every call
+Times are the best of REPEAT. 'add' is a single statement, 'table' indexes
+a literal list of TABLE constants and 'long' is LONG straight-line
+statements, so the last two embed long pools and ciphertexts.
+
+--against DIR runs the same builds with the obfuscator of another checkout
+(e.g. a `git worktree` of an older commit) and prints both side by side.
+
+Usage: python bench/bench_payload.py [-s sample ...] [--vm-cache] [--against DIR]
+"""
+import os
+import sys
+import json
+import time
+import random
+import marshal
+import argparse
+import subprocess
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TABLE = 2000
+LONG = 1500
+REPEAT = 5
+BATCH = 20
+
+
+def _sample(name):
+    if name == 'add':
+        return "def add(a: int, b: int) -> int:\n    return a + b\n", (3, 4)
+    if name == 'table':
+        values = ', '.join(str(i * 7919 % 65536) for i in range(TABLE))
+        return f"def table(i: int) -> int:\n    return [{values}][i % {TABLE}]\n", (1234,)
+    lines = [f"    v{i % 50} = v{i * 7 % 50} + {i + 1000} * n" for i in range(LONG)]
+    source = "def long(n: int) -> int:\n" + ''.join(f"    v{i} = {i}\n" for i in range(50))
+    return source + '\n'.join(lines) + "\n    return v0\n", (3,)
+
+
+SAMPLES = ('add', 'table', 'long')
+
+
+def _best(func, repeat=REPEAT):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(name, code_cache):
+    from vm_obf import vm_obfuscate_function
+    source, args = _sample(name)
+    random.seed(0)
+    text = vm_obfuscate_function(source, name, vm_count=3, code_cache=code_cache)
+    compile_s = _best(lambda: compile(text, name, 'exec'))
+    data = marshal.dumps(compile(text, name, 'exec'))
+    import_s = _best(lambda: exec(marshal.loads(data), {}))
+    ns = {}
+    exec(marshal.loads(data), ns)
+    func = ns[name]
+    result = func(*args)
+
+    def batch():
+        for _ in range(BATCH):
+            func(*args)
+    call_s = _best(batch) / BATCH
+    tracemalloc.start()
+    try:
+        func(*args)
+        alloc = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'sample': name, 'kib': len(text.encode()) / 1024, 'compile': compile_s, 'import': import_s,
+            'call': call_s, 'alloc': alloc / 1024, 'result': result}
+
+
+def _row(r):
+    return (f"{r['kib']:>8.1f} {r['compile'] * 1e3:>10.1f} {r['import'] * 1e3:>9.2f} "
+            f"{r['call'] * 1e6:>9.0f} {r['alloc']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payload size and load cost of VM builds.")
+    parser.add_argument("-s", "--samples", nargs="*", choices=SAMPLES, default=list(SAMPLES))
+    parser.add_argument("--vm-cache", action="store_true", help="Build with the code cache.")
+    parser.add_argument("--against", help="Another checkout to compare with.")
+    parser.add_argument("--root", default=ROOT, help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sys.path.insert(0, args.root)
+
+    options = ['-s', *args.samples] + (['--vm-cache'] if args.vm_cache else [])
+    other = {}
+    if args.against:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--root', args.against, '--json', *options],
+                             check=True, capture_output=True, text=True).stdout
+        other = {r['sample']: r for r in json.loads(out)}
+
+    results = []
+    for name in args.samples:
+        results.append(measure(name, args.vm_cache))
+        if args.json:
+            continue
+        r = results[-1]
+        if not results[1:]:
+            print(f"{'sample':<7} {'tree':<8} {'KiB':>8} {'compile ms':>10} {'import ms':>9} "
+                  f"{'call us':>9} {'alloc KiB':>9}")
+        if name in other:
+            old = other[name]
+            assert old['result'] == r['result'], name
+            print(f"{name:<7} {'against':<8} {_row(old)}")
+            print(f"{'':<7} {'this':<8} {_row(r)}")
+            ratios = [old[key] / r[key] if r[key] else float('inf')
+                      for key in ('kib', 'compile', 'import', 'call', 'alloc')]
+            print(f"{'':<7} {'ratio':<8} " + ' '.join(f"{x:>{w}.2f}x" for x, w in zip(ratios, (7, 9, 8, 8, 8))),
+                  flush=True)
+        else:
+            print(f"{name:<7} {'this':<8} {_row(r)}", flush=True)
+    if args.json:
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
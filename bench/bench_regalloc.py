@@ -0,0 +1,107 @@
+"""Register lowering against stack-only code for REGISTER/HYBRID VMs.
+
+Every function is split over three VMs (stack, register, hybrid). The
+"stack" build skips vm_regalloc, so the register VMs run the plain stack
+code. Instruction counts come from an instrumented elif build as in
+bench_dispatch; times use one dispatch style for both builds, averaged
+over a few seeds since block placement is random.
+
+Usage: python bench/bench_regalloc.py [calls] [dispatch]
+"""
+import os
+import re
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vm_splitter
+from vm_obf import vm_obfuscate_function
+
+SAMPLES = {
+    'loop': ('''def loop(n: int) -> int:
+    total = 0
+    for i in range(n):
+        total += i * 2
+    return total''', (200,)),
+    'fib': ('''def fib(n: int) -> int:
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a''', (150,)),
+    'poly': ('''def poly(n: int) -> int:
+    acc = 0
+    for x in range(n):
+        y = x * x - 3 * x + 7
+        acc = (acc + y * y) % 1000003
+        acc ^= x << 3
+    return acc''', (200,)),
+    'nested': ('''def nested(n: int) -> int:
+    s = 0
+    for i in range(n):
+        for j in range(i):
+            s += i * j - j
+    return s''', (40,)),
+}
+SEEDS = range(8)
+
+
+def _build(src, name, seed, dispatch, registers):
+    lower = vm_splitter.lower_registers
+    if not registers:
+        vm_splitter.lower_registers = lambda *args: None
+    try:
+        random.seed(seed)
+        return vm_obfuscate_function(src, name, vm_count=3, code_cache=True, dispatch=dispatch)
+    finally:
+        vm_splitter.lower_registers = lower
+
+
+def _count_instructions(src, name, seed, args, registers):
+    out = _build(src, name, seed, 'elif', registers)
+    out = re.sub(r'\b_ic\d+ \+= 1', '_ICOUNT[0] += 1', out)
+    ns = {'_ICOUNT': [0]}
+    exec(out, ns)
+    ns[name](*args)
+    ns['_ICOUNT'][0] = 0
+    ns[name](*args)
+    return ns['_ICOUNT'][0]
+
+
+def _time(src, name, seed, args, dispatch, calls):
+    funcs = []
+    for registers in (False, True):
+        ns = {}
+        exec(_build(src, name, seed, dispatch, registers), ns)
+        ns[name](*args)
+        funcs.append(ns[name])
+    # interleave the builds so clock drift hits both alike
+    best = [float('inf')] * 2
+    for _ in range(5):
+        for i, func in enumerate(funcs):
+            t = time.perf_counter()
+            for _ in range(calls):
+                func(*args)
+            best[i] = min(best[i], (time.perf_counter() - t) / calls)
+    return best
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    dispatch = sys.argv[2] if len(sys.argv) > 2 else 'threaded'
+    print(f"{'function':<8} {'stack':>8} {'regs':>8} {'saved':>7}   "
+          f"{'stack':>9} {'regs':>9} {'speedup':>8}  ({dispatch})")
+    for name, (src, args) in SAMPLES.items():
+        counts = [[_count_instructions(src, name, seed, args, registers) for seed in SEEDS]
+                  for registers in (False, True)]
+        n_stack, n_regs = (sum(c) / len(c) for c in counts)
+        times = [_time(src, name, seed, args, dispatch, calls) for seed in SEEDS]
+        t_stack = sum(t[0] for t in times) / len(times)
+        t_regs = sum(t[1] for t in times) / len(times)
+        print(f"{name:<8} {n_stack:>8.0f} {n_regs:>8.0f} {1 - n_regs / n_stack:>7.1%}   "
+              f"{t_stack * 1e3:>7.2f}ms {t_regs * 1e3:>7.2f}ms {t_stack / t_regs:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Estimated and measured VM segment switches per call.
+
+Each function is split over vm_count VMs. The estimate is the split's
+cost model (SplitResult.est_switches); the measurement counts passes
+through the outer segment dispatcher, minus the first entry, averaged over
+the sample calls and a few build seeds. Without a profile the estimate
+does not know about early returns, so it can exceed the measurement.
+
+Usage: python bench/bench_split.py [vm_count]
+"""
+import os
+import re
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vm_splitter
+from vm_obf import vm_obfuscate_function
+
+SAMPLES = {
+    'straight': ('''def straight(a: int, b: int) -> int:
+    c = a + b
+    d = c * 3
+    e = d - a
+    f = e ^ b
+    g = f + c
+    return g''', [(3, 4), (10, 2)]),
+    'loop': ('''def loop(n: int) -> int:
+    total = 0
+    for i in range(n):
+        total += i * 2
+    return total''', [(200,)]),
+    'early': ('''def early(n: int) -> int:
+    if n < 0:
+        return -1
+    a = n * 2
+    b = a + 1
+    for i in range(n):
+        b += i
+    c = b - a
+    return c''', [(-1,), (50,)]),
+    'nested': ('''def nested(n: int) -> int:
+    s = 0
+    for i in range(n):
+        for j in range(i):
+            s += i * j - j
+    t = s % 7
+    u = t + s
+    return u''', [(40,)]),
+}
+SEEDS = range(6)
+
+
+def _build(src, name, seed, vm_count):
+    # keep the split the build used, for its estimate
+    splits = []
+    split = vm_splitter.split_instructions
+
+    def recording_split(*args, **kwargs):
+        splits.append(split(*args, **kwargs))
+        return splits[-1]
+
+    vm_splitter.split_instructions = recording_split
+    try:
+        random.seed(seed)
+        out = vm_obfuscate_function(src, name, vm_count=vm_count, code_cache=True)
+    finally:
+        vm_splitter.split_instructions = split
+    return out, splits[0]
+
+
+def main():
+    vm_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f"{'function':<9} {'vms':>4} {'estimated':>10} {'measured':>9} {'us/call':>8}")
+    for name, (src, calls) in SAMPLES.items():
+        est = measured = elapsed = used = 0
+        for seed in SEEDS:
+            out, split = _build(src, name, seed, vm_count)
+            out = re.sub(r'(\n\s+)(_td\d+ = )', r'\1_SWITCHES[0] += 1; \2', out)
+            ns = {'_SWITCHES': [0]}
+            exec(out, ns)
+            ns[name](*calls[0])
+            for args in calls:
+                ns['_SWITCHES'][0] = 0
+                ns[name](*args)
+                measured += ns['_SWITCHES'][0] - 1
+                best = float('inf')
+                for _ in range(5):
+                    t = time.perf_counter()
+                    ns[name](*args)
+                    best = min(best, time.perf_counter() - t)
+                elapsed += best
+            est += split.est_switches
+            used += len({vm for vm, _ in split.dispatch_order})
+        n = len(SEEDS)
+        print(f"{name:<9} {used / n:>4.1f} {est / n:>10.2f} {measured / (n * len(calls)):>9.2f} "
+              f"{elapsed / (n * len(calls)) * 1e6:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
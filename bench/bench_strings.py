@@ -0,0 +1,66 @@
+"""Cost per evaluation of a protected string literal: _sd vs slot table.
+
+Every str/bytes literal in the functions of tests/test_edge.py is rewritten
+by each string-protection mode and the resulting expression is timed on its
+own, after one warm-up evaluation.
+
+Usage: python bench/bench_strings.py [evals]
+"""
+import os
+import ast
+import sys
+import random
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from string_encrypt import (StringEncryptTransformer, StringSlotTable, StringSlotTransformer,
+                            get_string_decrypt_helper, get_string_slot_helpers)
+
+
+def _literals(path):
+    tree = ast.parse(open(path).read())
+    found = []
+    for func in tree.body:
+        if isinstance(func, ast.FunctionDef):
+            for node in ast.walk(func):
+                if isinstance(node, ast.Constant) and isinstance(node.value, (str, bytes)) and node.value:
+                    found.append(node.value)
+    return found
+
+
+def _protect(values, mode):
+    random.seed(0)
+    if mode == '_sd':
+        transformer, table = StringEncryptTransformer(), None
+    else:
+        table = StringSlotTable()
+        transformer = StringSlotTransformer(table, mode)
+    exprs = [ast.unparse(transformer.visit(ast.Constant(value=v))) for v in values]
+    helpers = [get_string_decrypt_helper()] if table is None else get_string_slot_helpers(table, mode)
+    ns = {}
+    exec(compile(ast.Module(body=helpers, type_ignores=[]), '<helpers>', 'exec'), ns)
+    return exprs, ns
+
+
+def main():
+    evals = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    values = _literals(os.path.join(ROOT, 'tests', 'test_edge.py'))
+    modes = ['_sd', 'lazy', 'eager']
+    timings = {}
+    for mode in modes:
+        exprs, ns = _protect(values, mode)
+        timings[mode] = []
+        for value, expr in zip(values, exprs):
+            assert eval(expr, ns) == value
+            timings[mode].append(min(timeit.repeat(expr, globals=ns, number=evals, repeat=3)) / evals)
+    print(f"{'literal':<14} " + ' '.join(f'{m:>10}' for m in modes))
+    for j, value in enumerate(values):
+        print(f"{value!r:<14.14} " + ' '.join(f'{timings[m][j] * 1e9:>8.0f}ns' for m in modes))
+    avg = {m: sum(timings[m]) / len(values) for m in modes}
+    print(f"{'mean':<14} " + ' '.join(f'{avg[m] * 1e9:>8.0f}ns' for m in modes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Run time cost of each obfuscation stage, per target and transform.
+
+Every target is built once per CONFIGS entry through obfuscate(levels=...),
+so each stage can run alone (strings, MBA, constant unfolding, 1-5 VMs,
+the JIT trampoline) or combined with the others. "strip" is the pipeline
+with every transform off (renaming only), the floor the others add to.
+Functions the VM cannot compile fall back to the trampoline as in real builds.
+
+Each build is run in-process, `repeats` times from a fresh namespace:
+  import      executing the module body (__main__ blocks do not run)
+  first call  the first call of each sample, with code caches still cold
+  per call    steady-state time per call, in batches of at least MIN_BATCH
+  peak        tracemalloc peak over import and one call of each sample,
+              in a separate run since tracing slows everything down
+Times are medians with their standard deviation; slowdown is per call time
+against the original. Return values are checked against the original.
+ctf/ only ships a built challenge, so it is timed as shipped (import only).
+
+Results go to a JSON file and a Markdown table, to diff between commits.
+
+Usage: python bench/bench_suite.py [-r repeats] [-t target ...] [-c config ...] [--json PATH] [--markdown PATH]
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import builtins
+import platform
+import tempfile
+import statistics
+import contextlib
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from obfuscate import obfuscate
+
+KERNELS = {
+    'arith': '''def arith(n: int) -> int:
+    acc = 0
+    for i in range(n):
+        acc = (acc + i * 7 - (i ^ 3)) & 0xFFFFFF
+    return acc
+''',
+    'strings': '''def build(n: int) -> str:
+    parts = []
+    for i in range(n):
+        parts.append("item-" + str(i) + ";")
+    s = "".join(parts)
+    return s.upper()[:40] + str(len(s))
+''',
+    'dicts': '''def count_words(n: int) -> int:
+    counts = {}
+    for i in range(n):
+        key = "w" + str(i % 37)
+        counts[key] = counts.get(key, 0) + 1
+    best = 0
+    for k, v in counts.items():
+        if v > best:
+            best = v
+    return best + len(counts)
+''',
+    'recursion': '''def fib(n: int) -> int:
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+''',
+}
+
+# target: (path, [(function, args), ...]); a None path is a kernel
+TARGETS = {
+    'test1': ('tests/test1.py', [('get_sol', (50, 90))]),
+    'test2': ('tests/test2.py', [('get_sol', ('xwethgcx', b'2\x18\r\x1aH#\x0c\x1d'))]),
+    'test_edge': ('tests/test_edge.py', [
+        ('with_defaults', (3,)), ('nested_func', (50,)), ('multi_return', (5,)),
+        ('with_try', (7, 0)), ('with_while_break', (30,)), ('with_continue', (60,)),
+        ('with_nested_loops', (12,)), ('with_comprehension', (60,)),
+        ('with_dict_ops', ({'a': 1, 'b': 2, 'c': 3},)), ('with_string_ops', ('hello big world',)),
+        ('with_bool_logic', (True, False)), ('fibonacci', (30,))]),
+    'ctf': ('ctf/challenge_obfuscated.py', []),
+    'arith': (None, [('arith', (500,))]),
+    'strings': (None, [('build', (200,))]),
+    'dicts': (None, [('count_words', (300,))]),
+    'recursion': (None, [('fib', (10,))]),
+}
+PREBUILT = {'ctf'}
+
+_OFF = {'mba': 0.0, 'unfold': 0.0, 'strings': False}
+# config: level applied to every function (see obfuscate._function_level);
+# None runs the original source
+CONFIGS = {
+    'original': None,
+    'strip': dict(_OFF, tier='light'),
+    'strings': dict(_OFF, tier='light', strings=True),
+    'mba': dict(_OFF, tier='light', mba=1.0),
+    'unfold': dict(_OFF, tier='light', unfold=0.6),
+    **{f'vm{n}': dict(_OFF, vm_count=n) for n in range(1, 6)},
+    'jit': dict(_OFF, tier='jit'),
+    'ast-all': {'tier': 'light', 'mba': 1.0},
+    'jit+ast': {'tier': 'jit'},
+    'vm1+ast': {'vm_count': 1},
+    'default': {},
+}
+MIN_BATCH = 0.01
+SEED = 0
+
+
+def _source(target, tmp):
+    path, _ = TARGETS[target]
+    if path is None:
+        path = os.path.join(tmp, f'{target}.py')
+        with open(path, 'w') as f:
+            f.write(KERNELS[target])
+        return path
+    return os.path.join(ROOT, path)
+
+
+def _build(path, config):
+    # {original name: name in the build} maps the samples
+    with open(path) as f:
+        code = f.read()
+    if CONFIGS[config] is None:
+        return code, None, 0.0
+    functions = [line.split('(')[0][4:] for line in code.splitlines() if line.startswith('def ')]
+    names = {}
+    start = time.perf_counter()
+    code = obfuscate(path, seed=SEED, code_cache=True, names=names,
+                     levels=dict.fromkeys(functions, CONFIGS[config]))
+    return code, names, time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def _quiet():
+    saved_input = builtins.input
+    builtins.input = lambda prompt='': 'flag{bench}'
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        builtins.input = saved_input
+
+
+def _load(code_obj, path):
+    ns = {'__name__': '__bench__', '__file__': path}
+    random.seed(SEED)
+    with _quiet():
+        exec(code_obj, ns)
+    return ns
+
+
+def _per_call(func, args):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_BATCH:
+            return elapsed / number
+        number = max(number * 2, int(number * MIN_BATCH / max(elapsed, 1e-9)))
+
+
+def _run(code, names, path, calls):
+    """One fresh run: (import s, first call s, per call s, results)."""
+    code_obj = compile(code, path, 'exec')
+    start = time.perf_counter()
+    ns = _load(code_obj, path)
+    imported = time.perf_counter() - start
+    funcs = [ns[names[name] if names else name] for name, _ in calls]
+    first = per_call = 0.0
+    results = []
+    with _quiet():
+        for func, (_, args) in zip(funcs, calls):
+            random.seed(SEED)
+            start = time.perf_counter()
+            results.append(func(*args))
+            first += time.perf_counter() - start
+        for func, (_, args) in zip(funcs, calls):
+            per_call += _per_call(func, args)
+    return imported, first, per_call, results
+
+
+def _peak(code, names, path, calls):
+    code_obj = compile(code, path, 'exec')
+    tracemalloc.start()
+    try:
+        ns = _load(code_obj, path)
+        with _quiet():
+            for name, args in calls:
+                ns[names[name] if names else name](*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _stats(samples):
+    return {'median': statistics.median(samples),
+            'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            'samples': samples}
+
+
+def measure(target, config, repeats, tmp, expected=None):
+    path = _source(target, tmp)
+    calls = TARGETS[target][1]
+    code, names, build = _build(path, config)
+    runs = [_run(code, names, path, calls) for _ in range(repeats)]
+    results = runs[0][3]
+    entry = {
+        'target': target, 'config': config, 'build_s': build,
+        'import_s': _stats([run[0] for run in runs]),
+        'first_call_s': _stats([run[1] for run in runs]),
+        'per_call_s': _stats([run[2] for run in runs]),
+        'peak_bytes': _peak(code, names, path, calls),
+        'mismatch': [name for (name, _), got, want in zip(calls, results, expected or results)
+                     if repr(got) != repr(want)],
+    }
+    return entry, results
+
+
+def _cell(stats, scale, digits):
+    return f"{stats['median'] * scale:.{digits}f} ± {stats['stdev'] * scale:.{digits}f}"
+
+
+def markdown(entries):
+    rows = []
+    for target in dict.fromkeys(entry['target'] for entry in entries):
+        rows += [f"### {target}", "",
+                 "| config | build s | import ms | first call ms | per call µs | slowdown | peak KiB | check |",
+                 "|---|---:|---:|---:|---:|---:|---:|---|"]
+        base = None
+        for entry in entries:
+            if entry['target'] != target:
+                continue
+            per_call = entry['per_call_s']['median']
+            if base is None:
+                base = per_call
+            slowdown = f"{per_call / base:.2f}x" if base else '-'
+            check = ('mismatch: ' + ', '.join(entry['mismatch'])) if entry['mismatch'] else 'ok'
+            rows.append(f"| {entry['config']} | {entry['build_s']:.2f} | {_cell(entry['import_s'], 1e3, 2)} "
+                        f"| {_cell(entry['first_call_s'], 1e3, 2)} | {_cell(entry['per_call_s'], 1e6, 1)} "
+                        f"| {slowdown} | {entry['peak_bytes'] / 1024:.0f} | {check} |")
+        rows.append("")
+    return '\n'.join(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Original vs obfuscated run time, per transform.")
+    parser.add_argument("-r", "--repeats", type=int, default=5, help="Fresh runs per build (default: 5).")
+    parser.add_argument("-t", "--targets", nargs="*", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("-c", "--configs", nargs="*", choices=CONFIGS, default=list(CONFIGS))
+    parser.add_argument("--json", default="bench_suite.json", help="JSON results (default: bench_suite.json).")
+    parser.add_argument("--markdown", default="bench_suite.md", help="Markdown table (default: bench_suite.md).")
+    args = parser.parse_args()
+    # every slowdown is relative to the original
+    configs = ['original'] + [c for c in args.configs if c != 'original']
+    entries = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for target in args.targets:
+            expected = None
+            for config in (['original'] if target in PREBUILT else configs):
+                entry, results = measure(target, config, args.repeats, tmp, expected)
+                expected = expected or results
+                entries.append(entry)
+                print(f"{target:<10} {config:<9} {entry['per_call_s']['median'] * 1e6:>10.1f}us/call "
+                      f"{entry['import_s']['median'] * 1e3:>8.2f}ms import", flush=True)
+    with open(args.json, 'w') as f:
+        json.dump({'python': platform.python_version(), 'repeats': args.repeats, 'seed': SEED,
+                   'results': entries}, f, indent=1)
+    with open(args.markdown, 'w') as f:
+        f.write(markdown(entries))
+    print(f"results written to {args.json} and {args.markdown}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Dispatched VM instructions with and without superinstructions.
+
+Each file is obfuscated with elif dispatch, whose per-instruction counter is
+turned into a global as in bench_dispatch, and run as __main__ with stdout
+discarded and a fixed random seed. NOP padding is drawn per instruction, so
+counts are averaged over a few build seeds.
+
+Usage: python bench/bench_superinstructions.py [slots] [file ...]
+"""
+import io
+import os
+import re
+import sys
+import random
+import builtins
+import contextlib
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from obfuscate import obfuscate
+
+FILES = ['tests/test1.py', 'tests/test_edge.py']
+SEEDS = range(5)
+
+
+def _count_instructions(path, seed, slots):
+    out = obfuscate(path, dispatch='elif', seed=seed, compound_slots=slots)
+    out = re.sub(r'\b_ic\d+ \+= 1', '_ICOUNT[0] += 1', out)
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+        f.write(out)
+    ns = {'__name__': '__main__', '__file__': f.name, '_ICOUNT': [0]}
+    random.seed(0)
+    saved_input = builtins.input
+    builtins.input = lambda prompt='': ''
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(compile(out, f.name, 'exec'), ns)
+    finally:
+        builtins.input = saved_input
+        os.unlink(f.name)
+    return ns['_ICOUNT'][0], len(out)
+
+
+def main():
+    slots = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    files = sys.argv[2:] or [os.path.join(ROOT, f) for f in FILES]
+    print(f"{'file':<20} {'instrs':>9} {f'slots={slots}':>9} {'saved':>7} {'size':>7}")
+    for path in files:
+        base = [_count_instructions(path, seed, 0) for seed in SEEDS]
+        fused = [_count_instructions(path, seed, slots) for seed in SEEDS]
+        n_base = sum(n for n, _ in base) / len(base)
+        n_fused = sum(n for n, _ in fused) / len(fused)
+        size = sum(s for _, s in fused) / sum(s for _, s in base) - 1
+        print(f"{os.path.basename(path):<20} {n_base:>9.0f} {n_fused:>9.0f} "
+              f"{1 - n_fused / n_base:>7.1%} {size:>+7.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""First-call latency of JIT trampolines against marshalled code size.
+
+The first call of an encrypt_function trampoline checks, decrypts and
+unmarshals the code object; later calls go straight to the real function.
+
+Usage: python bench/bench_trampoline.py [rounds]
+"""
+import os
+import sys
+import time
+import random
+import marshal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bytecode_obf import encrypt_function
+
+SIZES = [1_000, 10_000, 50_000, 100_000, 200_000]
+VARIANTS = {0: 'perm+xor', 1: 'xor+perm', 2: 'xor'}
+
+
+def sized_function(target):
+    # straight-line body; grow it until the marshalled code reaches target
+    lines = ['def f(a):', '    s = 0']
+    i = 0
+    while True:
+        for _ in range(16):
+            lines.append(f'    s += a * {i} + {i * 7919}')
+            i += 1
+        src = '\n'.join(lines + ['    return s']) + '\n'
+        code = compile(src, '<bench>', 'exec').co_consts[0]
+        size = len(marshal.dumps(code))
+        if size >= target:
+            return src, size
+
+
+def first_call(src, variant):
+    g = {}
+    exec(encrypt_function(src, 'f', variant=variant), g)
+    t = time.perf_counter()
+    g['f'](0)
+    first = time.perf_counter() - t
+    t = time.perf_counter()
+    g['f'](0)
+    return first - (time.perf_counter() - t)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    random.seed(0)
+    print(f"{'marshalled':>10} " + ' '.join(f'{name:>10}' for name in VARIANTS.values()))
+    for target in SIZES:
+        src, size = sized_function(target)
+        best = [min(first_call(src, variant) for _ in range(rounds)) for variant in VARIANTS]
+        print(f"{size:>10} " + ' '.join(f'{t * 1000:>8.2f}ms' for t in best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Per-call latency of VM-protected functions with and without the code cache.
+
+Usage: python bench/bench_vm_cache.py [calls]
+"""
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vm_obf import vm_obfuscate_function
+
+SAMPLES = {
+    'add': '''def add(a: int, b: int) -> int:
+    return a + b''',
+    'loop': '''def loop(n: int) -> int:
+    total = 0
+    for i in range(n):
+        total += i * 2
+    return total''',
+    'branches': '''def branches(x: int) -> int:
+    if x < 0:
+        return -1
+    elif x == 0:
+        return 0
+    elif x < 10:
+        return 1
+    return 2''',
+}
+ARGS = {'add': (3, 4), 'loop': (10,), 'branches': (5,)}
+
+
+def _build(src, name, seed, **kwargs):
+    random.seed(seed)
+    ns = {}
+    exec(vm_obfuscate_function(src, name, vm_count=3, **kwargs), ns)
+    return ns[name]
+
+
+def _measure(func, args, calls):
+    t = time.perf_counter()
+    func(*args)
+    first = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(calls):
+        func(*args)
+    return first, (time.perf_counter() - t) / calls
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{'function':<10} {'mode':<14} {'first call':>12} {'later calls':>12} {'speedup':>8}")
+    for name, src in SAMPLES.items():
+        base_first, base_next = _measure(_build(src, name, 1), ARGS[name], calls)
+        print(f"{name:<10} {'no cache':<14} {base_first * 1e6:>10.1f}us {base_next * 1e6:>10.1f}us {'1.00x':>8}")
+        for label, kwargs in (('cache', {'code_cache': True}),
+                              ('cache+recheck', {'code_cache': True, 'cache_recheck': 50})):
+            first, nxt = _measure(_build(src, name, 1, **kwargs), ARGS[name], calls)
+            print(f"{name:<10} {label:<14} {first * 1e6:>10.1f}us {nxt * 1e6:>10.1f}us {base_next / nxt:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
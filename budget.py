@@ -0,0 +1,280 @@
+"""Run time budget: step protection down until functions meet a slowdown limit.
+
+Sample inputs come from a sidecar file next to the source, `name.bench.json`:
+
+    {"checksum": [["abc", 7], ["", 0]], "fib": [[20]]}
+
+or from a `__maskpy_bench__` hook in the module, a dict of the same shape
+or a function returning one (values need not be JSON then). Each entry is
+a list of positional argument lists for one function.
+
+Every round builds the module, then times the original against the
+candidate in a fresh interpreter (this file run as a script). Functions over the
+limit move one step down LEVELS. Unchanged functions keep their output
+between rounds, since per-function seeds do not depend on other functions.
+
+The same samples measure what each AST stage adds (stage_overhead).
+"""
+import os
+import ast
+import sys
+import json
+import time
+import random
+import runpy
+import tempfile
+import contextlib
+import subprocess
+
+# protection steps, strongest first. vm_count caps the VMs per function,
+# padding=False drops NOP padding and MORPH preambles, mba and unfold are
+# the share of integer operations and constants rewritten, and the last
+# step swaps the VM for the bytecode trampoline (see obfuscate._function_level)
+LEVELS = [
+    {},
+    {'vm_count': 2},
+    {'vm_count': 1},
+    {'vm_count': 1, 'padding': False},
+    {'vm_count': 1, 'padding': False, 'mba': 0.5, 'unfold': 0.3},
+    {'vm_count': 1, 'padding': False, 'mba': 0.0, 'unfold': 0.1},
+    {'tier': 'jit', 'mba': 0.0, 'unfold': 0.1},
+]
+# AST stages in pipeline order, as named in obfuscate's stage_ops
+STAGES = ('opaque', 'cff', 'mba', 'unfold')
+# each sample is timed in batches of at least this many seconds
+MIN_BATCH = 0.02
+REPEAT = 3
+
+
+def parse_slowdown(text):
+    """'3x' or '3' -> 3.0"""
+    value = float(text[:-1] if text.lower().endswith('x') else text)
+    if value < 1:
+        raise ValueError(f"slowdown must be at least 1x: {text}")
+    return value
+
+
+def sidecar_path(filename):
+    return os.path.splitext(filename)[0] + '.bench.json'
+
+
+def fit_budget(filename, max_slowdown, functions_to_obfuscate=[], seed=None, **options):
+    """Obfuscate `filename` so each sampled function runs at most `max_slowdown` times slower.
+
+    Returns (code, report); report maps function names to a dict with the
+    chosen 'level', the measured 'ratio' (None without samples), the
+    ratio measured at each level tried as 'steps' and an 'error' when the
+    candidate failed or returned something else.
+    """
+    from obfuscate import obfuscate
+
+    if seed is None:
+        seed = random.getrandbits(64)
+    levels = {}
+    report = {}
+    pending = None
+    # only the build that is returned reports its fallbacks
+    fallbacks = options.pop('fallbacks', None)
+    while True:
+        names = {}
+        built = {}
+        code = obfuscate(filename, functions_to_obfuscate, seed=seed, names=names, fallbacks=built,
+                         levels={name: LEVELS[level] for name, level in levels.items()}, **options)
+        if pending is None:
+            pending = set(names)
+            levels = dict.fromkeys(names, 0)
+            report = {name: {'level': 0, 'ratio': None, 'steps': []} for name in names}
+        results = measure(filename, code, {name: names[name] for name in pending})
+        pending &= set(results)
+        for name in sorted(pending):
+            report[name].update(results[name])
+            ratio = results[name].get('ratio')
+            report[name]['steps'].append(ratio)
+            if ratio is None or ratio <= max_slowdown or levels[name] == len(LEVELS) - 1:
+                pending.discard(name)
+            else:
+                levels[name] += 1
+                report[name]['level'] = levels[name]
+        if not pending:
+            if fallbacks is not None:
+                fallbacks.update(built)
+            return code, report
+
+
+def measure(filename, code, names):
+    """{name: {'ratio': obfuscated / original time}} for the sampled functions of `names`.
+
+    `names` maps original function names to their names in `code`. Both
+    modules are loaded in a subprocess, so neither the build nor earlier
+    candidates share its caches or warm-up.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        candidate = os.path.join(tmp, os.path.basename(filename))
+        with open(candidate, 'w', encoding='utf-8') as f:
+            f.write(code)
+        spec = os.path.join(tmp, 'spec.json')
+        out = os.path.join(tmp, 'result.json')
+        with open(spec, 'w') as f:
+            json.dump({'original': os.path.abspath(filename), 'candidate': candidate,
+                       'names': names, 'out': out}, f)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), spec],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise ValueError(f"timing run failed:\n{proc.stderr.strip()}")
+        with open(out) as f:
+            return json.load(f)
+
+
+def stage_overhead(filename, functions_to_obfuscate=[], seed=None, levels=None, **options):
+    """{name: {stage: slowdown}} for the sampled functions, measured per AST stage.
+
+    The module is built with the stages switched on one at a time in
+    pipeline order, starting with all of them off ('base': VM or
+    trampoline, strings); a stage's slowdown is the ratio of the builds
+    with and without it. opaque and cff only count when `options` turn
+    them on. Every build uses `seed`, so the last one is the full build.
+    """
+    from obfuscate import obfuscate
+    from ast_stack import recursion_limit
+
+    if seed is None:
+        seed = random.getrandbits(64)
+    if not functions_to_obfuscate:
+        with open(filename) as f, recursion_limit():
+            functions_to_obfuscate = [node.name for node in ast.parse(f.read()).body
+                                      if isinstance(node, ast.FunctionDef)]
+    stages = [stage for stage in STAGES if stage in ('mba', 'unfold') or options.get(stage)]
+    report = {}
+    previous = {}
+    for count in range(len(stages) + 1):
+        off = stages[count:]
+        build = dict(options, **{stage: False for stage in off if stage in ('opaque', 'cff')})
+        off_levels = {stage: 0.0 for stage in off if stage in ('mba', 'unfold')}
+        names = {}
+        code = obfuscate(filename, functions_to_obfuscate, seed=seed, names=names,
+                         levels={name: dict((levels or {}).get(name, {}), **off_levels)
+                                 for name in functions_to_obfuscate}, **build)
+        stage = stages[count - 1] if count else 'base'
+        for name, result in measure(filename, code, names).items():
+            entry = report.setdefault(name, {})
+            if 'error' in result or 'error' in entry:
+                entry.setdefault('error', result.get('error'))
+                continue
+            entry[stage] = result['ratio'] / previous.get(name, 1.0)
+            previous[name] = result['ratio']
+    return report
+
+
+def stage_table(stage_ops, overhead=None):
+    """Operations after each stage and the slowdown it measured (stage_overhead), per function."""
+    rows = [f"{'function':<24} {'stage':<8} {'ops':>6} {'added':>7} {'measured':>9}"]
+    for name, counts in sorted(stage_ops.items()):
+        measured = (overhead or {}).get(name, {})
+        previous = None
+        for stage, ops in counts:
+            added = '' if previous is None else f"+{ops - previous}"
+            ratio = measured.get('base' if stage == 'source' else stage)
+            shown = '-' if ratio is None else f"{ratio:.2f}x"
+            rows.append(f"{name if previous is None else '':<24} {stage:<8} {ops:>6} {added:>7} {shown:>9}")
+            previous = ops
+        if 'error' in measured:
+            rows.append(f"{'':<24} error: {measured['error']}")
+    return '\n'.join(rows)
+
+
+def describe_level(level):
+    """Short text for a LEVELS entry, for build logs."""
+    level = LEVELS[level]
+    if 'tier' in level:
+        parts = [level['tier']]
+    else:
+        parts = [f"vms<={level['vm_count']}" if 'vm_count' in level else 'vm']
+        if level.get('padding') is False:
+            parts.append('no-pad')
+    if 'mba' in level:
+        parts.append(f"mba={level['mba']:g} unfold={level['unfold']:g}")
+    return ' '.join(parts)
+
+
+def budget_table(report, max_slowdown):
+    rows = [f"{'function':<24} {'level':<28} {'ratio':>8}  (limit {max_slowdown:g}x)"]
+    for name, entry in sorted(report.items()):
+        ratio = entry['ratio']
+        note = ''
+        if 'error' in entry:
+            note = f"  error: {entry['error']}"
+        elif ratio is None:
+            note = '  no samples'
+        elif ratio > max_slowdown:
+            note = '  over budget'
+        if len(entry['steps']) > 1:
+            note += '  (tried ' + ', '.join(f"{r:.2f}x" for r in entry['steps'][:-1]) + ')'
+        shown = '-' if ratio is None else f"{ratio:.2f}x"
+        level = f"{entry['level']} {describe_level(entry['level'])}"
+        rows.append(f"{name:<24} {level:<28} {shown:>8}{note}")
+    return '\n'.join(rows)
+
+
+def _load(path):
+    # module level code runs, the __main__ block does not
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        return runpy.run_path(path, run_name='__maskpy_bench__')
+
+
+def _samples(original, namespace):
+    path = sidecar_path(original)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    hook = namespace.get('__maskpy_bench__', {})
+    return hook() if callable(hook) else hook
+
+
+def _per_call(func, args):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_BATCH:
+            break
+        number = max(number * 2, int(number * MIN_BATCH / max(elapsed, 1e-9)))
+    best = elapsed / number
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def _time_functions(spec):
+    sys.path.insert(0, os.path.dirname(spec['original']))
+    original = _load(spec['original'])
+    candidate = _load(spec['candidate'])
+    samples = _samples(spec['original'], original)
+    results = {}
+    for name, obf_name in spec['names'].items():
+        if not samples.get(name):
+            continue
+        before = after = 0.0
+        try:
+            for args in samples[name]:
+                # first calls decrypt code caches and string slots
+                expected = original[name](*args)
+                if candidate[obf_name](*args) != expected:
+                    raise ValueError(f"returned a different result for {args!r}")
+                before += _per_call(original[name], args)
+                after += _per_call(candidate[obf_name], args)
+        except Exception as e:
+            results[name] = {'ratio': None, 'error': str(e) or type(e).__name__}
+            continue
+        results[name] = {'ratio': after / before}
+    with open(spec['out'], 'w') as f:
+        json.dump(results, f)
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        _time_functions(json.load(f))
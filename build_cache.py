@@ -0,0 +1,63 @@
+import os
+import pickle
+import hashlib
+
+_TOOL_VERSION = None
+
+
+def tool_version():
+    # hash of the obfuscator's own sources: any code change invalidates the cache
+    global _TOOL_VERSION
+    if _TOOL_VERSION is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(root)):
+            if name.endswith('.py'):
+                h.update(name.encode() + b'\0')
+                with open(os.path.join(root, name), 'rb') as f:
+                    h.update(f.read())
+        _TOOL_VERSION = h.hexdigest()
+    return _TOOL_VERSION
+
+
+def source_hash(source):
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+class OutputCache:
+    """Content-addressed on-disk store of per-function obfuscation output.
+
+    Values are pickled, so a stage can cache AST nodes as well as text.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage, source, config):
+        h = hashlib.sha256()
+        for part in (tool_version(), stage, repr(config), source):
+            h.update(part.encode() + b'\0')
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
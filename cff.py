@@ -2,11 +2,45 @@ import ast
 import random
 
 
+# handler dispatch styles: 'chain' walks a shuffled if/elif chain or a
+# binary tree of comparisons, 'table' indexes a list of handler closures
+# and 'auto' uses the table from TABLE_MIN_STATES states on. The VM
+# compiler has no nested functions, so code headed for a VM needs 'chain'
+DISPATCH = ('chain', 'table', 'auto')
+# below this many states the closure calls (and building the closures on
+# every call) cost more than the comparisons they save (bench/bench_cff.py)
+TABLE_MIN_STATES = 24
+# straight-line statements per state in pipeline builds
+CFF_BLOCK_SIZE = 4
+# names whose meaning changes inside a nested function
+_SCOPE_BUILTINS = {'super', 'locals', 'vars', 'exec', 'eval'}
+
+
 class CFFTransformer(ast.NodeTransformer):
+    """Flatten each function into a state machine.
+
+    block_size is the most straight-line statements merged into one state
+    (1 gives every statement its own state). dispatch='table' and 'auto'
+    fall back to 'chain' for functions whose statements cannot move into
+    closures. Functions flattening would break are left as they are.
+    Table dispatch defines the handlers as nested functions, which
+    vm_compiler rejects (VMUnsupported('FunctionDef')): use 'chain' for
+    functions that will be VM-compiled.
+    """
+
+    def __init__(self, block_size=1, dispatch='chain'):
+        if dispatch not in DISPATCH:
+            raise ValueError(f"unknown dispatch: {dispatch}")
+        self.block_size = max(block_size, 1)
+        self.dispatch = dispatch
+
     def visit_FunctionDef(self, node):
         self.generic_visit(node)
-        helper = CFFHelper()
-        param_names = [arg.arg for arg in node.args.args]
+        if not _flattenable(node.body):
+            return node
+        helper = CFFHelper(self.block_size)
+        table = self.dispatch != 'chain' and _table_safe(node.body)
+        param_names = [arg.arg for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs]
         if node.args.vararg:
             param_names.append(node.args.vararg.arg)
         if node.args.kwarg:
@@ -25,12 +59,6 @@ class CFFTransformer(ast.NodeTransformer):
             {v for v in assigned_vars if not v.startswith('encoded_')}
             - set(param_names) - exclude_vars
         )
-        init_assigns = [
-            ast.Assign(
-                targets=[ast.Name(id=v, ctx=ast.Store())],
-                value=ast.Constant(value=0))
-            for v in local_vars_to_init
-        ]
 
         # process body into state machine
         start_state = helper.process_statements(node.body, helper.exit_state)
@@ -98,33 +126,39 @@ class CFFTransformer(ast.NodeTransformer):
             targets=[_name(helper.mask_var, store=True)],
             value=ast.Constant(value=vm))
 
-        # _d = {_p[i]: _p[i+1] ^ _vm for i in range(0, len(_p), 2)}
+        # _d = {}; for i in range(0, len(_p), 2): _d[_p[i]] = _p[i+1] ^ _vm
+        # (a loop rather than a dict comprehension, which the VM cannot compile)
         _ci = '_ci'
-        dt_build = ast.Assign(
-            targets=[_name(helper.dispatch_var, store=True)],
-            value=ast.DictComp(
-                key=ast.Subscript(
-                    value=_name(helper.pack_var),
-                    slice=_name(_ci), ctx=ast.Load()),
-                value=ast.BinOp(
-                    left=ast.Subscript(
-                        value=_name(helper.pack_var),
-                        slice=ast.BinOp(
-                            left=_name(_ci), op=ast.Add(),
-                            right=ast.Constant(value=1)),
-                        ctx=ast.Load()),
-                    op=ast.BitXor(),
-                    right=_name(helper.mask_var)),
-                generators=[ast.comprehension(
-                    target=_name(_ci, store=True),
-                    iter=ast.Call(
-                        func=_name('range'), args=[
-                            ast.Constant(value=0),
-                            ast.Call(func=_name('len'),
-                                     args=[_name(helper.pack_var)], keywords=[]),
-                            ast.Constant(value=2)],
-                        keywords=[]),
-                    ifs=[], is_async=0)]))
+        dt_build = [
+            ast.Assign(
+                targets=[_name(helper.dispatch_var, store=True)],
+                value=ast.Dict(keys=[], values=[])),
+            ast.For(
+                target=_name(_ci, store=True),
+                iter=ast.Call(
+                    func=_name('range'), args=[
+                        ast.Constant(value=0),
+                        ast.Call(func=_name('len'),
+                                 args=[_name(helper.pack_var)], keywords=[]),
+                        ast.Constant(value=2)],
+                    keywords=[]),
+                body=[ast.Assign(
+                    targets=[ast.Subscript(
+                        value=_name(helper.dispatch_var),
+                        slice=ast.Subscript(
+                            value=_name(helper.pack_var),
+                            slice=_name(_ci), ctx=ast.Load()),
+                        ctx=ast.Store())],
+                    value=ast.BinOp(
+                        left=ast.Subscript(
+                            value=_name(helper.pack_var),
+                            slice=ast.BinOp(
+                                left=_name(_ci), op=ast.Add(),
+                                right=ast.Constant(value=1)),
+                            ctx=ast.Load()),
+                        op=ast.BitXor(),
+                        right=_name(helper.mask_var)))],
+                orelse=[])]
 
         # while loop
         encoded_exit = helper.encode_state(helper.exit_state)
@@ -149,9 +183,20 @@ class CFFTransformer(ast.NodeTransformer):
                 right=_name(helper.mask_var)))
 
         # polymorphic handler dispatch: randomly choose style per function
-        cff_dispatch_style = random.choice(['elif', 'tree'])
-
-        if cff_dispatch_style == 'tree':
+        if table and (self.dispatch == 'table' or n >= TABLE_MIN_STATES):
+            cff_dispatch_style = 'table'
+        else:
+            cff_dispatch_style = random.choice(['elif', 'tree'])
+
+        if cff_dispatch_style == 'table':
+            # handlers share the function's variables through nonlocal, so
+            # every name they bind must exist in the function first
+            handler_defs, call = _build_table_dispatch(
+                shuffled_info, helper, real_state_ids)
+            for handler in handler_defs[:-1]:
+                local_vars_to_init |= _bound_names(handler.body)
+            local_vars_to_init -= set(param_names) | exclude_vars | helper.bogus_vars
+        elif cff_dispatch_style == 'tree':
             # binary search tree dispatch on handler index
             chain = _build_tree_dispatch(
                 shuffled_info, helper, real_state_ids, n)
@@ -172,9 +217,13 @@ class CFFTransformer(ast.NodeTransformer):
                 if_stmt = ast.If(test=cond, body=code, orelse=chain)
                 chain = [if_stmt]
 
+        if cff_dispatch_style == 'table':
+            loop_body = [call]
+        else:
+            loop_body = [hi_lookup] + chain
         while_loop = ast.While(
             test=while_test,
-            body=[hi_lookup] + chain,
+            body=loop_body,
             orelse=[])
 
         # sentinel for for-loops
@@ -184,6 +233,14 @@ class CFFTransformer(ast.NodeTransformer):
                 targets=[_name(helper.sentinel_var, store=True)],
                 value=ast.Call(func=_name('object'), args=[], keywords=[])))
 
+        init_assigns = [
+            ast.Assign(
+                targets=[ast.Name(id=v, ctx=ast.Store())],
+                value=ast.Constant(value=0))
+            # sorted: set order follows PYTHONHASHSEED, seeded builds must not
+            for v in sorted(local_vars_to_init)
+        ]
+
         # Assemble
         init_state = ast.Assign(
             targets=[_name(helper.state_var, store=True)],
@@ -197,13 +254,121 @@ class CFFTransformer(ast.NodeTransformer):
             value=ast.Constant(value=0))
         return_stmt = ast.Return(value=_name(helper.return_var))
 
+        if cff_dispatch_style == 'table':
+            init_assigns += handler_defs
         node.body = (sentinel_stmts + init_assigns +
-                     [p_assign, vm_assign, dt_build,
-                      init_state, init_sub, init_return,
+                     [p_assign, vm_assign] + dt_build +
+                     [init_state, init_sub, init_return,
                       while_loop, return_stmt])
         return node
 
 
+def _build_table_dispatch(shuffled_info, helper, real_state_ids):
+    # one closure per handler index; the loop calls _j[_d[_s] ^ _vm]().
+    # The closures keep the result out of the VM tier (see CFFTransformer)
+    ids = random.sample(range(100, 100 + max(900, len(shuffled_info))), len(shuffled_info))
+    handler_defs = []
+    for uid, (code, raw_state) in zip(ids, shuffled_info):
+        if random.random() < 0.4:
+            code = helper.wrap_guard(code, raw_state, real_state_ids)
+        shared = sorted(_bound_names(code) - helper.bogus_vars)
+        body = ([ast.Nonlocal(names=shared)] if shared else []) + code
+        handler = ast.parse(f'def {helper.table_var}_{uid}(): pass').body[0]
+        handler.body = body
+        handler_defs.append(handler)
+    table = ast.Assign(
+        targets=[_name(helper.table_var, store=True)],
+        value=ast.List(elts=[_name(h.name) for h in handler_defs], ctx=ast.Load()))
+    index = ast.BinOp(
+        left=ast.Subscript(value=_name(helper.dispatch_var),
+                           slice=_name(helper.state_var), ctx=ast.Load()),
+        op=ast.BitXor(), right=_name(helper.mask_var))
+    call = ast.Call(
+        func=ast.Subscript(value=_name(helper.table_var), slice=index, ctx=ast.Load()),
+        args=[], keywords=[])
+    return handler_defs + [table], ast.Expr(value=call)
+
+
+def _bound_names(stmts):
+    """Names the statements bind in their own scope (not in nested functions)."""
+    names = set()
+    todo = list(stmts)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+            continue
+        if isinstance(node, ast.Lambda):
+            continue
+        if isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            # only := escapes a comprehension
+            names.update(n.target.id for n in ast.walk(node) if isinstance(n, ast.NamedExpr))
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+        todo.extend(ast.iter_child_nodes(node))
+    return names
+
+
+def _flattenable(stmts):
+    """Whether flattening keeps the behaviour of a function body.
+
+    The state machine takes apart if/while/for and their return, break and
+    continue; anything else stays inside one state, where a break or
+    continue would hit the dispatch loop. Pre-initialising locals also
+    rules out global and nonlocal declarations.
+    """
+    return _states_safe(stmts, closure=False)
+
+
+def _table_safe(stmts):
+    """Whether the function body still works with its states moved into closures.
+
+    On top of _flattenable: a return left inside a state would leave the
+    handler instead of the function, and generators, awaits and
+    frame-inspecting builtins would see the handler's frame.
+    """
+    return _states_safe(stmts, closure=True)
+
+
+def _states_safe(stmts, closure):
+    for stmt in stmts:
+        if isinstance(stmt, (ast.If, ast.While, ast.For)):
+            if not (_states_safe(stmt.body, closure) and _states_safe(stmt.orelse, closure)):
+                return False
+        elif not isinstance(stmt, (ast.Return, ast.Break, ast.Continue)) \
+                and not _state_safe(stmt, False, closure):
+            return False
+    return True
+
+
+def _state_safe(node, in_loop, closure):
+    if isinstance(node, ast.ClassDef):
+        # decorators, bases and defaults still run in the state
+        return all(_state_safe(n, in_loop, closure) for n in node.decorator_list + node.bases)
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+        outer = getattr(node, 'decorator_list', []) + node.args.defaults
+        return all(_state_safe(n, in_loop, closure) for n in outer + [d for d in node.args.kw_defaults if d])
+    if isinstance(node, (ast.Global, ast.Nonlocal)):
+        return False
+    if isinstance(node, (ast.Break, ast.Continue)) and not in_loop:
+        return False
+    if closure and isinstance(node, (ast.Yield, ast.YieldFrom, ast.Await, ast.Return)):
+        return False
+    if closure and isinstance(node, ast.Name) and node.id in _SCOPE_BUILTINS:
+        return False
+    loop = isinstance(node, (ast.While, ast.For, ast.AsyncFor))
+    return all(_state_safe(child, in_loop or loop, closure) for child in ast.iter_child_nodes(node))
+
+
 def _build_tree_dispatch(shuffled_info, helper, real_state_ids, n):
     # collect valid handlers
     handlers = []
@@ -245,17 +410,22 @@ def _build_tree_dispatch(shuffled_info, helper, real_state_ids, n):
     return build_tree(handlers)
 
 
+_CONTROL = (ast.If, ast.Return, ast.While, ast.For, ast.Break, ast.Continue)
+
+
 def _name(id, store=False):
     return ast.Name(id=id, ctx=ast.Store() if store else ast.Load())
 
 
 class CFFHelper:
-    def __init__(self):
+    def __init__(self, block_size=1):
+        self.block_size = block_size
         self.keys = []
         self._used_states = set()
         self._loop_stack = []
         self._iter_count = 0
         self.needs_sentinel = False
+        self.bogus_vars = set()
         self.sentinel_var = f'_sn{random.randint(10, 99)}'
 
         # 3-key state cipher
@@ -278,6 +448,7 @@ class CFFHelper:
         self.dispatch_var = f'_d{random.randint(100, 999)}'
         self.pack_var = f'_p{random.randint(100, 999)}'
         self.mask_var = f'_m{random.randint(100, 999)}'
+        self.table_var = f'_j{random.randint(100, 999)}'
 
         # Sub-state tracking: each state has an expected _u value
         self.sub_init = random.randint(0, 0xFFFF)
@@ -384,6 +555,7 @@ class CFFHelper:
         code = []
         for _ in range(random.randint(1, 3)):
             var = _name(f'_t{random.randint(0, 999)}', store=True)
+            self.bogus_vars.add(var.id)
             val = ast.BinOp(
                 left=_name(self.sub_var),
                 op=random.choice([ast.Add(), ast.Sub(), ast.Mult(), ast.BitXor()]),
@@ -396,9 +568,21 @@ class CFFHelper:
     def process_statements(self, stmts, next_state):
         if not stmts:
             return next_state
+        # runs of straight-line statements share a state, block_size at a time
+        items = []
+        for stmt in stmts:
+            if isinstance(stmt, _CONTROL):
+                items.append(stmt)
+            elif items and isinstance(items[-1], list) and len(items[-1]) < self.block_size:
+                items[-1].append(stmt)
+            else:
+                items.append([stmt])
         current = next_state
-        for stmt in reversed(stmts):
-            current = self.process_statement(stmt, current)
+        for item in reversed(items):
+            if isinstance(item, list):
+                current = self._process_regular(item, current)
+            else:
+                current = self.process_statement(item, current)
         return current
 
     def process_statement(self, stmt, next_state):
@@ -415,7 +599,7 @@ class CFFHelper:
         elif isinstance(stmt, ast.Continue):
             return self._process_continue()
         else:
-            return self._process_regular(stmt, next_state)
+            return self._process_regular([stmt], next_state)
 
     def _process_if(self, stmt, next_state):
         then_start = self.process_statements(stmt.body, next_state)
@@ -513,8 +697,68 @@ class CFFHelper:
         self.keys.append((block_state, self.assign_state(continue_target), True))
         return block_state
 
-    def _process_regular(self, stmt, next_state):
+    def _process_regular(self, stmts, next_state):
         block_state = self.new_state()
-        block_code = [stmt] + self.assign_state(next_state)
+        block_code = list(stmts) + self.assign_state(next_state)
         self.keys.append((block_state, block_code, True))
         return block_state
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import subprocess
+
+    SAMPLE = """
+def f(x, n):
+    total = 0
+    for i in range(n):
+        if i % 3 == 0:
+            alpha = i * x
+            total += alpha
+        elif i % 3 == 1:
+            beta, gamma = i, x
+            total -= beta * gamma
+        else:
+            delta = [i, x]
+            total ^= sum(delta)
+    epsilon = total % 97
+    return total + epsilon
+"""
+
+    def flatten(dispatch, seed=0):
+        random.seed(seed)
+        tree = CFFTransformer(1, dispatch).visit(ast.parse(SAMPLE))
+        return ast.unparse(ast.fix_missing_locations(tree))
+
+    ns = {}
+    exec(SAMPLE, ns)
+    for dispatch in DISPATCH:
+        flat = {}
+        exec(flatten(dispatch), flat)
+        assert all(flat['f'](x, n) == ns['f'](x, n) for x in (-3, 0, 7) for n in (0, 1, 10)), dispatch
+
+    # seeded output does not depend on the hash seed
+    if len(sys.argv) > 1:
+        print(flatten(sys.argv[1]))
+        sys.exit()
+    for dispatch in DISPATCH:
+        outputs = {subprocess.run([sys.executable, __file__, dispatch], check=True, capture_output=True, text=True,
+                                  env=dict(os.environ, PYTHONHASHSEED=hash_seed)).stdout
+                   for hash_seed in ('1', '2')}
+        assert len(outputs) == 1, dispatch
+
+    # chain dispatch still VM-compiles, the table's closures do not
+    from vm_obf import vm_obfuscate_function
+    from vm_compiler import VMUnsupported
+    for dispatch in DISPATCH:
+        random.seed(0)
+        func = CFFTransformer(1, dispatch).visit(ast.parse(SAMPLE)).body[0]
+        try:
+            vm = {}
+            exec(vm_obfuscate_function(ast.fix_missing_locations(func), 'f', vm_count=2), vm)
+        except VMUnsupported:
+            assert dispatch == 'table'
+            continue
+        assert dispatch != 'table' and vm['f'](7, 10) == ns['f'](7, 10), dispatch
+    print('all cff tests passed')
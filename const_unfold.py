@@ -1,20 +1,11 @@
 import ast
 import random
+from ast_stack import StackTransformer
 
 
-class ConstantUnfolder(ast.NodeTransformer):
+class ConstantUnfolder(StackTransformer):
     def __init__(self, probability=0.7):
         self.probability = probability
-        self._depth = 0
-
-    def visit(self, node):
-        self._depth += 1
-        if self._depth > 200:
-            self._depth -= 1
-            return node
-        result = super().visit(node)
-        self._depth -= 1
-        return result
 
     def visit_Constant(self, node):
         if (isinstance(node.value, int)
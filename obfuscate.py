@@ -1,122 +1,453 @@
 import ast
-import sys
+import io
+import time
 import random
-from strip import strip
-from opaque_mba import MBATransformer, OpaquePredicateTransformer
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from build_cache import OutputCache, source_hash
+from ast_stack import FlatTree, dump, fix_missing_locations, recursion_limit
+from strip import strip_tree
+from opaque_mba import MBATransformer, OpaquePredicateTransformer, MBA_MAX_NODES, MBA_MAX_GROWTH, count_ops
 from encode_types import get_type_annotation
-from string_encrypt import StringEncryptTransformer, get_string_decrypt_helper
+from string_encrypt import (StringEncryptTransformer, StringSlotTable, StringSlotTransformer,
+                            get_string_decrypt_helper, get_string_slot_helpers)
 from const_unfold import ConstantUnfolder
+from cff import CFFTransformer, CFF_BLOCK_SIZE
 from bytecode_obf import encrypt_function
 from vm_obf import vm_obfuscate_function
+from vm_optimize import IR_PASSES
+from tiering import TIERS, choose_tiers
 
-sys.setrecursionlimit(10000)
+# control-flow stages (opaque predicates, flattening) may add up to
+# (FLOW_MAX_GROWTH - 1) times a function's operations, counting at least
+# FLOW_MIN_OPS: flattening costs about the same for a tiny function
+FLOW_MAX_GROWTH = 6.0
+FLOW_MIN_OPS = 20
+# flattening over budget retries with blocks up to this large
+CFF_MAX_BLOCK = 32
 
-def _break_sharing(node):
-    if isinstance(node, ast.AST):
-        new = type(node)()
+def _copy_tree(node):
+    if not isinstance(node, ast.AST):
+        return node
+    root = type(node)()
+    # (original, its empty copy): fields are filled when the pair is popped
+    stack = [(node, root)]
+    while stack:
+        node, new = stack.pop()
         for field, value in ast.iter_fields(node):
             if isinstance(value, list):
-                setattr(new, field, [_break_sharing(item) for item in value])
+                items = []
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        copy = type(item)()
+                        stack.append((item, copy))
+                        item = copy
+                    items.append(item)
+                value = items
             elif isinstance(value, ast.AST):
-                setattr(new, field, _break_sharing(value))
-            else:
-                setattr(new, field, value)
+                copy = type(value)()
+                stack.append((value, copy))
+                value = copy
+            setattr(new, field, value)
         for attr in ('lineno', 'col_offset', 'end_lineno', 'end_col_offset'):
             if hasattr(node, attr):
                 setattr(new, attr, getattr(node, attr))
-        return new
-    return node
+    return root
 
 
-def obfuscate_function(fun_code):
-    tree = ast.parse(fun_code)
+def _break_sharing(tree):
+    # transformers reuse operand nodes: copy only subtrees reached twice.
+    # Slots (parent, field, index) are taken in pre-order, so the first
+    # occurrence is the one a recursive walk would keep
+    seen = set()
+    stack = [(tree, None, None)]
+    while stack:
+        parent, field, index = stack.pop()
+        if field is None:
+            node = parent
+        else:
+            value = getattr(parent, field)
+            node = value if index is None else value[index]
+            if id(node) in seen:
+                copy = _copy_tree(node)
+                if index is None:
+                    setattr(parent, field, copy)
+                else:
+                    value[index] = copy
+                continue
+            seen.add(id(node))
+        slots = []
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                slots.extend((node, name, i) for i, item in enumerate(value)
+                             if isinstance(item, ast.AST) and item._fields)
+            elif isinstance(value, ast.AST) and value._fields:
+                slots.append((node, name, None))
+        stack.extend(reversed(slots))
+    return tree
+
+
+@contextmanager
+def _stage(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def _source_segment(lines, node):
+    # ast.get_source_segment re-splits the whole file on every call
+    seg = lines[node.lineno - 1:node.end_lineno]
+    seg[-1] = seg[-1].encode()[:node.end_col_offset].decode()
+    seg[0] = seg[0].encode()[node.col_offset:].decode()
+    return ''.join(seg)
+
+
+def _sub_seed(seed, stage, name, source):
+    # per-function seed from (master seed, name, source): independent of
+    # which worker runs the function and of edits to other functions
+    return random.Random(f'{seed}/{stage}/{name}/{source_hash(source)}').getrandbits(64)
+
+
+def _run_jobs(fn, items, executor=None, jobs=1, cache=None, keys=None):
+    # jobs and results are pickled: AST nodes in them travel as FlatTree
+    results = [cache.get(k) for k in keys] if cache is not None else [None] * len(items)
+    todo = [i for i, r in enumerate(results) if r is None]
+    pending = [items[i] for i in todo]
+    if executor is None:
+        done = [fn(item) for item in pending]
+    else:
+        done = executor.map(fn, pending, chunksize=max(1, len(pending) // (jobs * 4)))
+    for i, r in zip(todo, done):
+        results[i] = r
+        if cache is not None:
+            cache.put(keys[i], r)
+    return results
+
+
+def obfuscate_function(fun_code, string_table=None, string_slots=None):
+    tree = _transform_function(fun_code, encrypt_strings=string_table is None)
+    # slot indices are plain constants, so slot after unfolding
+    if string_table is not None:
+        tree = StringSlotTransformer(string_table, string_slots).visit(tree)
+
+    fix_missing_locations(tree)
+    with recursion_limit():
+        return ast.unparse(tree).strip()
+
+
+def _obfuscate_function_job(job):
+    func_def, seed, encrypt_strings, mba, unfold, mba_options, flow_options = job
+    random.seed(seed)
+    stage_ops = []
+    func = _transform_function(func_def.node, encrypt_strings, mba, unfold, mba_options, flow_options,
+                               stage_ops).body[0]
+    return FlatTree(func), stage_ops
+
+
+def _transform_function(fun_code, encrypt_strings=True, mba=1.0, unfold=0.6, mba_options=None,
+                        flow_options=None, stage_ops=None):
+    # accepts source text or an already parsed FunctionDef; `mba` and
+    # `unfold` are the share of integer operations and constants rewritten,
+    # mba=0 skips MBA, the transform that costs most at run time.
+    # `mba_options` are MBATransformer budgets (max_nodes, max_growth, temps)
+    # and `flow_options` turn on the control-flow stages (see _flow_transform).
+    # Pass a list as `stage_ops` to collect (stage, operations after it).
+    if isinstance(fun_code, str):
+        with recursion_limit():
+            tree = ast.parse(fun_code)
+    else:
+        tree = ast.Module(body=[fun_code], type_ignores=[])
     func_def = tree.body[0]
     param_names = [arg.arg for arg in func_def.args.args]
     param_types = {arg.arg: get_type_annotation(arg.annotation) for arg in func_def.args.args if arg.annotation}
+    if stage_ops is None:
+        stage_ops = []
+    stage_ops.append(('source', count_ops(tree)))
 
-    tree = StringEncryptTransformer().visit(tree)
+    if encrypt_strings:
+        tree = StringEncryptTransformer().visit(tree)
 
-    tree = MBATransformer(param_names, param_types).visit(tree)
-    tree = _break_sharing(tree)
-    tree = MBATransformer(param_names, param_types).visit(tree)
-    tree = _break_sharing(tree)
-    unfolder = ConstantUnfolder(probability=0.6)
+    if flow_options:
+        ints = [name for name, kind in param_types.items() if kind == 'int']
+        tree = _flow_transform(tree, ints, stage_ops[0][1], stage_ops, **flow_options)
+
+    if mba > 0:
+        # both passes draw on one op budget
+        transformer = MBATransformer(param_names, param_types, probability=mba, **(mba_options or {}))
+        tree = transformer.visit(tree)
+        tree = _break_sharing(tree)
+        tree = transformer.visit(tree)
+        tree = _break_sharing(tree)
+        stage_ops.append(('mba', count_ops(tree)))
+    unfolder = ConstantUnfolder(probability=unfold)
     tree = unfolder.visit(tree)
+    stage_ops.append(('unfold', count_ops(tree)))
+    return _break_sharing(tree)
+
+
+def _flow_transform(tree, int_params, ops, stage_ops, opaque=False, cff=False, block_size=CFF_BLOCK_SIZE,
+                    max_growth=FLOW_MAX_GROWTH, dispatch='auto'):
+    # one op budget per function for both stages. Flattening is the stronger
+    # of the two, so opaque predicates get at most half of it when both run;
+    # flattening then takes the rest, with larger blocks when it does not fit.
+    # `dispatch` is the CFFTransformer style: 'chain' for VM-tier functions,
+    # the VM cannot compile the closures of table dispatch
+    budget = max(ops, FLOW_MIN_OPS) * (max_growth - 1)
+    start = count_ops(tree)
+    if opaque:
+        predicates = OpaquePredicateTransformer(int_params, anchor_value=random.randint(1, 0xFFFFFF),
+                                                op_budget=budget / 2 if cff else budget)
+        tree = predicates.visit(tree)
+        stage_ops.append(('opaque', count_ops(tree)))
+    if cff:
+        budget -= count_ops(tree) - start
+        before = count_ops(tree)
+        sizes = [block_size]
+        while sizes[-1] < CFF_MAX_BLOCK:
+            sizes.append(sizes[-1] * 2)
+        for size in sizes:
+            with recursion_limit():
+                flat = CFFTransformer(size, dispatch).visit(_copy_tree(tree))
+            if count_ops(flat) - before <= budget:
+                tree = flat
+                break
+        stage_ops.append(('cff', count_ops(tree)))
+    return tree
+
+
+def _encrypt_function_job(job):
+    func_def, name, seed, uid, use_vm, tier, vm_options = job
+    # unparse and compile recurse once per nesting level
+    with recursion_limit():
+        return _encrypt_function(func_def.node, name, seed, uid, use_vm, tier, vm_options)
+
+
+def _encrypt_function(func_def, name, seed, uid, use_vm, tier, vm_options):
+    # (source, None), or (source, why) when the function got less than its
+    # tier: the VM could not build it, or neither could the JIT
+    random.seed(seed)
+    if tier == 'light':
+        return ast.unparse(func_def), None
+    # VM compile, fallback to JIT
+    fallback = None
+    if use_vm and tier == 'vm':
+        try:
+            vm_src = vm_obfuscate_function(func_def, name, uid=uid, **vm_options)
+            if vm_src:
+                return vm_src, None
+            fallback = 'jit: no VM code'
+        except Exception as e:
+            fallback = f"jit: {type(e).__name__}: {e}"
+    try:
+        return encrypt_function(func_def, name), fallback
+    except (SyntaxError, ValueError) as e:
+        return ast.unparse(func_def), f"light: {type(e).__name__}: {e}"
+
 
-    ast.fix_missing_locations(tree)
-    return ast.unparse(tree).strip()
+def _function_level(tier, level, vm_count):
+    # a budget level (budget.LEVELS) can only lower what the profile tier
+    # left; light code skips MBA unless the level asks for it
+    if TIERS.index(level.get('tier', 'vm')) > TIERS.index(tier):
+        tier = level['tier']
+    vm_options = {}
+    if 'vm_count' in level:
+        vm_options['vm_count'] = min(vm_count or level['vm_count'], level['vm_count'])
+    if 'padding' in level:
+        vm_options['padding'] = level['padding']
+    mba = level.get('mba', 0.0 if tier == 'light' else 1.0)
+    return tier, mba, level.get('unfold', 0.6), level.get('strings', True), vm_options
 
 
-def _encrypt_all_functions(source, vm_func_count=0, vm_count=0):
-    tree = ast.parse(source)
+def _encrypt_all_functions(tree, vm_func_count=0, vm_count=0, code_cache=False, cache_recheck=0,
+                           dispatch=None, compound_slots=8, ir_passes=IR_PASSES, seed=None, executor=None,
+                           jobs=1, cache=None, tiers=None, node_options=None, vm_profile=False,
+                           fallbacks=None):
+    # pass a dict as `fallbacks` to collect {node: why} for the functions
+    # built below their tier (_encrypt_function)
+    if seed is None:
+        seed = random.getrandbits(64)
     parts = []
+    jobs_in = []
+    keys = []
+    vm_options = dict(vm_count=vm_count, code_cache=code_cache, cache_recheck=cache_recheck,
+                      dispatch=dispatch, compound_slots=compound_slots, ir_passes=tuple(ir_passes))
+    if vm_profile:
+        # only set when on, so cache keys of plain builds stay as they were
+        vm_options['instrument'] = True
 
+    used_uids = set()
     for node in tree.body:
         if isinstance(node, ast.FunctionDef):
-            func_src = ast.unparse(node)
-            # VM compile, fallback to JIT
-            if vm_func_count > 0:
-                try:
-                    vm_src = vm_obfuscate_function(func_src, node.name, vm_count=vm_count)
-                    if vm_src:
-                        parts.append(vm_src)
-                        continue
-                except Exception:
-                    pass
-            try:
-                parts.append(encrypt_function(func_src, node.name))
-            except SyntaxError:
-                parts.append(func_src)
+            # position-free dump: moving a function does not change its seed
+            func_src = dump(node)
+            fseed = _sub_seed(seed, 'encrypt', node.name, func_src)
+            # module-level helper names embed the uid, keep them unique
+            uid = 1000 + fseed % 9000
+            while uid in used_uids:
+                uid = 1000 + (uid - 999) % 9000
+            used_uids.add(uid)
+            tier = (tiers or {}).get(node, 'vm')
+            options = dict(vm_options, **(node_options or {}).get(node, {}))
+            jobs_in.append((FlatTree(node), node.name, fseed, uid, vm_func_count > 0, tier, options))
+            if cache is not None:
+                keys.append(cache.key('encrypt', func_src, (node.name, fseed, uid, vm_func_count > 0, tier,
+                                                            sorted(options.items()))))
+            parts.append(None)
         else:
-            parts.append(ast.unparse(node))
-    return '\n'.join(parts)
+            with recursion_limit():
+                parts.append(ast.unparse(node))
 
+    done = _run_jobs(_encrypt_function_job, jobs_in, executor, jobs, cache, keys)
+    if fallbacks is not None:
+        fallbacks.update((job[0].node, why) for job, (_, why) in zip(jobs_in, done) if why)
+    done = iter(src for src, _ in done)
+    return '\n'.join(next(done) if part is None else part for part in parts)
 
-def obfuscate(filename, functions_to_obfuscate=[], vm_count=0):
+
+def obfuscate(filename, functions_to_obfuscate=[], vm_count=0, code_cache=False, cache_recheck=0,
+              dispatch=None, string_slots=None, jobs=1, seed=None, cache_dir=None, shared=None, module=None,
+              timings=None, compound_slots=8, ir_passes=IR_PASSES, profile=None, tiers=None,
+              levels=None, names=None, vm_profile=False, mba_max_nodes=MBA_MAX_NODES,
+              mba_max_growth=MBA_MAX_GROWTH, mba_temps=False, op_growth=None, opaque=False, cff=False,
+              cff_block=CFF_BLOCK_SIZE, flow_max_growth=FLOW_MAX_GROWTH, stage_ops=None, fallbacks=None):
+    # the module is parsed once; every stage hands AST nodes to the next and
+    # text is only produced for the final output. Pass a dict as `timings`
+    # to collect seconds per stage. With a `profile` (tiering.load_profile),
+    # hot functions get lighter protection (tiering.choose_tiers); pass a
+    # dict as `tiers` to collect the tier of each function. `levels` maps
+    # function names to a level dict like the budget.LEVELS entries (tier,
+    # vm_count, padding, mba, unfold, strings) that lowers their protection
+    # further. Pass a dict as `names` to collect the stripped name of each
+    # obfuscated function. `vm_profile` builds VMs with the execution
+    # profiler (vm_obf._emit_profiler). The mba_* options bound MBA growth
+    # (opaque_mba.MBATransformer); pass a dict as `op_growth` to collect
+    # (ops before, ops after) the AST transforms for each function.
+    # `opaque` and `cff` add opaque predicates and control-flow flattening
+    # (in blocks of `cff_block` statements) within an op budget of
+    # `flow_max_growth` per function; pass a dict as `stage_ops` to collect
+    # [(stage, ops after it), ...] for each function. Pass a dict as
+    # `fallbacks` to collect, for each function built with less protection
+    # than its tier (the VM could not compile it), the tier it got and why.
     with open(filename, 'r') as f:
         code = f.read()
 
     extracted = 0
     functions = []
     function_codes = []
-    try:
-        tree = ast.parse(code)
-    except SyntaxError as e:
-        raise ValueError(f"Invalid Python code: {e}")
+    function_nodes = []
+    with _stage(timings, 'parse'):
+        try:
+            with recursion_limit():
+                tree = ast.parse(code)
+        except SyntaxError as e:
+            raise ValueError(f"Invalid Python code: {e}")
 
-    if not functions_to_obfuscate:
-        functions_to_obfuscate = [
-            node.name for node in tree.body if isinstance(node, ast.FunctionDef)]
+        if not functions_to_obfuscate:
+            functions_to_obfuscate = [
+                node.name for node in tree.body if isinstance(node, ast.FunctionDef)]
 
-    nodes_to_remove = []
-    for node in tree.body:
-        if isinstance(node, ast.FunctionDef) and node.name in functions_to_obfuscate:
-            func_code = ast.get_source_segment(code, node)
-            function_codes.append(func_code)
-            functions.append(node.name)
-            nodes_to_remove.append(node)
-            extracted += 1
+        lines = io.StringIO(code, newline='').readlines()
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef) and node.name in functions_to_obfuscate:
+                # the source text only feeds seeds and cache keys
+                function_codes.append(_source_segment(lines, node))
+                function_nodes.append(node)
+                functions.append(node.name)
+                extracted += 1
 
-    for node in nodes_to_remove:
-        tree.body.remove(node)
+        for node in function_nodes:
+            tree.body.remove(node)
 
     if extracted < len(functions_to_obfuscate):
         raise ValueError(f"Some functions were not found: {set(functions_to_obfuscate) - set(functions)}")
 
-    tree.body.insert(0, get_string_decrypt_helper())
+    chosen = choose_tiers(profile, filename, functions) if profile else {}
+    if tiers is not None:
+        tiers.update(chosen)
+    settings = [_function_level(chosen.get(name, 'vm'), (levels or {}).get(name, {}), vm_count)
+                for name in functions]
+
+    string_table = StringSlotTable() if string_slots else None
+    if string_table is None:
+        tree.body.insert(0, get_string_decrypt_helper())
 
-    insert_pos = 0
+    # after the helper: unparsed (light) functions call it in their defaults
+    insert_pos = 1 if string_table is None else 0
     for idx, node in enumerate(tree.body):
         if isinstance(node, (ast.Import, ast.ImportFrom)):
             insert_pos = idx + 1
 
-    for i, func_code in enumerate(function_codes):
-        func = obfuscate_function(func_code)
-        func_ast = ast.parse(func)
-        tree.body.insert(insert_pos, func_ast.body[0])
-        insert_pos += 1
+    if seed is None:
+        seed = random.getrandbits(64)
+    seeds = [_sub_seed(seed, 'transform', name, func_code)
+             for name, func_code in zip(functions, function_codes)]
+    cache = OutputCache(cache_dir) if cache_dir else None
+    encrypt_strings = string_table is None
+    mba_options = dict(max_nodes=mba_max_nodes, max_growth=mba_max_growth, temps=mba_temps)
+    # VM-tier functions are flattened with chain dispatch, the VM compiles no closures
+    flow_options = [dict(opaque=opaque, cff=cff, block_size=cff_block, max_growth=flow_max_growth,
+                         dispatch='chain' if tier == 'vm' else 'auto') if opaque or cff else None
+                    for tier, _, _, _, _ in settings]
+    keys = [cache.key('transform', func_code, (fseed, encrypt_strings and strings, mba, unfold,
+                                               sorted(mba_options.items()),
+                                               sorted((flow or {}).items())))
+            for func_code, fseed, (_, mba, unfold, strings, _), flow
+            in zip(function_codes, seeds, settings, flow_options)] if cache else None
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        with _stage(timings, 'transform'):
+            funcs = _run_jobs(_obfuscate_function_job,
+                              [(FlatTree(func_def), fseed, encrypt_strings and strings, mba, unfold, mba_options,
+                                flow)
+                               for func_def, fseed, (_, mba, unfold, strings, _), flow
+                               in zip(function_nodes, seeds, settings, flow_options)],
+                              executor, jobs, cache, keys)
+        funcs, ops = zip(*funcs) if funcs else ((), ())
+        funcs = [func.node for func in funcs]
+        if op_growth is not None:
+            op_growth.update((name, (counts[0][1], counts[-1][1])) for name, counts in zip(functions, ops))
+        if stage_ops is not None:
+            stage_ops.update(zip(functions, ops))
+
+        # strip renames functions: the encrypt stage finds tiers by node
+        node_tiers = {}
+        node_options = {}
+        with _stage(timings, 'strings'):
+            for func, fseed, name, (tier, _, _, strings, options) in zip(funcs, seeds, functions, settings):
+                if string_table is not None and strings:
+                    # slots are numbered module-wide, so this stays in order here
+                    random.seed(fseed)
+                    func = StringSlotTransformer(string_table, string_slots).visit(func)
+                node_tiers[func] = tier
+                node_options[func] = options
+                tree.body.insert(insert_pos, func)
+                insert_pos += 1
+
+            if string_table is not None and string_table.slots:
+                tree.body[0:0] = get_string_slot_helpers(string_table, string_slots)
 
-    code = ast.unparse(tree)
-    stripped = strip(code)
+        with _stage(timings, 'strip'):
+            tree = strip_tree(tree, shared, module)
+        if names is not None:
+            names.update((name, func.name) for name, func in zip(functions, node_tiers))
 
-    return _encrypt_all_functions(stripped, vm_func_count=len(function_codes), vm_count=vm_count)
+        downgraded = {}
+        with _stage(timings, 'encrypt'):
+            output = _encrypt_all_functions(tree, vm_func_count=len(function_codes), vm_count=vm_count,
+                                            code_cache=code_cache, cache_recheck=cache_recheck,
+                                            dispatch=dispatch, compound_slots=compound_slots,
+                                            ir_passes=ir_passes, seed=seed,
+                                            executor=executor, jobs=jobs, cache=cache, tiers=node_tiers,
+                                            node_options=node_options, vm_profile=vm_profile,
+                                            fallbacks=downgraded)
+        if fallbacks is not None:
+            fallbacks.update((name, downgraded[func]) for name, func in zip(functions, node_tiers)
+                             if func in downgraded)
+        return output
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -1,5 +1,6 @@
 import ast
 import random
+from ast_stack import StackTransformer
 
 
 def _identity_wrap(expr):
@@ -23,11 +24,30 @@ def _maybe_commute(left, op, right):
     return ast.BinOp(left=left, op=op, right=right)
 
 
-class OpaquePredicateTransformer(ast.NodeTransformer):
-    def __init__(self, int_param_names, anchor_name='_anc', anchor_value=42):
+# opaque predicates nest at most this many boolean levels
+OPAQUE_MAX_DEPTH = 2
+
+
+class OpaquePredicateTransformer(StackTransformer):
+    """Wrap ifs and returns of a function in always-true predicates with junk else branches.
+
+    The function starts by setting the anchor variable. Predicates that only
+    read the anchor do not change while the function runs, so inside loops
+    they are evaluated once at entry into a temporary instead. `op_budget`
+    caps the operations added (count_ops), predicates and junk together;
+    wrapping stops once it is spent and the rest stays as it was.
+    """
+
+    def __init__(self, int_param_names, anchor_name='_anc', anchor_value=42,
+                 max_depth=OPAQUE_MAX_DEPTH, op_budget=None):
         self.anchor_name = anchor_name
         self.anchor_value = anchor_value
         self.int_vars = [anchor_name] + list(int_param_names)
+        self.max_depth = max_depth
+        self.op_budget = op_budget
+        self._loops = 0
+        self._hoisted = []
+        self._in_function = False
 
     def _var(self, name=None):
         name = name or random.choice(self.int_vars)
@@ -112,7 +132,7 @@ class OpaquePredicateTransformer(ast.NodeTransformer):
         ]
         return random.choice(conditions)
 
-    def generate_opaque_true(self, depth=0, max_depth=5):
+    def generate_opaque_true(self, depth=0, max_depth=OPAQUE_MAX_DEPTH):
         if depth >= max_depth or random.random() < 0.3:
             return self.generate_single_condition()
         op = random.choice([ast.And(), ast.Or()])
@@ -145,58 +165,285 @@ class OpaquePredicateTransformer(ast.NodeTransformer):
                                 orelse=self.generate_junk_code(max_depth - 1)))
         return stmts
 
+    def visit_FunctionDef(self, node):
+        if self._in_function:
+            # nested scopes may rebind the parameters
+            return node
+        self._in_function = True
+        # parameters the body reassigns may stop being ints
+        assigned = {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+        self.int_vars = [v for v in self.int_vars if v == self.anchor_name or v not in assigned]
+        body = []
+        for stmt in node.body:
+            body.append((yield stmt))
+        node.body = body
+        anchor = ast.Assign(targets=[ast.Name(id=self.anchor_name, ctx=ast.Store())],
+                            value=ast.Constant(value=self.anchor_value))
+        node.body = [anchor] + self._hoisted + node.body
+        return node
+
+    def visit_AsyncFunctionDef(self, node):
+        return node
+
+    def visit_Lambda(self, node):
+        return node
+
+    def visit_ClassDef(self, node):
+        return node
+
+    def _visit_loop(self, node):
+        self._loops += 1
+        try:
+            return (yield from self.generic_visit(node))
+        finally:
+            self._loops -= 1
+
+    visit_For = visit_While = _visit_loop
+
+    def _wrap(self, node):
+        cond = self.generate_opaque_true(max_depth=self.max_depth)
+        junk = self.generate_junk_code(max_depth=2)
+        if self.op_budget is not None:
+            cost = count_ops(cond) + sum(count_ops(stmt) for stmt in junk)
+            if cost > self.op_budget:
+                return node
+            self.op_budget -= cost
+        if self._loops and all(n.id == self.anchor_name for n in ast.walk(cond) if isinstance(n, ast.Name)):
+            temp = f'_op{len(self._hoisted)}'
+            self._hoisted.append(ast.Assign(targets=[ast.Name(id=temp, ctx=ast.Store())], value=cond))
+            cond = ast.Name(id=temp, ctx=ast.Load())
+        return ast.If(test=cond, body=[node], orelse=junk)
+
     def visit_If(self, node):
         # Preserve original condition — wrap entire if in opaque predicate instead
-        node.body = [self.visit(n) for n in node.body]
-        node.orelse = [self.visit(n) for n in node.orelse] if node.orelse else []
-        cond = self.generate_opaque_true(max_depth=5)
-        junk = self.generate_junk_code(max_depth=3)
-        return ast.If(test=cond, body=[node], orelse=junk)
+        body = []
+        for stmt in node.body:
+            body.append((yield stmt))
+        orelse = []
+        for stmt in node.orelse or ():
+            orelse.append((yield stmt))
+        node.body = body
+        node.orelse = orelse
+        return self._wrap(node)
 
     def visit_Return(self, node):
-        cond = self.generate_opaque_true(max_depth=5)
-        junk = self.generate_junk_code(max_depth=3)
-        return ast.If(test=cond, body=[node], orelse=junk)
+        return self._wrap(node)
+
 
+# budgets: rewrites stop growing a statement's expression past MBA_MAX_NODES
+# nodes, and a function may end up with at most MBA_MAX_GROWTH times the
+# operations it started with
+MBA_MAX_NODES = 150
+MBA_MAX_GROWTH = 8.0
+_OPS = (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare)
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
 
-class MBATransformer(ast.NodeTransformer):
-    def __init__(self, param_names, param_types, known_int_vars=None):
+
+def count_ops(node):
+    """Operations (arithmetic, boolean, comparisons) in the tree under `node`."""
+    return sum(isinstance(n, _OPS) for n in ast.walk(node))
+
+
+class MBATransformer(StackTransformer):
+    """Rewrite integer operations as mixed boolean-arithmetic expressions.
+
+    One instance can run several passes over the same function: the op
+    budget is set on the first pass from the function's own op count and
+    shared by the rest. With `temps`, an operand the rewrite repeats that is
+    more than a name or constant is evaluated once into a `_mt` temporary
+    (walrus), except inside comprehensions.
+    """
+
+    def __init__(self, param_names, param_types, known_int_vars=None, probability=1.0,
+                 max_nodes=MBA_MAX_NODES, max_growth=MBA_MAX_GROWTH, temps=False):
         self.param_names = [n for n in param_names if param_types.get(n) == 'int']
         self.param_types = param_types
+        # share of integer operations rewritten
+        self.probability = probability
         self.known_int_vars = known_int_vars or set()
+        self.max_nodes = max_nodes
+        self.max_growth = max_growth
+        self.temps = temps
+        self.op_budget = None
+        self._n_temps = 0
+        self._in_comprehension = 0
+        # per-node facts, rebuilt every pass since visiting edits nodes in place
+        self._int = {}
+        self._size = {}
+        # expression node -> the statement-level expression it belongs to,
+        # and the nodes that expression may still grow by
+        self._root = {}
+        self._room = {}
+
+    def visit_Module(self, node):
+        self._int.clear()
+        self._size.clear()
+        self._root.clear()
+        self._room.clear()
+        if self.op_budget is None:
+            self.op_budget = count_ops(node) * (self.max_growth - 1)
+        for stmt in ast.walk(node):
+            if isinstance(stmt, ast.stmt):
+                for expr in ast.iter_child_nodes(stmt):
+                    if isinstance(expr, ast.expr):
+                        sub = [n for n in ast.walk(expr) if isinstance(n, ast.expr)]
+                        self._room[expr] = max(self.max_nodes - len(sub), 0)
+                        self._root.update(dict.fromkeys(sub, expr))
+        return (yield from self.generic_visit(node))
+
+    def _visit_comprehension(self, node):
+        self._in_comprehension += 1
+        try:
+            return (yield from self.generic_visit(node))
+        finally:
+            self._in_comprehension -= 1
 
-    def is_integer_expr(self, node, depth=0):
-        if depth > 15:
-            return False
-        if isinstance(node, ast.Name):
-            return self.param_types.get(node.id) == 'int' or node.id in self.known_int_vars
-        if isinstance(node, ast.Constant) and isinstance(node.value, int) and not isinstance(node.value, bool):
-            return True
-        if isinstance(node, ast.BinOp):
-            return (self.is_integer_expr(node.left, depth + 1)
-                    and self.is_integer_expr(node.right, depth + 1))
-        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Invert, ast.USub, ast.UAdd)):
-            return self.is_integer_expr(node.operand, depth + 1)
-        return False
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+    def is_integer_expr(self, node):
+        # post-order on a stack: a node is decided once its operands are,
+        # stopping at the first operand that is not an integer
+        known = self._int.get(node)
+        if known is not None:
+            return known
+        stack = [node]
+        while stack:
+            top = stack[-1]
+            if isinstance(top, ast.BinOp):
+                operands = (top.left, top.right)
+            elif isinstance(top, ast.UnaryOp) and isinstance(top.op, (ast.Invert, ast.USub, ast.UAdd)):
+                operands = (top.operand,)
+            elif isinstance(top, ast.NamedExpr):
+                operands = (top.value,)
+            elif isinstance(top, ast.Name):
+                operands = ()
+                known = self.param_types.get(top.id) == 'int' or top.id in self.known_int_vars
+            elif isinstance(top, ast.Constant):
+                operands = ()
+                known = isinstance(top.value, int) and not isinstance(top.value, bool)
+            else:
+                operands = ()
+                known = False
+            pending = None
+            if operands:
+                known = True
+                for operand in operands:
+                    value = self._int.get(operand)
+                    if value is None:
+                        pending = operand
+                        break
+                    if not value:
+                        known = False
+                        break
+            if pending is not None:
+                stack.append(pending)
+                continue
+            stack.pop()
+            self._int[top] = known
+        return self._int[node]
+
+    def _measure(self, node, sizes=None):
+        # (expression nodes, operations) under node; a node on the stack is
+        # summed once none of its children are left to measure. New entries
+        # go to `sizes` when given, else to the memo
+        if sizes is None:
+            sizes = self._size
+        known = self._size.get(node) or sizes.get(node)
+        if known is not None:
+            return known
+        stack = [node]
+        while stack:
+            top = stack[-1]
+            nodes, ops = 1, int(isinstance(top, _OPS))
+            pending = False
+            for child in ast.iter_child_nodes(top):
+                if isinstance(child, ast.expr):
+                    size = self._size.get(child) or sizes.get(child)
+                    if size is None:
+                        stack.append(child)
+                        pending = True
+                    else:
+                        nodes += size[0]
+                        ops += size[1]
+            if not pending:
+                stack.pop()
+                sizes[top] = (nodes, ops)
+        return sizes[node]
 
     def visit_BinOp(self, node):
-        left = self.visit(node.left)
-        right = self.visit(node.right)
+        left = yield node.left
+        right = yield node.right
         is_int = self.is_integer_expr(node.left) and self.is_integer_expr(node.right)
+        plain = ast.BinOp(left=left, op=node.op, right=right)
+        # the parent asks about this node, not its replacement
+        self._int[node] = self._int[plain] = is_int
 
-        if is_int:
+        if is_int and (self.probability >= 1 or random.random() < self.probability):
+            rewritten = None
             if isinstance(node.op, ast.Add):
-                return _identity_wrap(mba_add(left, right))
+                rewritten = _identity_wrap(mba_add(left, right))
             elif isinstance(node.op, ast.Sub):
-                return _identity_wrap(mba_sub(left, right))
+                rewritten = _identity_wrap(mba_sub(left, right))
             elif isinstance(node.op, ast.BitXor) and random.random() < 0.5:
-                return _identity_wrap(mba_xor(left, right))
+                rewritten = _identity_wrap(mba_xor(left, right))
             elif isinstance(node.op, ast.BitAnd) and random.random() < 0.5:
-                return _identity_wrap(mba_and(left, right))
+                rewritten = _identity_wrap(mba_and(left, right))
             elif isinstance(node.op, ast.BitOr) and random.random() < 0.5:
-                return _identity_wrap(mba_or(left, right))
+                rewritten = _identity_wrap(mba_or(left, right))
+            if rewritten is not None:
+                if self.temps and not self._in_comprehension:
+                    rewritten = self._bind_operands(rewritten, (left, right))
+                # rejected rewrites are dropped, so their sizes stay out of the memo
+                fresh = {}
+                nodes, ops = self._measure(rewritten, fresh)
+                plain_nodes, plain_ops = self._measure(plain)
+                root = self._root.get(node)
+                room = self._room.get(root, self.max_nodes)
+                if nodes - plain_nodes <= room and ops - plain_ops <= self.op_budget:
+                    self.op_budget -= ops - plain_ops
+                    if root is not None:
+                        self._room[root] = room - (nodes - plain_nodes)
+                    self._size.update(fresh)
+                    self._int[rewritten] = True
+                    return rewritten
+
+        return plain
+
+    def _bind_operands(self, expr, operands):
+        # rewrites reuse the operand nodes themselves: the first use in
+        # evaluation order stores into a temporary, later ones read it
+        uses = {}
+
+        def count(node):
+            if any(node is operand for operand in operands):
+                if not isinstance(node, (ast.Name, ast.Constant)):
+                    uses[id(node)] = uses.get(id(node), 0) + 1
+            elif isinstance(node, ast.BinOp):
+                count(node.left)
+                count(node.right)
+            elif isinstance(node, ast.UnaryOp):
+                count(node.operand)
+
+        count(expr)
+        names = {}
+
+        def bind(node):
+            if any(node is operand for operand in operands):
+                if uses.get(id(node), 0) < 2:
+                    return node
+                if id(node) in names:
+                    return ast.Name(id=names[id(node)], ctx=ast.Load())
+                names[id(node)] = name = f'_mt{self._n_temps}'
+                self._n_temps += 1
+                return ast.NamedExpr(target=ast.Name(id=name, ctx=ast.Store()), value=node)
+            if isinstance(node, ast.BinOp):
+                node.left = bind(node.left)
+                node.right = bind(node.right)
+            elif isinstance(node, ast.UnaryOp):
+                node.operand = bind(node.operand)
+            return node
 
-        return ast.BinOp(left=left, op=node.op, right=right)
+        return bind(expr) if uses else expr
 
 
 def mba_add(left, right):
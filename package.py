@@ -0,0 +1,126 @@
+import os
+import ast
+import time
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from obfuscate import obfuscate
+from ast_stack import recursion_limit
+from strip import SharedRenames, collect_global_variables
+
+
+def find_modules(root):
+    """Map dotted module names to the .py files under `root`."""
+    root = os.path.abspath(root)
+    prefix = [os.path.basename(root)] if os.path.isfile(os.path.join(root, '__init__.py')) else []
+    modules = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, root)
+        parts = prefix + ([] if rel == '.' else rel.split(os.sep))
+        for name in sorted(filenames):
+            if not name.endswith('.py'):
+                continue
+            if name == '__init__.py':
+                modules['.'.join(parts)] = os.path.join(dirpath, name)
+            else:
+                modules['.'.join(parts + [name[:-3]])] = os.path.join(dirpath, name)
+    return modules
+
+
+def shared_renames(modules):
+    """Collect the names modules import from each other into one rename map."""
+    packages = {m for m, path in modules.items() if os.path.basename(path) == '__init__.py'}
+    trees = {}
+    for module, path in modules.items():
+        with open(path, 'r') as f, recursion_limit():
+            trees[module] = ast.parse(f.read())
+    shared = SharedRenames(modules, packages, ())
+    names = set()
+    star = {}
+    for module, tree in trees.items():
+        aliases = shared.aliases(tree, module)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom):
+                base = shared.target(module, node)
+                if base not in modules:
+                    continue
+                for name in node.names:
+                    if name.name == '*':
+                        star[base] = collect_global_variables(trees[base])
+                        names |= star[base]
+                    elif f"{base}.{name.name}" not in modules:
+                        names.add(name.name)
+            elif isinstance(node, ast.Attribute) and shared.attribute_module(node, aliases):
+                names.add(node.attr)
+    return SharedRenames(modules, packages, names, star)
+
+
+def _write_atomic(path, code):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(code)
+    os.replace(tmp, path)
+
+
+def _obfuscate_module_job(job):
+    path, module, shared, options = job
+    start = time.perf_counter()
+    fallbacks = {}
+    code = obfuscate(path, shared=shared, module=module, fallbacks=fallbacks, **options)
+    return code, time.perf_counter() - start, fallbacks
+
+
+def obfuscate_package(src_dir, out_dir, jobs=1, seed=None, report=print, **options):
+    """Obfuscate every module under `src_dir` into `out_dir`.
+
+    Names one module imports from another get the same mask everywhere.
+    Files go through one pool of `jobs` workers, with at most 2 * jobs in
+    flight; non-Python files are copied. Functions built below their tier
+    are reported under their file. Returns {relative path: seconds}.
+    """
+    modules = find_modules(src_dir)
+    shared = shared_renames(modules)
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    def job(module):
+        fseed = random.Random(f'{seed}/module/{module}').getrandbits(64)
+        return modules[module], module, shared, dict(options, seed=fseed)
+
+    def finish(module, result):
+        code, elapsed, fallbacks = result
+        rel = os.path.relpath(modules[module], src_dir)
+        _write_atomic(os.path.join(out_dir, rel), code)
+        timings[rel] = elapsed
+        report(f"{elapsed * 1000:9.1f}ms  {rel}")
+        for name, why in fallbacks.items():
+            report(f"{'':13}{name} fell back to {why}")
+
+    timings = {}
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if not name.endswith('.py'):
+                dest = os.path.join(out_dir, os.path.relpath(os.path.join(dirpath, name), src_dir))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(os.path.join(dirpath, name), dest)
+
+    if jobs <= 1:
+        for module in modules:
+            finish(module, _obfuscate_module_job(job(module)))
+        return timings
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+        queue = iter(modules)
+        for module in queue:
+            pending[executor.submit(_obfuscate_module_job, job(module))] = module
+            while len(pending) >= 2 * jobs:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(pending.pop(future), future.result())
+        for future in list(pending):
+            finish(pending.pop(future), future.result())
+    return timings
@@ -1,10 +1,14 @@
 import ast
 import random
+from ast_stack import StackTransformer
 
 DECRYPT_FUNC = '_sd'
+SLOT_TABLE = '_ss'
+SLOT_LOAD = '_sl'
+SLOT_MODES = ['lazy', 'eager']
 
 
-class StringEncryptTransformer(ast.NodeTransformer):
+class StringEncryptTransformer(StackTransformer):
     def __init__(self):
         self.has_strings = False
         self._in_fstring = False
@@ -12,7 +16,7 @@ class StringEncryptTransformer(ast.NodeTransformer):
     def visit_JoinedStr(self, node):
         old = self._in_fstring
         self._in_fstring = True
-        self.generic_visit(node)
+        yield from self.generic_visit(node)
         self._in_fstring = old
         return node
 
@@ -58,3 +62,81 @@ class StringEncryptTransformer(ast.NodeTransformer):
 def get_string_decrypt_helper():
     code = f"def {DECRYPT_FUNC}(d, k):\n    return bytes([a ^ b for a, b in zip(d, k)])"
     return ast.parse(code).body[0]
+
+
+class StringSlotTable:
+    """Module-wide table of encrypted literals, one slot per literal."""
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.key = bytearray()
+        self.slots = []  # (offset, length, is_str)
+
+    def add(self, data, is_str):
+        key = bytes([random.randint(1, 255) for _ in range(len(data))])
+        self.slots.append((len(self.blob), len(data), is_str))
+        self.blob.extend(d ^ k for d, k in zip(data, key))
+        self.key.extend(key)
+        return len(self.slots) - 1
+
+
+class StringSlotTransformer(StringEncryptTransformer):
+    """Replace literals with a slot read that decrypts on first access.
+
+    lazy:  (_ss[i] or _sl(i))  -- _sl decrypts slot i and stores it
+    eager: _ss[i]              -- every slot is decrypted at import
+    Only non-empty literals are slotted, so a filled slot is always truthy.
+    """
+
+    def __init__(self, table, mode='lazy'):
+        super().__init__()
+        self.table = table
+        self.mode = mode
+
+    def _slot(self, data, is_str):
+        idx = self.table.add(data, is_str)
+        load = ast.Subscript(
+            value=ast.Name(id=SLOT_TABLE, ctx=ast.Load()),
+            slice=ast.Constant(value=idx),
+            ctx=ast.Load()
+        )
+        if self.mode == 'eager':
+            return load
+        return ast.BoolOp(
+            op=ast.Or(),
+            values=[load, ast.Call(
+                func=ast.Name(id=SLOT_LOAD, ctx=ast.Load()),
+                args=[ast.Constant(value=idx)],
+                keywords=[]
+            )]
+        )
+
+    def _encrypt_string(self, s):
+        return self._slot(s.encode('utf-8'), True)
+
+    def _encrypt_bytes(self, b):
+        return self._slot(b, False)
+
+
+def get_string_slot_helpers(table, mode='lazy'):
+    code = (
+        f"_sb = {bytes(table.blob)!r}\n"
+        f"_sk = {bytes(table.key)!r}\n"
+        f"_so = {tuple(table.slots)!r}\n"
+    )
+    if mode == 'eager':
+        # one big-int XOR over the whole blob instead of a per-byte loop
+        code += (
+            "_sx = (int.from_bytes(_sb, 'little') ^ int.from_bytes(_sk, 'little')).to_bytes(len(_sb), 'little')\n"
+            f"{SLOT_TABLE} = [_sx[o:o + n].decode('utf-8') if t else _sx[o:o + n] for o, n, t in _so]\n"
+        )
+    else:
+        code += (
+            f"{SLOT_TABLE} = [None] * {len(table.slots)}\n"
+            f"def {SLOT_LOAD}(i):\n"
+            "    o, n, t = _so[i]\n"
+            "    v = bytes([a ^ b for a, b in zip(_sb[o:o + n], _sk[o:o + n])])\n"
+            f"    v = {SLOT_TABLE}[i] = v.decode('utf-8') if t else v\n"
+            "    return v\n"
+        )
+    return ast.parse(code).body
@@ -1,18 +1,78 @@
 import ast
+from ast_stack import StackTransformer, fix_missing_locations, recursion_limit
 
 counter = 1
 
-class CommentRemover(ast.NodeTransformer):
-    def visit(self, node):
+
+class SharedRenames:
+    """Package-wide masks for names that one module imports from another."""
+
+    def __init__(self, modules, packages, names, star=None):
+        self.modules = set(modules)
+        self.packages = set(packages)
+        # module -> top-level names a `from module import *` binds
+        self.star = star or {}
+        self.mask = {}
+        for name in sorted(names):
+            self.mask[name] = f"X{len(self.mask) + 1}"
+
+    def target(self, module, node):
+        # absolute module named by an ImportFrom inside `module`
+        if not node.level:
+            return node.module
+        parts = module.split('.')
+        if module not in self.packages:
+            parts = parts[:-1]
+        parts = parts[:len(parts) - node.level + 1]
+        if node.module:
+            parts.append(node.module)
+        return '.'.join(parts)
+
+    def aliases(self, tree, module):
+        # local name -> package module it is bound to
+        aliases = {}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for name in node.names:
+                    if name.asname and name.name in self.modules:
+                        aliases[name.asname] = name.name
+                    elif not name.asname and name.name.split('.')[0] in self.modules:
+                        aliases[name.name.split('.')[0]] = name.name.split('.')[0]
+            elif isinstance(node, ast.ImportFrom):
+                base = self.target(module, node)
+                for name in node.names:
+                    if f"{base}.{name.name}" in self.modules:
+                        aliases[name.asname or name.name] = f"{base}.{name.name}"
+        return aliases
+
+    def attribute_module(self, node, aliases):
+        # package module an `x.y.attr` expression reads `attr` from, if any
+        parts = []
+        value = node.value
+        while isinstance(value, ast.Attribute):
+            parts.append(value.attr)
+            value = value.value
+        if not isinstance(value, ast.Name) or value.id not in aliases:
+            return None
+        path = '.'.join([aliases[value.id]] + parts[::-1])
+        if path in self.modules and f"{path}.{node.attr}" not in self.modules:
+            return path
+        return None
+
+
+class CommentRemover(StackTransformer):
+    def generic_visit(self, node):
         if hasattr(node, 'body') and isinstance(node.body, list):
             node.body = [stmt for stmt in node.body if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Str))]
-        return super().visit(node)
+        return super().generic_visit(node)
 
-class RenameTransformer(ast.NodeTransformer):
-    def __init__(self, mask_bank, function_local_vars):
+class RenameTransformer(StackTransformer):
+    def __init__(self, mask_bank, function_local_vars, shared=None, aliases=None):
         self.mask_bank = mask_bank
         self.function_local_vars = function_local_vars
         self.current_function = None
+        self.shared = shared
+        self.aliases = aliases or {}
 
     def visit_FunctionDef(self, node):
         original_name = node.name
@@ -24,13 +84,13 @@ class RenameTransformer(ast.NodeTransformer):
                 arg_key = (self.current_function, arg.arg)
                 if arg_key in self.mask_bank:
                     arg.arg = self.mask_bank[arg_key]
-            self.generic_visit(node)
+            yield from self.generic_visit(node)
         else:
             node.name = self.mask_bank[("global", original_name)]
             for arg in node.args.args:
                 arg.arg = self.mask_bank[(original_name, arg.arg)]
             self.current_function = original_name
-            self.generic_visit(node)
+            yield from self.generic_visit(node)
             self.current_function = None
         return node
 
@@ -57,12 +117,21 @@ class RenameTransformer(ast.NodeTransformer):
                 node.id = self.mask_bank[global_key]
         return node
 
+    def visit_Attribute(self, node):
+        if self.shared and node.attr in self.shared.mask:
+            if self.shared.attribute_module(node, self.aliases):
+                node.attr = self.shared.mask[node.attr]
+        yield from self.generic_visit(node)
+        return node
+
     def visit_Call(self, node):
-        self.generic_visit(node)
+        yield from self.generic_visit(node)
         return node
 
 def collect_global_variables(tree):
     global_vars = set()
+    # `import a.b` binds `a` but cannot be rewritten as `import a.b as X`
+    dotted_roots = set()
     # collect globals declared inside functions via 'global' statement
     for node in ast.walk(tree):
         if isinstance(node, ast.Global):
@@ -78,25 +147,26 @@ def collect_global_variables(tree):
             for name in node.names:
                 var_name = name.asname or name.name.split('.')[0]
                 global_vars.add(var_name)
+                if not name.asname and '.' in name.name:
+                    dotted_roots.add(var_name)
         elif isinstance(node, ast.ImportFrom):
             for name in node.names:
-                var_name = name.asname or name.name
-                global_vars.add(var_name)
-    return global_vars
+                if name.name != '*':
+                    global_vars.add(name.asname or name.name)
+    return global_vars - dotted_roots
 
 def collect_local_variables(func_node):
     global_names = set()
+    stored = set()
     for node in ast.walk(func_node):
-        if isinstance(node, ast.Global):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Store):
+                stored.add(node.id)
+        elif isinstance(node, ast.Global):
             global_names.update(node.names)
-    local_vars = set(arg.arg for arg in func_node.args.args)
-    for node in ast.walk(func_node):
-        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
-            if node.id not in global_names:
-                local_vars.add(node.id)
-    return local_vars
+    return (stored - global_names) | set(arg.arg for arg in func_node.args.args)
 
-def strip_imports(tree, mask_bank):
+def strip_imports(tree, mask_bank, shared=None, module=None):
     for node in ast.walk(tree):
         if isinstance(node, ast.Import):
             for name in node.names:
@@ -104,41 +174,66 @@ def strip_imports(tree, mask_bank):
                 if ("global", var_name) in mask_bank:
                     name.asname = mask_bank[("global", var_name)]
         elif isinstance(node, ast.ImportFrom):
+            base = shared.target(module, node) if shared else None
             for name in node.names:
                 var_name = name.asname or name.name
                 if ("global", var_name) in mask_bank:
                     name.asname = mask_bank[("global", var_name)]
+                # the exporting module renamed it with the same shared mask
+                if (shared and base in shared.modules and name.name in shared.mask
+                        and f"{base}.{name.name}" not in shared.modules):
+                    name.name = shared.mask[name.name]
 
-def strip(code):
-    global counter
-    counter = 1
-
+def strip(code, shared=None, module=None):
     try:
-        tree = ast.parse(code)
+        with recursion_limit():
+            tree = ast.parse(code)
     except SyntaxError as e:
         raise ValueError(f"Invalid Python code: {e}")
+    tree = strip_tree(tree, shared, module)
+    with recursion_limit():
+        return ast.unparse(tree).strip()
+
+def strip_tree(tree, shared=None, module=None):
+    # renames in place; the tree must not share nodes between positions
+    global counter
+    # shared package masks take X1..XN, module-local masks follow
+    counter = len(shared.mask) + 1 if shared else 1
 
     comment_remover = CommentRemover()
     tree = comment_remover.visit(tree)
 
     global_vars = collect_global_variables(tree)
+    if shared:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.names[0].name == '*':
+                global_vars |= shared.star.get(shared.target(module, node), set())
     function_local_vars = {}
     for node in tree.body:
         if isinstance(node, ast.FunctionDef):
             function_local_vars[node.name] = collect_local_variables(node)
 
     mask_bank = {}
-    for var in global_vars:
+    # sorted so the numbering does not depend on set order
+    for var in sorted(global_vars):
+        if shared and var in shared.mask:
+            mask_bank[("global", var)] = shared.mask[var]
+            continue
         mask_bank[("global", var)] = f"X{counter}"
         counter += 1
+    # each function numbers its locals from the same base, so editing one
+    # function does not renumber the others
+    local_base = counter
     for func_name, local_vars in function_local_vars.items():
-        for var in local_vars:
+        counter = local_base
+        for var in sorted(local_vars):
             mask_bank[(func_name, var)] = f"X{counter}"
             counter += 1
 
-    strip_imports(tree, mask_bank)
+    aliases = shared.aliases(tree, module) if shared else None
+    strip_imports(tree, mask_bank, shared, module)
 
-    transformer = RenameTransformer(mask_bank, function_local_vars)
+    transformer = RenameTransformer(mask_bank, function_local_vars, shared, aliases)
     tree = transformer.visit(tree)
-    ast.fix_missing_locations(tree)
-    return ast.unparse(tree).strip()
+    fix_missing_locations(tree)
+    return tree
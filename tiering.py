@@ -0,0 +1,142 @@
+"""Profile-guided protection tiers.
+
+Record a profile by running a test or load suite under cProfile:
+
+    python tiering.py -o profile.json script.py [args ...]
+    python tiering.py -o profile.json -m pytest tests/
+
+then pass it to Maskpy2 with --profile. Each obfuscated function gets the
+strongest tier whose projected overhead stays a small share of the
+profiled run time: multi-VM for cold code, the bytecode trampoline for
+warm code and AST-only transforms (strings, constant unfolding) for the
+hottest.
+"""
+import os
+import sys
+import json
+import runpy
+import cProfile
+import pstats
+
+TIERS = ('vm', 'jit', 'light')
+
+# projected cost per tier: (seconds added per call, factor on own time).
+# From bench samples with --vm-cache: a VM entry sets up its handlers on
+# every call; the trampoline runs the MBA-transformed code at near native
+# speed once decoded.
+TIER_COST = {
+    'vm': (250e-6, 12.0),
+    'jit': (0.2e-6, 4.0),
+    'light': (0.0, 1.0),
+}
+# a tier is used while its projected overhead is at most this share of the
+# profiled total
+MAX_SHARE = {'vm': 0.01, 'jit': 0.05}
+
+
+def record_profile(run, out_path):
+    """Run `run()` under cProfile and write per-function call counts and times to `out_path`."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        run()
+    except SystemExit:
+        pass
+    finally:
+        profiler.disable()
+    # the interpreter's own modules count towards the total only
+    skip = tuple({sys.prefix, sys.base_prefix, os.path.dirname(os.__file__)})
+    functions = {}
+    total = 0.0
+    for (filename, _, name), (_, calls, own, cumulative, _) in pstats.Stats(profiler).stats.items():
+        total += own
+        if not filename.endswith('.py') or os.path.abspath(filename).startswith(skip):
+            continue
+        entry = functions.setdefault(f'{os.path.abspath(filename)}:{name}',
+                                     {'calls': 0, 'time': 0.0, 'cumtime': 0.0})
+        entry['calls'] += calls
+        entry['time'] += own
+        entry['cumtime'] += cumulative
+    with open(out_path, 'w') as f:
+        json.dump({'total': total, 'functions': functions}, f, indent=1, sort_keys=True)
+
+
+def load_profile(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def profile_entries(profile, filename):
+    """{function name: entry} for the top-level functions of `filename` in `profile`.
+
+    Paths are matched exactly first, then by file name, so a profile
+    recorded in a checkout elsewhere still applies.
+    """
+    path = os.path.abspath(filename)
+    exact = {}
+    by_name = {}
+    for key, entry in profile['functions'].items():
+        file, _, name = key.rpartition(':')
+        if file == path:
+            exact[name] = entry
+        elif os.path.basename(file) == os.path.basename(path):
+            by_name[name] = entry
+    return exact or by_name
+
+
+def projected_time(entry, tier):
+    per_call, factor = TIER_COST[tier]
+    return entry['calls'] * per_call + entry['time'] * factor
+
+
+def choose_tiers(profile, filename, functions):
+    """{name: tier} for `functions`; code the profile never saw stays in the VM."""
+    entries = profile_entries(profile, filename)
+    total = profile['total'] or 1e-9
+    tiers = {}
+    for name in functions:
+        entry = entries.get(name)
+        tiers[name] = 'vm'
+        if entry is None:
+            continue
+        for tier in TIERS:
+            tiers[name] = tier
+            if tier == 'light' or projected_time(entry, tier) - entry['time'] <= MAX_SHARE[tier] * total:
+                break
+    return tiers
+
+
+def overhead_table(profile, filename, tiers):
+    """Projected run time of the profiled calls with every function in the VM, and with `tiers`."""
+    entries = profile_entries(profile, filename)
+    rows = [f"{'function':<24} {'calls':>9} {'own ms':>9} {'tier':>6} {'before ms':>10} {'after ms':>10}"]
+    own = before = after = 0.0
+    for name, tier in sorted(tiers.items(), key=lambda item: -entries.get(item[0], {}).get('time', 0)):
+        entry = entries.get(name, {'calls': 0, 'time': 0.0})
+        b, a = projected_time(entry, 'vm'), projected_time(entry, tier)
+        own += entry['time']
+        before += b
+        after += a
+        rows.append(f"{name:<24} {entry['calls']:>9} {entry['time'] * 1e3:>9.2f} {tier:>6} "
+                    f"{b * 1e3:>10.2f} {a * 1e3:>10.2f}")
+    rest = profile['total'] - own
+    rows.append(f"{'total (whole profile)':<24} {'':>9} {profile['total'] * 1e3:>9.2f} {'':>6} "
+                f"{(before + rest) * 1e3:>10.2f} {(after + rest) * 1e3:>10.2f}")
+    return '\n'.join(rows)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Record a call profile for Maskpy2 --profile.")
+    parser.add_argument("-o", "--output", default="profile.json", help="Profile file to write (default: profile.json).")
+    parser.add_argument("-m", dest="module", action="store_true", help="Run the target as a module, like python -m.")
+    parser.add_argument("target", help="Script path, or module name with -m.")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments for the target.")
+    args = parser.parse_args()
+    sys.argv = [args.target] + args.args
+    if args.module:
+        record_profile(lambda: runpy.run_module(args.target, run_name='__main__', alter_sys=True), args.output)
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(args.target)))
+        record_profile(lambda: runpy.run_path(args.target, run_name='__main__'), args.output)
+    print(f"profile written to {args.output}")
@@ -74,16 +74,34 @@ _CMPOP_MAP = {
 }
 
 
-def _instr_size(op_name):
-    if op_name in _NO_OPERAND:
-        return 1
-    if op_name in _U8_OPERAND:
-        return 2
-    if op_name in _U16_OPERAND:
-        return 3
-    if op_name in _U8U8_OPERAND:
-        return 3
-    return 1
+# constants, names and locals per function
+POOL_LIMIT = 0x10000
+
+_DONE = object()
+
+
+def const_index(constants, ids, value):
+    """Index of `value` in `constants`, appended if new.
+
+    `ids` maps (type, value) to indices, so equal values of different types
+    (1, 1.0, True) stay apart; unhashable values fall back to a scan.
+    """
+    try:
+        key = (type(value), value)
+        if key in ids:
+            return ids[key]
+    except TypeError:
+        key = None
+        for i, c in enumerate(constants):
+            if c is value or (type(c) == type(value) and c == value):
+                return i
+    constants.append(value)
+    if key is not None:
+        ids[key] = len(constants) - 1
+    return len(constants) - 1
+
+
+_OPERAND_FORMATS = {'': '', 'u8': 'B', 'u16': 'H', 'u8u8': 'BB', 'u16u16': 'HH', 'u32': 'I'}
 
 
 class CompileResult:
@@ -110,17 +128,23 @@ class VMCompiler(ast.NodeVisitor):
         self._label_counter = 0
         self._loop_stack = []
         self._globals = set()
+        self._assigned = set()
+        self._const_ids = {}
+        self._name_ids = {}
 
     def _reset(self):
         self.code = []
         self.constants = []
         self.names = []
+        self._const_ids = {}
+        self._name_ids = {}
         self.locals = {}
         self.num_locals = 0
         self.num_args = 0
         self._label_counter = 0
         self._loop_stack = []
         self._globals = set()
+        self._assigned = set()
 
     def generic_visit(self, node):
         # reject unsupported node types
@@ -130,7 +154,23 @@ class VMCompiler(ast.NodeVisitor):
                        ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
         if isinstance(node, unsupported):
             raise VMUnsupported(type(node).__name__)
-        super().generic_visit(node)
+        yield from ast.iter_child_nodes(node)
+
+    def visit(self, node):
+        # visit_* methods are generators yielding each child to compile in
+        # place; the explicit stack keeps deeply nested expressions clear of
+        # the recursion limit
+        stack = [self._steps(node)]
+        while stack:
+            child = next(stack[-1], _DONE)
+            if child is _DONE:
+                stack.pop()
+            else:
+                stack.append(self._steps(child))
+
+    def _steps(self, node):
+        steps = getattr(self, 'visit_' + node.__class__.__name__, self.generic_visit)(node)
+        return iter(()) if steps is None else steps
 
     def compile_function(self, func_def):
         self._reset()
@@ -139,6 +179,10 @@ class VMCompiler(ast.NodeVisitor):
         for arg in func_def.args.args:
             self.add_local(arg.arg)
         self.num_args = len(func_def.args.args)
+        # as in Python, a name stored anywhere in the function is local, also
+        # where a load comes first in the source (read after a loop back edge)
+        self._assigned = {n.id for n in ast.walk(func_def)
+                          if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
         for stmt in func_def.body:
             self.visit(stmt)
         # ensure trailing RET
@@ -146,6 +190,11 @@ class VMCompiler(ast.NodeVisitor):
             idx = self.add_const(None)
             self.emit('PUSH_CONST', idx)
             self.emit('RET')
+        # pool indices are u16 operands in their wide form (vm_isa.widen)
+        for pool, size in (('constants', len(self.constants)), ('names', len(self.names)),
+                           ('locals', self.num_locals)):
+            if size > POOL_LIMIT:
+                raise VMUnsupported(f'too_many_{pool}')
         ir = list(self.code)
         result = self._resolve()
         result.ir = ir
@@ -163,17 +212,13 @@ class VMCompiler(ast.NodeVisitor):
 
     def add_const(self, value):
         # reuse existing constant if possible
-        for i, c in enumerate(self.constants):
-            if c is value or (type(c) == type(value) and c == value):
-                return i
-        self.constants.append(value)
-        return len(self.constants) - 1
+        return const_index(self.constants, self._const_ids, value)
 
     def add_name(self, name):
-        if name in self.names:
-            return self.names.index(name)
-        self.names.append(name)
-        return len(self.names) - 1
+        if name not in self._name_ids:
+            self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self._name_ids[name]
 
     def add_local(self, name):
         if name in self.locals:
@@ -209,20 +254,22 @@ class VMCompiler(ast.NodeVisitor):
                 self.emit('LOAD_GLOBAL', idx)
             elif node.id in self.locals:
                 self.emit('LOAD_LOCAL', self.locals[node.id])
+            elif node.id in self._assigned:
+                self.emit('LOAD_LOCAL', self.add_local(node.id))
             else:
                 idx = self.add_name(node.id)
                 self.emit('LOAD_GLOBAL', idx)
 
     def visit_BinOp(self, node):
-        self.visit(node.left)
-        self.visit(node.right)
+        yield node.left
+        yield node.right
         op_name = _BINOP_MAP.get(type(node.op))
         if op_name is None:
             raise NotImplementedError(f'binop {type(node.op).__name__}')
         self.emit(op_name)
 
     def visit_UnaryOp(self, node):
-        self.visit(node.operand)
+        yield node.operand
         op_name = _UNARYOP_MAP.get(type(node.op))
         if op_name is None:
             raise NotImplementedError(f'unaryop {type(node.op).__name__}')
@@ -230,16 +277,16 @@ class VMCompiler(ast.NodeVisitor):
 
     def visit_Compare(self, node):
         if len(node.ops) == 1:
-            self.visit(node.left)
-            self.visit(node.comparators[0])
+            yield node.left
+            yield node.comparators[0]
             self.emit(_CMPOP_MAP[type(node.ops[0])])
             return
         # chained comparisons -> short-circuit and
         end_label = self.new_label()
         done_label = self.new_label()
-        self.visit(node.left)
+        yield node.left
         for i, (op, comp) in enumerate(zip(node.ops, node.comparators)):
-            self.visit(comp)
+            yield comp
             if i < len(node.ops) - 1:
                 # need to keep copy of comp for next comparison
                 self.emit('DUP')
@@ -260,7 +307,7 @@ class VMCompiler(ast.NodeVisitor):
     def visit_BoolOp(self, node):
         end_label = self.new_label()
         for i, val in enumerate(node.values):
-            self.visit(val)
+            yield val
             if i < len(node.values) - 1:
                 self.emit('DUP')
                 if isinstance(node.op, ast.And):
@@ -273,20 +320,20 @@ class VMCompiler(ast.NodeVisitor):
     def visit_Call(self, node):
         if isinstance(node.func, ast.Attribute):
             # method call
-            self.visit(node.func.value)
+            yield node.func.value
             name_idx = self.add_name(node.func.attr)
             for arg in node.args:
-                self.visit(arg)
+                yield arg
             self.emit('CALL_METHOD', name_idx, len(node.args))
         else:
-            self.visit(node.func)
+            yield node.func
             for arg in node.args:
-                self.visit(arg)
+                yield arg
             self.emit('CALL_FUNC', len(node.args))
 
     def visit_Attribute(self, node):
         if isinstance(node.ctx, ast.Load):
-            self.visit(node.value)
+            yield node.value
             idx = self.add_name(node.attr)
             self.emit('LOAD_ATTR', idx)
         elif isinstance(node.ctx, ast.Store):
@@ -295,78 +342,83 @@ class VMCompiler(ast.NodeVisitor):
 
     def visit_Subscript(self, node):
         if isinstance(node.ctx, ast.Load):
-            self.visit(node.value)
+            yield node.value
             if isinstance(node.slice, ast.Slice):
-                self._compile_slice(node.slice)
+                yield from self._compile_slice(node.slice)
             else:
-                self.visit(node.slice)
+                yield node.slice
             self.emit('SUBSCRIPT')
         elif isinstance(node.ctx, ast.Store):
             # store_subscript expects: val obj idx on stack
             # caller should have pushed val already
-            self.visit(node.value)
+            yield node.value
             if isinstance(node.slice, ast.Slice):
-                self._compile_slice(node.slice)
+                yield from self._compile_slice(node.slice)
             else:
-                self.visit(node.slice)
+                yield node.slice
             self.emit('STORE_SUBSCRIPT')
 
     def _compile_slice(self, node):
         if node.step:
             raise VMUnsupported('slice_step')
         if node.lower:
-            self.visit(node.lower)
+            yield node.lower
         else:
             self.emit('PUSH_CONST', self.add_const(None))
         if node.upper:
-            self.visit(node.upper)
+            yield node.upper
         else:
             self.emit('PUSH_CONST', self.add_const(None))
         self.emit('BUILD_SLICE')
 
     def visit_List(self, node):
         for elt in node.elts:
-            self.visit(elt)
+            yield elt
         self.emit('BUILD_LIST', len(node.elts))
 
     def visit_Tuple(self, node):
         if isinstance(node.ctx, ast.Load):
             for elt in node.elts:
-                self.visit(elt)
+                yield elt
             self.emit('BUILD_TUPLE', len(node.elts))
 
     def visit_Dict(self, node):
         for k, v in zip(node.keys, node.values):
-            self.visit(k)
-            self.visit(v)
+            yield k
+            yield v
         self.emit('BUILD_DICT', len(node.keys))
 
     def visit_IfExp(self, node):
         else_label = self.new_label()
         end_label = self.new_label()
-        self.visit(node.test)
+        yield node.test
         self.emit('JF', else_label)
-        self.visit(node.body)
+        yield node.body
         self.emit('JMP', end_label)
         self.place_label(else_label)
-        self.visit(node.orelse)
+        yield node.orelse
         self.place_label(end_label)
 
+    def visit_NamedExpr(self, node):
+        yield node.value
+        self.emit('DUP')
+        yield from self._store_target(node.target)
+
     def visit_JoinedStr(self, node):
         # f-string: compile each part, convert to str, concatenate
         parts = []
         for val in node.values:
             if isinstance(val, ast.Constant):
-                self.visit(val)
+                yield val
             elif isinstance(val, ast.FormattedValue):
-                self.visit(val.value)
+                yield val.value
                 # call str() on it
                 str_idx = self.add_name('str')
                 self.emit('LOAD_GLOBAL', str_idx)
                 self.emit('ROT2')
                 self.emit('CALL_FUNC', 1)
             else:
-                self.visit(val)
+                yield val
             parts.append(True)
         # join all parts with add
         for _ in range(len(parts) - 1):
@@ -375,26 +427,33 @@ class VMCompiler(ast.NodeVisitor):
     #
 
     def visit_Assign(self, node):
-        self.visit(node.value)
+        yield node.value
         target = node.targets[0]
         if isinstance(target, ast.Tuple) or isinstance(target, ast.List):
             self.emit('UNPACK', len(target.elts))
             for elt in target.elts:
-                self._store_target(elt)
+                yield from self._store_target(elt)
         elif isinstance(target, ast.Subscript):
             # val is on stack, now need obj and idx
-            self.visit(target.value)
-            self.visit(target.slice)
+            yield target.value
+            yield target.slice
             self.emit('STORE_SUBSCRIPT')
         elif isinstance(target, ast.Attribute):
-            self.visit(target.value)
+            yield target.value
             idx = self.add_name(target.attr)
             self.emit('STORE_ATTR', idx)
         else:
-            self._store_target(target)
+            yield from self._store_target(target)
 
     def _store_target(self, target):
-        if isinstance(target, ast.Name):
+        if isinstance(target, (ast.Tuple, ast.List)):
+            # for a, b in ...: the item is still packed
+            if any(isinstance(elt, ast.Starred) for elt in target.elts):
+                raise VMUnsupported('starred_target')
+            self.emit('UNPACK', len(target.elts))
+            for elt in target.elts:
+                yield from self._store_target(elt)
+        elif isinstance(target, ast.Name):
             if target.id in self._globals:
                 idx = self.add_name(target.id)
                 self.emit('STORE_GLOBAL', idx)
@@ -404,11 +463,11 @@ class VMCompiler(ast.NodeVisitor):
                 slot = self.add_local(target.id)
                 self.emit('STORE_LOCAL', slot)
         elif isinstance(target, ast.Subscript):
-            self.visit(target.value)
-            self.visit(target.slice)
+            yield target.value
+            yield target.slice
             self.emit('STORE_SUBSCRIPT')
         elif isinstance(target, ast.Attribute):
-            self.visit(target.value)
+            yield target.value
             idx = self.add_name(target.attr)
             self.emit('STORE_ATTR', idx)
 
@@ -426,11 +485,11 @@ class VMCompiler(ast.NodeVisitor):
                 self.add_local(name)
                 self.emit('LOAD_LOCAL', self.locals[name])
         elif isinstance(node.target, ast.Subscript):
-            self.visit(node.target.value)
-            self.visit(node.target.slice)
+            yield node.target.value
+            yield node.target.slice
             self.emit('SUBSCRIPT')
         # compile rhs
-        self.visit(node.value)
+        yield node.value
         # emit operation
         op_name = _BINOP_MAP.get(type(node.op))
         if op_name is None:
@@ -445,13 +504,13 @@ class VMCompiler(ast.NodeVisitor):
             else:
                 self.emit('STORE_LOCAL', self.locals[name])
         elif isinstance(node.target, ast.Subscript):
-            self.visit(node.target.value)
-            self.visit(node.target.slice)
+            yield node.target.value
+            yield node.target.slice
             self.emit('STORE_SUBSCRIPT')
 
     def visit_Return(self, node):
         if node.value:
-            self.visit(node.value)
+            yield node.value
         else:
             self.emit('PUSH_CONST', self.add_const(None))
         self.emit('RET')
@@ -465,7 +524,7 @@ class VMCompiler(ast.NodeVisitor):
         self.emit('SETUP_EXCEPT', handler_label)
         # compile try body
         for stmt in node.body:
-            self.visit(stmt)
+            yield stmt
         self.emit('POP_EXCEPT')
         self.emit('JMP', end_label)
         # compile except handlers — exception is on TOS when we arrive
@@ -498,28 +557,28 @@ class VMCompiler(ast.NodeVisitor):
             else:
                 self.emit('POP')
             for stmt in handler.body:
-                self.visit(stmt)
+                yield stmt
             self.emit('JMP', end_label)
             if next_handler:
                 self.place_label(next_handler)
         self.place_label(end_label)
         if node.orelse:
             for stmt in node.orelse:
-                self.visit(stmt)
+                yield stmt
 
     def visit_If(self, node):
         else_label = self.new_label()
         end_label = self.new_label()
-        self.visit(node.test)
+        yield node.test
         self.emit('JF', else_label)
         for stmt in node.body:
-            self.visit(stmt)
+            yield stmt
         if node.orelse:
             self.emit('JMP', end_label)
         self.place_label(else_label)
         if node.orelse:
             for stmt in node.orelse:
-                self.visit(stmt)
+                yield stmt
         self.place_label(end_label)
 
     def visit_While(self, node):
@@ -527,10 +586,10 @@ class VMCompiler(ast.NodeVisitor):
         end_label = self.new_label()
         self._loop_stack.append((end_label, loop_label))
         self.place_label(loop_label)
-        self.visit(node.test)
+        yield node.test
         self.emit('JF', end_label)
         for stmt in node.body:
-            self.visit(stmt)
+            yield stmt
         self.emit('JMP', loop_label)
         self.place_label(end_label)
         self._loop_stack.pop()
@@ -539,14 +598,14 @@ class VMCompiler(ast.NodeVisitor):
         check_label = self.new_label()
         end_label = self.new_label()
         self._loop_stack.append((end_label, check_label))
-        self.visit(node.iter)
+        yield node.iter
         self.emit('ITER_NEW')
         self.place_label(check_label)
         self.emit('ITER_NEXT', end_label)
         # store loop variable
-        self._store_target(node.target)
+        yield from self._store_target(node.target)
         for stmt in node.body:
-            self.visit(stmt)
+            yield stmt
         self.emit('JMP', check_label)
         self.place_label(end_label)
         self._loop_stack.pop()
@@ -564,7 +623,7 @@ class VMCompiler(ast.NodeVisitor):
         self.emit('JMP', cont_label)
 
     def visit_Expr(self, node):
-        self.visit(node.value)
+        yield node.value
         self.emit('POP')
 
     def visit_Pass(self, node):
@@ -573,32 +632,31 @@ class VMCompiler(ast.NodeVisitor):
     #
 
     def _resolve(self):
-        # first pass: compute byte offsets, collect label positions
+        # plain (unpermuted) encoding: wide forms where an operand needs
+        # them, every jump wide once the code passes u16 offsets
+        from vm_isa import LAYOUT_SIZES, WIDE_OPS, operand_layout, widen
+        opcodes = dict(OP, **WIDE_OPS)
+        code = widen(self.code)
+        sizes = [LAYOUT_SIZES[operand_layout(instr[0])] if instr[0] != 'LABEL' else 0 for instr in code]
+        if sum(sizes) > 0xFFFF:
+            code = widen(self.code, far=True)
+            sizes = [LAYOUT_SIZES[operand_layout(instr[0])] if instr[0] != 'LABEL' else 0 for instr in code]
+        # first pass: label positions
         label_offsets = {}
         offset = 0
-        for instr in self.code:
+        for instr, size in zip(code, sizes):
             if instr[0] == 'LABEL':
                 label_offsets[instr[1]] = offset
-                continue
-            op_name = instr[0]
-            offset += _instr_size(op_name)
+            offset += size
         # second pass: emit bytes
         out = bytearray()
-        for instr in self.code:
-            if instr[0] == 'LABEL':
-                continue
+        for instr in code:
             op_name = instr[0]
-            out.append(OP[op_name])
-            if op_name in _U8_OPERAND:
-                out.append(instr[1] & 0xFF)
-            elif op_name in _U16_OPERAND:
-                target = instr[1]
-                if isinstance(target, str):
-                    target = label_offsets[target]
-                out.extend(struct.pack('<H', target))
-            elif op_name in _U8U8_OPERAND:
-                out.append(instr[1] & 0xFF)
-                out.append(instr[2] & 0xFF)
+            if op_name == 'LABEL':
+                continue
+            operands = [label_offsets[x] if isinstance(x, str) else x for x in instr[1:]]
+            out.append(opcodes[op_name])
+            out.extend(struct.pack('<' + _OPERAND_FORMATS[operand_layout(op_name)], *operands))
         return CompileResult(
             bytes(out), self.constants, self.names,
             self.num_locals, self.num_args,
@@ -696,4 +754,21 @@ if __name__ == '__main__':
     assert len(result10.code) > 0
     print(f'test10: {len(result10.code)} bytes')
 
+    # test 11: pools past a byte take wide operands; 1 and 1.0 stay apart
+    code11 = 'def f(x):\n' + ''.join(f'    v{i} = x + {i}\n' for i in range(300)) + '    return v299 + 1.0'
+    result11 = VMCompiler().compile_function(ast.parse(code11).body[0])
+    assert result11.num_locals == 301 and type(result11.constants[300]) is float
+    assert ('STORE_LOCAL', 299) in result11.ir
+    print(f'test11: {len(result11.code)} bytes, {len(result11.constants)} consts')
+
+    # test 12: nesting past the recursion limit
+    expr = ast.Name('x', ast.Load())
+    for _ in range(5000):
+        expr = ast.BinOp(expr, ast.Add(), ast.Name('x', ast.Load()))
+    func12 = ast.parse('def f(x):\n    return 0').body[0]
+    func12.body[0].value = expr
+    result12 = VMCompiler().compile_function(func12)
+    assert result12.ir.count(('ADD',)) == 5000
+    print(f'test12: {len(result12.code)} bytes')
+
     print('all compiler tests passed')
@@ -1,84 +1,165 @@
-import random
+from vm_isa import COMPOUND_BASE, MAX_COMPOUNDS, compound_parts
 
-def fuse_opcodes(ir_instructions, compound_defs, rng):
-    if not compound_defs:
-        return ir_instructions
+# never part of a superinstruction: they leave the dispatch loop, touch the
+# exception stack, rewrite code or are jump targets
+_BARRIER = {'LABEL', 'RET', 'HALT', 'VM_YIELD', 'NOP', 'MORPH', 'SETUP_EXCEPT', 'SETUP_EXCEPT_W', 'POP_EXCEPT'}
+# branches may end a superinstruction but not sit inside one
+_BRANCH = {'JMP', 'JT', 'JF', 'ITER_NEXT', 'JMP_W', 'JT_W', 'JF_W', 'ITER_NEXT_W'}
 
-    # build lookup: (op1, op2) -> compound_name
-    pair_lookup = {}
-    for name, info in compound_defs.items():
-        ops = info['base_ops']
-        pair_lookup[(ops[0], ops[1])] = (name, info)
 
-    # don't fuse across labels, jumps, or control flow boundaries
-    unsafe = {'LABEL', 'JMP', 'JF', 'JT', 'RET', 'HALT', 'ITER_NEXT', 'VM_YIELD',
-              'XFER_PUSH_SHARED', 'XFER_POP_SHARED', 'XFER_STORE_GREG', 'XFER_LOAD_GREG',
-              'CALL_FUNC', 'CALL_METHOD', 'UNPACK', 'BUILD_LIST', 'BUILD_TUPLE',
-              'BUILD_DICT', 'STORE_SUBSCRIPT'}
+def loop_weights(ir, base=8):
+    """Static execution estimate per instruction: `base` ** loop nesting depth."""
+    labels = {instr[1]: i for i, instr in enumerate(ir) if instr[0] == 'LABEL'}
+    depth = [0] * len(ir)
+    for i, instr in enumerate(ir):
+        # a backward branch closes a loop that starts at its target label
+        if instr[0] in _BRANCH and labels.get(instr[1], i) < i:
+            for j in range(labels[instr[1]], i + 1):
+                depth[j] += 1
+    return [base ** d for d in depth]
 
-    result = []
-    i = 0
-    while i < len(ir_instructions):
-        if i + 1 < len(ir_instructions):
-            instr1 = ir_instructions[i]
-            instr2 = ir_instructions[i + 1]
-            pair_key = (instr1[0], instr2[0])
-
-            # only fuse when neither instruction is near control flow
-            if (pair_key in pair_lookup
-                    and instr1[0] not in unsafe and instr2[0] not in unsafe
-                    and rng.random() < 0.5):
-                # also check the instruction AFTER the pair isn't a label
-                if i + 2 < len(ir_instructions) and ir_instructions[i + 2][0] == 'LABEL':
-                    result.append(ir_instructions[i])
-                    i += 1
-                    continue
-                name, info = pair_lookup[pair_key]
-                if info['operand_spec'] == 'u8':
-                    operand = instr1[1] if len(instr1) > 1 else 0
-                    result.append((name, operand))
-                elif info['operand_spec'] == 'u8u8':
-                    op1 = instr1[1] if len(instr1) > 1 else 0
-                    op2 = instr2[1] if len(instr2) > 1 else 0
-                    result.append((name, op1, op2))
-                else:
-                    result.append((name,))
-                i += 2
+
+def block_weights(ir, counts):
+    """Per-label execution counts from a per-instruction profile of `ir`.
+
+    Labels survive splitting and register lowering, so these carry a profile
+    of the compiler IR over to code derived from it (see segment_weights).
+    """
+    blocks = {None: counts[0] if counts else 1}
+    for i, instr in enumerate(ir[:-1]):
+        if instr[0] == 'LABEL':
+            blocks[instr[1]] = counts[i + 1]
+    return blocks
+
+
+def segment_weights(seg, blocks):
+    # a region starts outside any loop, so it restarts at the entry count
+    weights = []
+    w = blocks[None]
+    for instr in seg:
+        if instr[0] == 'LABEL':
+            w = blocks.get(instr[1], w)
+        weights.append(w)
+        if instr[0] == 'VM_YIELD':
+            w = blocks[None]
+    return weights
+
+
+def _score_ngrams(ir, weights, max_len):
+    # dispatches each op sequence would save, counting non-overlapping
+    # occurrences left to right
+    scores = {}
+    ends = {}
+    for i in range(len(ir)):
+        ops = ()
+        for instr in ir[i:i + max_len]:
+            op = instr[0]
+            if op in _BARRIER or compound_parts(op) or (ops and ops[-1] in _BRANCH):
+                break
+            ops += (op,)
+            if len(ops) < 2 or ends.get(ops, 0) > i:
                 continue
+            ends[ops] = i + len(ops)
+            scores[ops] = scores.get(ops, 0) + weights[i] * (len(ops) - 1)
+    return scores
+
+
+def _fuse(ir, ops, weights=None):
+    out = []
+    out_weights = []
+    n = len(ops)
+    i = 0
+    while i < len(ir):
+        if weights is not None:
+            out_weights.append(weights[i])
+        window = ir[i:i + n]
+        if len(window) == n and all(instr[0] == op for instr, op in zip(window, ops)):
+            out.append(('+'.join(ops),) + tuple(window))
+            i += n
+        else:
+            out.append(ir[i])
+            i += 1
+    return out, out_weights
 
-        result.append(ir_instructions[i])
-        i += 1
 
-    return result
+def mine_superinstructions(ir, budget, weights=None, max_len=4):
+    """Pick up to `budget` op sequences of 2..max_len ops to fuse, most saved dispatches first.
+
+    `weights` is an execution count per IR instruction, e.g. from a recorded
+    profile; without one, loop nesting depth stands in. Each pick is fused
+    before the next is mined, so the result must be applied in order.
+    """
+    if weights is None:
+        weights = loop_weights(ir)
+    chosen = []
+    for _ in range(min(budget, MAX_COMPOUNDS)):
+        scores = _score_ngrams(ir, weights, max_len)
+        if not scores:
+            break
+        best = max(scores, key=lambda ops: (scores[ops], len(ops), ops))
+        # a one-off straight-line pair saves a single dispatch per call
+        if scores[best] < 2:
+            break
+        chosen.append(best)
+        ir, weights = _fuse(ir, best, weights)
+    return chosen
+
+
+def fuse_opcodes(ir_instructions, patterns):
+    """Fuse `patterns` into a VM segment; returns (ir, {compound name: opcode byte}).
+
+    A superinstruction is ('A+B', instr_a, instr_b): its parts keep their
+    operands and are encoded end to end, so only its opcodes are per VM.
+    """
+    compounds = {}
+    for ops in patterns:
+        fused, _ = _fuse(ir_instructions, ops)
+        if len(fused) < len(ir_instructions):
+            compounds['+'.join(ops)] = COMPOUND_BASE + len(compounds)
+            ir_instructions = fused
+    return ir_instructions, compounds
+
 
 if __name__ == '__main__':
-    rng = random.Random(42)
-
-    # test: fuse LOAD_LOCAL + ADD
-    compounds = {
-        'LOAD_ADD': {'byte': 0xA0, 'base_ops': ['LOAD_LOCAL', 'ADD'], 'operand_spec': 'u8'},
-    }
-    ir = [('PUSH_CONST', 5), ('LOAD_LOCAL', 2), ('ADD',), ('STORE_LOCAL', 0)]
-    fused = fuse_opcodes(ir, compounds, rng)
-    print(f'original: {ir}')
+    # while i < n: total += i * 2; i += 1
+    ir = [('PUSH_CONST', 0), ('STORE_LOCAL', 1), ('LABEL', 'top'),
+          ('LOAD_LOCAL', 2), ('LOAD_LOCAL', 0), ('CMP_LT',), ('JF', 'end'),
+          ('LOAD_LOCAL', 1), ('LOAD_LOCAL', 2), ('PUSH_CONST', 1), ('MUL',), ('ADD',), ('STORE_LOCAL', 1),
+          ('LOAD_LOCAL', 2), ('PUSH_CONST', 2), ('ADD',), ('STORE_LOCAL', 2), ('JMP', 'top'),
+          ('LABEL', 'end'), ('LOAD_LOCAL', 1), ('RET',)]
+
+    weights = loop_weights(ir)
+    assert weights[0] == 1 and weights[3] == 8 and weights[-1] == 1
+
+    patterns = mine_superinstructions(ir, 4)
+    print(f'patterns: {patterns}')
+    assert 0 < len(patterns) <= 4
+    assert all(2 <= len(p) <= 4 for p in patterns)
+
+    fused, compounds = fuse_opcodes(ir, patterns)
     print(f'fused:    {fused}')
-    assert len(fused) <= len(ir)
-
-    # test: empty compounds = no changes
-    assert fuse_opcodes(ir, {}, rng) == ir
-
-    # test: PUSH_STORE (u8u8)
-    compounds2 = {
-        'PUSH_STORE': {'byte': 0xA1, 'base_ops': ['PUSH_CONST', 'STORE_LOCAL'], 'operand_spec': 'u8u8'},
-    }
-    ir2 = [('PUSH_CONST', 0), ('STORE_LOCAL', 3)]
-    any_fused = False
-    for _ in range(20):
-        f = fuse_opcodes(ir2, compounds2, random.Random(_))
-        if len(f) == 1 and f[0][0] == 'PUSH_STORE':
-            any_fused = True
-            assert f[0] == ('PUSH_STORE', 0, 3)
-            break
-    assert any_fused
+    assert len(fused) < len(ir)
+    assert sorted(compounds.values()) == list(range(COMPOUND_BASE, COMPOUND_BASE + len(compounds)))
+    # labels, returns and mid-sequence branches stay out of superinstructions
+    for instr in fused:
+        parts = compound_parts(instr[0])
+        if parts:
+            assert not set(parts) & _BARRIER
+            assert not set(parts[:-1]) & _BRANCH
+    # unfused code round-trips
+    flat = []
+    for instr in fused:
+        flat.extend(instr[1:] if compound_parts(instr[0]) else [instr])
+    assert flat == ir
+
+    # a profile reaches derived code through its labels
+    counts = [1, 1, 1] + [100] * 15 + [1, 1, 1]
+    blocks = block_weights(ir, counts)
+    assert blocks == {None: 1, 'top': 100, 'end': 1}
+    seg = [('PUSH_CONST', 0), ('LABEL', 'top'), ('ADD',), ('VM_YIELD', 1), ('LABEL', 'end'), ('RET',)]
+    assert segment_weights(seg, blocks) == [1, 100, 100, 100, 1, 1]
+
+    # no budget, no compounds
+    assert fuse_opcodes(ir, mine_superinstructions(ir, 0)) == (ir, {})
 
     print('all compound tests passed')
@@ -1,8 +1,18 @@
 # pure python crypto primitives for vm layer
+#
+# The *_ref functions are the original per-byte/per-block implementations;
+# the bulk versions below them must stay bit-exact with them (see __main__).
+
+import struct
 
 MASK64 = 0xFFFFFFFFFFFFFFFF
 MASK32 = 0xFFFFFFFF
 
+# chain keystream formats: the runtime decoder is generated to match
+CHAIN_BYTEWISE = 1  # low byte of one xoshiro output per code byte
+CHAIN_BLOCK = 2     # 8 little-endian bytes per xoshiro output
+CHAIN_FORMAT = CHAIN_BLOCK
+
 
 # --- xoshiro256** ---
 
@@ -42,11 +52,53 @@ def xoshiro256_next(state):
 
 def xoshiro256_stream(state, n):
     # generate n bytes of keystream
-    out = bytearray()
-    while len(out) < n:
-        val = xoshiro256_next(state)
-        out.extend(val.to_bytes(8, 'little'))
-    return bytes(out[:n])
+    words = xoshiro256_block(state, (n + 7) // 8)
+    return struct.pack(f'<{len(words)}Q', *words)[:n]
+
+
+def xoshiro256_block(state, count):
+    # count outputs of xoshiro256** with the state kept in locals
+    s0, s1, s2, s3 = state
+    out = [0] * count
+    for i in range(count):
+        x = (s1 * 5) & MASK64
+        out[i] = ((((x << 7) | (x >> 57)) & MASK64) * 9) & MASK64
+        t = (s1 << 17) & MASK64
+        s2 ^= s0
+        s3 ^= s1
+        s1 ^= s2
+        s0 ^= s3
+        s2 ^= t
+        s3 = ((s3 << 45) | (s3 >> 19)) & MASK64
+    state[:] = [s0, s1, s2, s3]
+    return out
+
+
+# --- chain layer ---
+
+def chain_keystream(state, n, fmt=CHAIN_FORMAT):
+    if fmt == CHAIN_BYTEWISE:
+        return bytes(w & 0xFF for w in xoshiro256_block(state, n))
+    if fmt == CHAIN_BLOCK:
+        return xoshiro256_stream(state, n)
+    raise ValueError(f'unknown chain format {fmt}')
+
+
+def chain_encrypt(code, chain_state, fmt=CHAIN_FORMAT):
+    # xor with the keystream as one big integer; chain_state is not modified
+    ks = chain_keystream(list(chain_state), len(code), fmt)
+    n = len(code)
+    return (int.from_bytes(code, 'little') ^ int.from_bytes(ks, 'little')).to_bytes(n, 'little')
+
+
+def chain_encrypt_ref(code, chain_state):
+    # CHAIN_BYTEWISE, one xoshiro call per byte
+    out = bytearray(len(code))
+    state = list(chain_state)
+    for i in range(len(code)):
+        keystream = xoshiro256_next(state)
+        out[i] = code[i] ^ (keystream & 0xFF)
+    return bytes(out)
 
 
 # --- xtea ---
@@ -71,7 +123,70 @@ def xtea_decrypt(v0, v1, key):
     return v0, v1
 
 
+def _xtea_schedule(key):
+    # (sum + key word) per half-round; only the low 32 bits reach the result
+    delta = 0x9E3779B9
+    sched = []
+    s = 0
+    for _ in range(32):
+        sched.append((s + key[s & 3]) & MASK32)
+        s = (s + delta) & MASK32
+        sched.append((s + key[(s >> 11) & 3]) & MASK32)
+    return sched
+
+
+def _xtea_lanes(data):
+    # one 64-bit lane per block: (v0 lanes, v1 lanes, lane count)
+    n = len(data) // 8
+    words = struct.unpack(f'>{2 * n}I', data)
+    v0 = int.from_bytes(struct.pack(f'<{n}Q', *words[0::2]), 'little')
+    v1 = int.from_bytes(struct.pack(f'<{n}Q', *words[1::2]), 'little')
+    return v0, v1, n
+
+
+def _xtea_unlanes(v0, v1, n):
+    w0 = struct.unpack(f'<{n}Q', v0.to_bytes(8 * n, 'little'))
+    w1 = struct.unpack(f'<{n}Q', v1.to_bytes(8 * n, 'little'))
+    out = [0] * (2 * n)
+    out[0::2] = w0
+    out[1::2] = w1
+    return struct.pack(f'>{2 * n}I', *out)
+
+
 def xtea_encrypt_bytes(data, key):
+    # pad to 8-byte blocks, ecb mode; every block runs in its own 64-bit
+    # lane of one big integer, so each round is a handful of bigint ops.
+    # Lanes never exceed 38 bits, so nothing carries into the next lane.
+    pad_len = (8 - len(data) % 8) % 8
+    data = bytes(data) + b'\x00' * pad_len
+    if not data:
+        return b''
+    v0, v1, n = _xtea_lanes(data)
+    rep = int.from_bytes(b'\x01\x00\x00\x00\x00\x00\x00\x00' * n, 'little')
+    m32 = MASK32 * rep
+    ks = _xtea_schedule(key)
+    for r in range(0, 64, 2):
+        v0 = (v0 + ((((v1 << 4) ^ ((v1 >> 5) & m32)) + v1) ^ (ks[r] * rep))) & m32
+        v1 = (v1 + ((((v0 << 4) ^ ((v0 >> 5) & m32)) + v0) ^ (ks[r + 1] * rep))) & m32
+    return _xtea_unlanes(v0, v1, n)
+
+
+def xtea_decrypt_bytes(data, key):
+    n = len(data) // 8
+    if not n:
+        return b''
+    v0, v1, n = _xtea_lanes(bytes(data[:8 * n]))
+    rep = int.from_bytes(b'\x01\x00\x00\x00\x00\x00\x00\x00' * n, 'little')
+    m32 = MASK32 * rep
+    bias = (1 << 40) * rep  # keeps each lane positive across the subtraction
+    ks = _xtea_schedule(key)
+    for r in range(62, -1, -2):
+        v1 = (v1 + bias - ((((v0 << 4) ^ ((v0 >> 5) & m32)) + v0) ^ (ks[r + 1] * rep))) & m32
+        v0 = (v0 + bias - ((((v1 << 4) ^ ((v1 >> 5) & m32)) + v1) ^ (ks[r] * rep))) & m32
+    return _xtea_unlanes(v0, v1, n)
+
+
+def xtea_encrypt_bytes_ref(data, key):
     # pad to 8-byte blocks, ecb mode
     pad_len = (8 - len(data) % 8) % 8
     data = data + b'\x00' * pad_len
@@ -85,7 +200,7 @@ def xtea_encrypt_bytes(data, key):
     return bytes(out)
 
 
-def xtea_decrypt_bytes(data, key):
+def xtea_decrypt_bytes_ref(data, key):
     out = bytearray()
     for i in range(0, len(data), 8):
         v0 = int.from_bytes(data[i:i+4], 'big')
@@ -117,6 +232,44 @@ def sipround(v0, v1, v2, v3):
 
 
 def siphash(key_bytes, data):
+    # siphash-2-4 with 128-bit key, rounds inlined over 64-bit words
+    # (hashlib has no keyed siphash-2-4)
+    k0, k1 = struct.unpack('<QQ', bytes(key_bytes[:16]))
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+
+    length = len(data)
+    n = length // 8
+    words = list(struct.unpack(f'<{n}Q', bytes(data[:n * 8])))
+    tail = bytes(data[n * 8:]) + b'\x00' * (7 - length % 8) + bytes([length & 0xFF])
+    words.append(int.from_bytes(tail, 'little'))
+
+    for m in words:
+        v3 ^= m
+        for _ in range(2):
+            v0 = (v0 + v1) & MASK64; v1 = ((v1 << 13) | (v1 >> 51)) & MASK64; v1 ^= v0
+            v0 = ((v0 << 32) | (v0 >> 32)) & MASK64
+            v2 = (v2 + v3) & MASK64; v3 = ((v3 << 16) | (v3 >> 48)) & MASK64; v3 ^= v2
+            v0 = (v0 + v3) & MASK64; v3 = ((v3 << 21) | (v3 >> 43)) & MASK64; v3 ^= v0
+            v2 = (v2 + v1) & MASK64; v1 = ((v1 << 17) | (v1 >> 47)) & MASK64; v1 ^= v2
+            v2 = ((v2 << 32) | (v2 >> 32)) & MASK64
+        v0 ^= m
+
+    v2 ^= 0xFF
+    for _ in range(4):
+        v0 = (v0 + v1) & MASK64; v1 = ((v1 << 13) | (v1 >> 51)) & MASK64; v1 ^= v0
+        v0 = ((v0 << 32) | (v0 >> 32)) & MASK64
+        v2 = (v2 + v3) & MASK64; v3 = ((v3 << 16) | (v3 >> 48)) & MASK64; v3 ^= v2
+        v0 = (v0 + v3) & MASK64; v3 = ((v3 << 21) | (v3 >> 43)) & MASK64; v3 ^= v0
+        v2 = (v2 + v1) & MASK64; v1 = ((v1 << 17) | (v1 >> 47)) & MASK64; v1 ^= v2
+        v2 = ((v2 << 32) | (v2 >> 32)) & MASK64
+
+    return (v0 ^ v1 ^ v2 ^ v3) & MASK64
+
+
+def siphash_ref(key_bytes, data):
     # siphash-2-4 with 128-bit key
     k0 = int.from_bytes(key_bytes[0:8], 'little')
     k1 = int.from_bytes(key_bytes[8:16], 'little')
@@ -204,4 +357,23 @@ if __name__ == '__main__':
     k2 = derive_vm_key(12345, key_bytes, 1)
     assert len(k) == 4 and all(isinstance(x, int) for x in k)
     assert k != k2
+    # bulk paths are bit-exact with the reference implementations
+    import random
+    rng = random.Random(7)
+    for n in list(range(0, 40)) + [255, 1000, 4099]:
+        blob = bytes(rng.randrange(256) for _ in range(n))
+        key = tuple(rng.randrange(1 << 32) for _ in range(4))
+        skey = bytes(rng.randrange(256) for _ in range(16))
+        seed = xoshiro256_init(rng.randrange(1 << 64))
+        assert siphash(skey, blob) == siphash_ref(skey, blob)
+        assert xtea_encrypt_bytes(blob, key) == xtea_encrypt_bytes_ref(blob, key)
+        enc = xtea_encrypt_bytes(blob, key)
+        assert xtea_decrypt_bytes(enc, key) == xtea_decrypt_bytes_ref(enc, key)
+        assert chain_encrypt(blob, seed, CHAIN_BYTEWISE) == chain_encrypt_ref(blob, seed)
+        st = list(seed)
+        ref = bytearray()
+        while len(ref) < n:
+            ref.extend(xoshiro256_next(st).to_bytes(8, 'little'))
+        assert chain_keystream(list(seed), n, CHAIN_BLOCK) == bytes(ref[:n])
+        assert chain_encrypt(chain_encrypt(blob, seed), seed) == blob
     print('all crypto tests passed')
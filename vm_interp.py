@@ -76,12 +76,12 @@ def generate_interpreter(opcode_table, opcode_defs, chain_seed, xtea_key,
     #
     _a(f"    {v['code']} = bytearray()")
     _a(f"    {v['k']} = {list(xtea_key)}")
-    _a(f"    {v['tmp']} = {list(bytecode)}")
+    _a(f"    {v['tmp']} = {bytes(bytecode)!r}")
     _a(f"    for {v['bi']} in range(0, len({v['tmp']}), 8):")
-    _a(f"        {v['v0']} = ({v['tmp']}[{v['bi']}]<<24) | ({v['tmp']}[{v['bi']}+1]<<16) | ({v['tmp']}[{v['bi']}+2]<<8) | {v['tmp']}[{v['bi']}+3]")
-    _a(f"        {v['v1']} = ({v['tmp']}[{v['bi']}+4]<<24) | ({v['tmp']}[{v['bi']}+5]<<16) | ({v['tmp']}[{v['bi']}+6]<<8) | {v['tmp']}[{v['bi']}+7]")
+    _a(f"        {v['v0']} = int.from_bytes({v['tmp']}[{v['bi']}:{v['bi']}+4], 'big')")
+    _a(f"        {v['v1']} = int.from_bytes({v['tmp']}[{v['bi']}+4:{v['bi']}+8], 'big')")
     _a(f"        {v['v0']}, {v['v1']} = _xd{uid}({v['v0']}, {v['v1']}, {v['k']})")
-    _a(f"        {v['code']}.extend([({v['v0']}>>24)&0xFF, ({v['v0']}>>16)&0xFF, ({v['v0']}>>8)&0xFF, {v['v0']}&0xFF, ({v['v1']}>>24)&0xFF, ({v['v1']}>>16)&0xFF, ({v['v1']}>>8)&0xFF, {v['v1']}&0xFF])")
+    _a(f"        {v['code']} += ({v['v0']}<<32 | {v['v1']}).to_bytes(8, 'big')")
 
     #
     _a(f"    {v['code']} = {v['code']}[:{code_len}]")
@@ -93,9 +93,9 @@ def generate_interpreter(opcode_table, opcode_defs, chain_seed, xtea_key,
     _a(f"        {v['code']}[{v['bi']}] ^= _xn{uid}({v['cs']}) & 0xFF")
 
     #
-    _a(f"    {v['ot']} = {list(opcode_table)}")
-    _a(f"    {v['consts']} = {constants!r}")
-    _a(f"    {v['names']} = {names!r}")
+    _a(f"    {v['ot']} = {bytes(opcode_table)!r}")
+    _a(f"    {v['consts']} = {tuple(constants)!r}")
+    _a(f"    {v['names']} = {tuple(names)!r}")
     _a(f"    {v['gl']} = globals()")
     _a(f"    {v['gl']}.update(__builtins__ if isinstance(__builtins__, dict) else vars(__builtins__))")
     _a(f"    {v['stk']} = []")
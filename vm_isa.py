@@ -1,4 +1,5 @@
 import random
+from vm_compiler import _U8_OPERAND, _U16_OPERAND, _U8U8_OPERAND
 
 # VM types
 STACK_ONLY = 0   # type A: pure stack machine (current VM)
@@ -16,8 +17,16 @@ REG_OPS = {
     'REG_MOV': 0x84,     # u8 dst_reg, u8 src_reg
     'REG_ADD': 0x85,     # u8 dst_reg, u8 src_reg — dst += src
     'REG_SUB': 0x86,     # u8 dst_reg, u8 src_reg — dst -= src
+    'REG_CONST': 0x87,   # u8 reg, u8 const_idx — load constant into register
 }
 
+# three-address register opcodes (vm_regalloc): REG3_<op> u8 dst, u8 a, u8 b
+# computes dst = a <op> b
+REG3_BASE_OPS = ['ADD', 'SUB', 'MUL', 'MOD', 'FLOORDIV', 'POW',
+                 'BITXOR', 'BITAND', 'BITOR', 'LSHIFT', 'RSHIFT',
+                 'CMP_EQ', 'CMP_NE', 'CMP_LT', 'CMP_GT', 'CMP_LE', 'CMP_GE']
+REG3_OPS = {f'REG3_{op}': 0xE0 + i for i, op in enumerate(REG3_BASE_OPS)}
+
 # cross-VM transfer opcodes (all types)
 XFER_OPS = {
     'XFER_PUSH_SHARED': 0x90,  # u8 stack_id — push TOS onto shared stack
@@ -27,6 +36,19 @@ XFER_OPS = {
     'VM_YIELD': 0x94,          # no operand — yield control to dispatcher
 }
 
+# wide forms: the same op with u16 pool indices and counts, for functions
+# with more than 256 constants, names or locals, and u32 jump targets for
+# segments past 64 KB (see widen)
+WIDE_OPS = {
+    'PUSH_CONST_W': 0x62, 'LOAD_LOCAL_W': 0x63, 'STORE_LOCAL_W': 0x64,
+    'LOAD_GLOBAL_W': 0x65, 'STORE_GLOBAL_W': 0x66,
+    'CALL_FUNC_W': 0x67, 'LOAD_ATTR_W': 0x68, 'STORE_ATTR_W': 0x69,
+    'BUILD_LIST_W': 0x6A, 'BUILD_TUPLE_W': 0x6B, 'UNPACK_W': 0x6C, 'BUILD_DICT_W': 0x6D,
+    'CALL_METHOD_W': 0x88,   # u16 name_idx, u16 argc
+    'REG_LOAD_W': 0x89, 'REG_STORE_W': 0x8A, 'REG_CONST_W': 0x8B,  # u16 reg, u16 slot
+    'JMP_W': 0x43, 'JT_W': 0x44, 'JF_W': 0x45, 'ITER_NEXT_W': 0x46, 'SETUP_EXCEPT_W': 0x47,
+}
+
 # self-modifying bytecode
 # polymorphic ISA padding
 POLY_OPS = {
@@ -36,7 +58,8 @@ POLY_OPS = {
 # instruction sizes for new opcodes
 REG_OP_SIZES = {
     'REG_LOAD': 3, 'REG_STORE': 3, 'REG_PUSH': 2, 'REG_POP': 2,
-    'REG_MOV': 3, 'REG_ADD': 3, 'REG_SUB': 3,
+    'REG_MOV': 3, 'REG_ADD': 3, 'REG_SUB': 3, 'REG_CONST': 3,
+    **{op: 4 for op in REG3_OPS},
 }
 XFER_OP_SIZES = {
     'XFER_PUSH_SHARED': 2, 'XFER_POP_SHARED': 2,
@@ -62,59 +85,99 @@ STACK_EFFECTS = {
     'UNPACK': 0, 'BUILD_SLICE': -1,
     'ITER_NEW': 0, 'ITER_NEXT': 0,
     'RET': -1, 'HALT': 0,
+    'SETUP_EXCEPT': 0, 'POP_EXCEPT': 0, 'MORPH': 0,
     # register ops
     'REG_LOAD': 0, 'REG_STORE': 0, 'REG_PUSH': 1, 'REG_POP': -1,
-    'REG_MOV': 0, 'REG_ADD': 0, 'REG_SUB': 0,
+    'REG_MOV': 0, 'REG_ADD': 0, 'REG_SUB': 0, 'REG_CONST': 0,
+    **{op: 0 for op in REG3_OPS},
     # transfer ops
     'XFER_PUSH_SHARED': -1, 'XFER_POP_SHARED': 1,
     'XFER_STORE_GREG': -1, 'XFER_LOAD_GREG': 1,
     'VM_YIELD': 0,
 }
+STACK_EFFECTS.update({op: STACK_EFFECTS[op[:-2]] for op in WIDE_OPS})
+
+# superinstructions (vm_compound): per-VM opcodes numbered from COMPOUND_BASE,
+# named by their parts joined with '+', e.g. 'LOAD_LOCAL+LOAD_LOCAL+ADD'
+COMPOUND_BASE = 0xA0
+MAX_COMPOUNDS = 0x40
+
+# bytes per operand layout, opcode included
+LAYOUT_SIZES = {'': 1, 'u8': 2, 'u16': 3, 'u8u8': 3, 'u8u8u8': 4, 'morph': 4, 'u16u16': 5, 'u32': 5}
+
+def compound_parts(op_name):
+    """Base ops of a superinstruction, or None for a plain op."""
+    return op_name.split('+') if '+' in op_name else None
 
-# compound opcode candidates: (name, [base_op1, base_op2], operand_spec)
-COMPOUND_CANDIDATES = [
-    ('LOAD_ADD', ['LOAD_LOCAL', 'ADD'], 'u8'),
-    ('PUSH_STORE', ['PUSH_CONST', 'STORE_LOCAL'], 'u8u8'),
-    ('LOAD2', ['LOAD_LOCAL', 'LOAD_LOCAL'], 'u8u8'),
-    ('DUP_STORE', ['DUP', 'STORE_LOCAL'], 'u8'),
-    ('LOAD_SUB', ['LOAD_LOCAL', 'SUB'], 'u8'),
-    ('LOAD_CMP', ['LOAD_LOCAL', 'CMP_LT'], 'u8'),
-]
-
-def generate_compound_set(rng, count=2):
-    chosen = rng.sample(COMPOUND_CANDIDATES, min(count, len(COMPOUND_CANDIDATES)))
-    result = {}
-    for i, (name, base_ops, operand_spec) in enumerate(chosen):
-        result[name] = {
-            'byte': 0xA0 + i,
-            'base_ops': base_ops,
-            'operand_spec': operand_spec,
-        }
-    return result
+def wide_base(op_name):
+    """The op a wide form stands for, or None for any other op."""
+    return op_name[:-2] if op_name in WIDE_OPS else None
+
+def operand_layout(op_name):
+    """Operand kind of an op: '' (none), 'u8', 'u16', 'u8u8', 'u8u8u8', 'morph' (u16 target + u8 mask),
+    'u16u16' or 'u32'.
+
+    Superinstructions report '': their parts decode their own operands.
+    Wide forms double each operand of their base op.
+    """
+    base = wide_base(op_name)
+    if base:
+        return {'u8': 'u16', 'u8u8': 'u16u16', 'u16': 'u32'}[operand_layout(base)]
+    if op_name == 'MORPH':
+        return 'morph'
+    if op_name in _U8_OPERAND:
+        return 'u8'
+    if op_name in _U16_OPERAND:
+        return 'u16'
+    if op_name in _U8U8_OPERAND:
+        return 'u8u8'
+    size = REG_OP_SIZES.get(op_name) or XFER_OP_SIZES.get(op_name, 1)
+    return {1: '', 2: 'u8', 3: 'u8u8', 4: 'u8u8u8'}[size]
+
+def instr_size(instr):
+    """Encoded size of an IR instruction; a superinstruction lays its parts end to end."""
+    if compound_parts(instr[0]):
+        return sum(instr_size(part) for part in instr[1:])
+    return LAYOUT_SIZES[operand_layout(instr[0])]
+
+def widen(ir, far=False):
+    """`ir` with the wide form of every instruction that has an operand over 255.
+
+    With `far`, jumps take their wide form as well, whatever their target.
+    """
+    out = []
+    for instr in ir:
+        op = instr[0]
+        if op + '_W' in WIDE_OPS and (op in _U16_OPERAND and far or op not in _U16_OPERAND
+                                      and any(operand > 0xFF for operand in instr[1:])):
+            instr = (op + '_W',) + instr[1:]
+        out.append(instr)
+    return out
 
 def generate_vm_config(vm_id, vm_type, master_seed, rng):
     from vm_interp import generate_opcode_table
     perm = generate_opcode_table(master_seed ^ (vm_id * 0x9E3779B9))
-    compounds = generate_compound_set(rng) if rng.random() < 0.7 else {}
     return {
         'vm_id': vm_id,
         'vm_type': vm_type,
         'opcode_table': perm,
-        'compounds': compounds,
     }
 
 if __name__ == '__main__':
-    rng = random.Random(42)
+    # sizes: plain ops by layout, superinstructions as the sum of their parts
+    assert instr_size(('JF', 'L1')) == 3 and instr_size(('REG_PUSH', 1)) == 2
+    assert instr_size(('LOAD_LOCAL+PUSH_CONST+ADD', ('LOAD_LOCAL', 0), ('PUSH_CONST', 1), ('ADD',))) == 5
+    assert compound_parts('ADD') is None
 
-    # compound set: 2 entries with unique bytes
-    cs = generate_compound_set(rng, count=2)
-    assert len(cs) == 2
-    bytes_used = [v['byte'] for v in cs.values()]
-    assert len(set(bytes_used)) == 2
+    # wide forms only where an operand needs them, jumps only when far
+    ir = [('PUSH_CONST', 3), ('LOAD_LOCAL', 300), ('CALL_METHOD', 2, 256), ('JF', 'L1'), ('LABEL', 'L1')]
+    assert [i[0] for i in widen(ir)] == ['PUSH_CONST', 'LOAD_LOCAL_W', 'CALL_METHOD_W', 'JF', 'LABEL']
+    assert widen(ir, far=True)[3] == ('JF_W', 'L1')
+    assert [instr_size(i) for i in widen(ir, far=True)[1:4]] == [3, 5, 5]
 
     # vm config has all required keys
     cfg = generate_vm_config(0, STACK_ONLY, 12345, random.Random(99))
-    for k in ('vm_id', 'vm_type', 'opcode_table', 'compounds'):
+    for k in ('vm_id', 'vm_type', 'opcode_table'):
         assert k in cfg, f'missing key: {k}'
 
     # stack effects covers all base opcodes
@@ -122,4 +185,9 @@ if __name__ == '__main__':
     for op_name in OP:
         assert op_name in STACK_EFFECTS, f'missing stack effect for {op_name}'
 
+    # wide opcodes take free values
+    taken = [*OP.values(), *REG_OPS.values(), *REG3_OPS.values(), *XFER_OPS.values(), *POLY_OPS.values(),
+             *range(COMPOUND_BASE, COMPOUND_BASE + MAX_COMPOUNDS)]
+    assert not set(WIDE_OPS.values()) & set(taken) and len(set(WIDE_OPS.values())) == len(WIDE_OPS)
+
     print('all isa tests passed')
@@ -1,10 +1,12 @@
 import ast
 import random
 import struct
+from vm_isa import REG3_OPS, WIDE_OPS, LAYOUT_SIZES, compound_parts, operand_layout, instr_size, wide_base, widen
+from vm_optimize import IR_PASSES, optimize_ir
 
 # ops that can be withheld from static dispatch and injected at runtime
 _SAFE_TO_WITHHOLD = {
-    'PUSH_CONST', 'LOAD_LOCAL', 'STORE_LOCAL', 'LOAD_GLOBAL', 'STORE_GLOBAL',
+    'PUSH_CONST', 'LOAD_LOCAL', 'STORE_LOCAL', 'LOAD_GLOBAL',
     'DUP', 'POP', 'ROT2',
     'ADD', 'SUB', 'MUL',
     'BITXOR', 'BITAND', 'BITOR', 'LSHIFT', 'RSHIFT',
@@ -15,39 +17,68 @@ _SAFE_TO_WITHHOLD = {
     'UNPACK', 'BUILD_SLICE',
     'ITER_NEW',
     'REG_LOAD', 'REG_STORE', 'REG_PUSH', 'REG_POP',
-    'REG_MOV', 'REG_ADD', 'REG_SUB',
+    'REG_MOV', 'REG_ADD', 'REG_SUB', 'REG_CONST', *REG3_OPS,
     'XFER_PUSH_SHARED', 'XFER_POP_SHARED', 'XFER_STORE_GREG', 'XFER_LOAD_GREG',
-    'LOAD_ADD', 'LOAD_SUB', 'PUSH_STORE', 'LOAD2', 'DUP_STORE', 'LOAD_CMP',
     'NOP',
 }
 
-
-def vm_obfuscate_function(func_source, func_name, vm_count=0):
-    from vm_compiler import VMCompiler, OP, _NO_OPERAND, _U8_OPERAND, _U16_OPERAND, _U8U8_OPERAND
-    from vm_crypto import (xoshiro256_init, xoshiro256_next, xtea_encrypt_bytes,
-                           siphash, derive_vm_key, MASK64)
+DISPATCH_STYLES = ['elif', 'dict', 'array', 'tree', 'threaded']
+# styles a VM draws from when none is forced: threaded only pulls ahead of
+# the table styles in bench/bench_dispatch.py with the code cache, without it
+# the per-entry decode leaves it level with them
+DEFAULT_DISPATCH_STYLES = ['elif', 'dict', 'array', 'tree']
+
+_PY_BINOPS = {'ADD': '+', 'SUB': '-', 'MUL': '*', 'MOD': '%', 'FLOORDIV': '//', 'POW': '**',
+              'BITXOR': '^', 'BITAND': '&', 'BITOR': '|', 'LSHIFT': '<<', 'RSHIFT': '>>',
+              'CMP_EQ': '==', 'CMP_NE': '!=', 'CMP_LT': '<', 'CMP_GT': '>', 'CMP_LE': '<=', 'CMP_GE': '>='}
+
+
+def vm_obfuscate_function(func_source, func_name, vm_count=0, code_cache=False, cache_recheck=0,
+                          dispatch=None, uid=None, compound_slots=8, profile=None, ir_passes=IR_PASSES,
+                          padding=True, instrument=False):
+    """VM-compile one function into interpreter source, or None if it cannot be compiled.
+
+    The `compound_slots` most dispatch-saving op sequences of each VM's
+    final code become its superinstructions; `profile` is an optional
+    execution count per compiler IR instruction to rank them and place VM
+    cuts by instead of loop depth.
+    `ir_passes` names the vm_optimize passes run on the IR before it is split.
+    `padding=False` leaves out the NOP padding and MORPH preambles.
+    `instrument=True` emits the execution profiler (see _emit_profiler).
+    """
+    from vm_compiler import VMCompiler, OP
+    from vm_crypto import (xoshiro256_init, xtea_encrypt_bytes,
+                           siphash, derive_vm_key, chain_encrypt, CHAIN_FORMAT, MASK64)
     from vm_interp import (generate_interpreter, generate_opcode_table,
                            generate_chain_seed)
     from vm_splitter import split_instructions
-    from vm_compound import fuse_opcodes
+    from vm_compound import mine_superinstructions, fuse_opcodes, block_weights, segment_weights
 
-    tree = ast.parse(func_source)
-    func_def = tree.body[0]
+    # accepts source text or an already parsed FunctionDef
+    if isinstance(func_source, str):
+        func_def = ast.parse(func_source).body[0]
+    else:
+        func_def = func_source
+    defaults = [ast.unparse(d) for d in func_def.args.defaults]
     compiler = VMCompiler()
     result = compiler.compile_function(func_def)
 
     if result is None or len(result.code) == 0:
         return None
+    # the profile counts compiler IR; labels carry it over to optimized code
+    blocks = block_weights(result.ir, profile) if profile else None
+    result.ir = optimize_ir(result.ir, result.constants, ir_passes)
 
     master_seed = random.randint(0, MASK64)
     siphash_key = bytes(random.randint(0, 255) for _ in range(16))
 
     # try/except can't span VMs
     has_try = any(instr[0] in ('SETUP_EXCEPT', 'POP_EXCEPT') for instr in result.ir)
-    n_vms = 1 if has_try else (vm_count if vm_count >= 2 else random.randint(3, 5))
+    n_vms = 1 if has_try else (vm_count if vm_count >= 1 else random.randint(3, 5))
     rng = random.Random(master_seed)
 
-    split = split_instructions(result.ir, n_vms, rng)
+    weights = segment_weights(result.ir, blocks) if blocks else None
+    split = split_instructions(result.ir, n_vms, rng, weights)
     n_vms = len(split.segments)
 
     vm_data = []
@@ -55,38 +86,47 @@ def vm_obfuscate_function(func_source, func_name, vm_count=0):
     from vm_isa import XFER_OPS, REG_OPS, POLY_OPS
     all_ops.update(XFER_OPS)
     all_ops.update(REG_OPS)
+    all_ops.update(REG3_OPS)
     all_ops.update(POLY_OPS)
 
-    from vm_isa import generate_compound_set
-    compounds = generate_compound_set(rng, count=2)
-    for cname, cinfo in compounds.items():
-        all_ops[cname] = cinfo['byte']
 
     for vm_id in range(n_vms):
         segment_ir = split.segments[vm_id]
         if not segment_ir:
             segment_ir = [('HALT',)]
 
-        segment_ir = fuse_opcodes(segment_ir, compounds, rng)
-        if rng.random() < 0.4:
-            segment_ir = _insert_nop_padding(segment_ir, rng)
-        segment_ir = _insert_morph_preamble(segment_ir, rng)
+        # operands past a byte, and jumps in segments that may pass 64 KB
+        # once padded, take their wide form; only the wide ops in use get
+        # handlers
+        far = _may_pass_u16(segment_ir)
+        segment_ir = widen(segment_ir, far)
+        wide = {op: WIDE_OPS[op] for op in set(instr[0] for instr in segment_ir) if op in WIDE_OPS}
+
+        # mined per VM: register lowering leaves each VM different op sequences
+        weights = segment_weights(segment_ir, blocks) if blocks else None
+        patterns = mine_superinstructions(segment_ir, compound_slots, weights)
+        segment_ir, compounds = fuse_opcodes(segment_ir, patterns)
+        vm_ops = dict(all_ops, **wide, **compounds)
+        if padding:
+            if rng.random() < 0.4:
+                segment_ir = _insert_nop_padding(segment_ir, rng)
+            # MORPH targets are u16
+            if not far:
+                segment_ir = _insert_morph_preamble(segment_ir, rng)
         used = set(instr[0] for instr in segment_ir if instr[0] != 'LABEL')
 
-        bytecode = _resolve_segment(segment_ir, all_ops, _NO_OPERAND, _U8_OPERAND, _U16_OPERAND, _U8U8_OPERAND)
+        bytecode = _resolve_segment(segment_ir, vm_ops)
 
         perm_seed = master_seed ^ (vm_id * 0x9E3779B9)
         opcode_table = generate_opcode_table(perm_seed)
         inverse_table = [0] * 256
         for i, logical in enumerate(opcode_table):
             inverse_table[logical] = i
-        permuted_bytecode = _apply_permutation(bytecode, segment_ir, all_ops,
-                                                inverse_table, _NO_OPERAND, _U8_OPERAND, _U16_OPERAND, _U8U8_OPERAND)
-        permuted_bytecode = _apply_morph_corruption(permuted_bytecode, segment_ir, all_ops,
-                                                     _NO_OPERAND, _U8_OPERAND, _U16_OPERAND, _U8U8_OPERAND)
+        permuted_bytecode = _apply_permutation(bytecode, segment_ir, vm_ops, inverse_table)
+        permuted_bytecode = _apply_morph_corruption(permuted_bytecode, segment_ir, vm_ops)
 
         chain_seed = generate_chain_seed(master_seed ^ (vm_id * 0x1337CAFE))
-        encrypted_code = _chain_encrypt(permuted_bytecode, chain_seed[:])
+        encrypted_code = chain_encrypt(permuted_bytecode, chain_seed, CHAIN_FORMAT)
         xtea_key = derive_vm_key(master_seed, siphash_key, vm_id)
         integrity = siphash(siphash_key, encrypted_code)
         xtea_encrypted = xtea_encrypt_bytes(encrypted_code, xtea_key)
@@ -95,11 +135,14 @@ def vm_obfuscate_function(func_source, func_name, vm_count=0):
             'vm_id': vm_id,
             'opcode_table': opcode_table,
             'chain_seed': chain_seed,
+            'chain_format': CHAIN_FORMAT,
             'xtea_key': xtea_key,
-            'bytecode': list(xtea_encrypted),
+            'bytecode': bytes(xtea_encrypted),
             'integrity': integrity,
             'code_len': len(encrypted_code),
             'used_ops': used,
+            'compounds': compounds,
+            'wide': wide,
         })
 
     seg_instr_counts = []
@@ -120,11 +163,14 @@ def vm_obfuscate_function(func_source, func_name, vm_count=0):
         n_shared_stacks=split.n_shared_stacks,
         n_global_regs=split.n_global_regs,
         seg_instr_counts=seg_instr_counts,
+        code_cache=code_cache,
+        cache_recheck=cache_recheck,
+        dispatch=dispatch,
+        uid=uid,
+        func_name=func_name,
+        instrument=instrument,
     )
 
-    func_ast = ast.parse(func_source)
-    func_def = func_ast.body[0]
-    defaults = [ast.unparse(d) for d in func_def.args.defaults]
     num_required = result.num_args - len(defaults)
 
     if defaults:
@@ -147,34 +193,40 @@ def vm_obfuscate_function(func_source, func_name, vm_count=0):
     return wrapper
 
 
-def _resolve_segment(ir, op_map, no_op, u8_op, u16_op, u8u8_op):
-    xfer_no = {'VM_YIELD', 'HALT', 'NOP', 'POP_EXCEPT'}
-    xfer_u8 = {'XFER_PUSH_SHARED', 'XFER_POP_SHARED', 'XFER_STORE_GREG', 'XFER_LOAD_GREG',
-                'REG_PUSH', 'REG_POP',
-                'LOAD_ADD', 'LOAD_SUB', 'DUP_STORE', 'LOAD_CMP'}
-    xfer_u16 = {'SETUP_EXCEPT'}
-    reg_u8u8 = {'REG_LOAD', 'REG_STORE', 'REG_MOV', 'REG_ADD', 'REG_SUB',
-                 'PUSH_STORE', 'LOAD2'}
+def _may_pass_u16(ir):
+    # worst case after NOP padding (two per instruction) and MORPH preambles
+    size = sum(instr_size(instr) + 2 for instr in ir if instr[0] != 'LABEL')
+    return size + 4 * LAYOUT_SIZES['morph'] > 0xFFFF
+
+
+def _encode_instr(out, instr, op_map, label_offsets):
+    op = instr[0]
+    kind = operand_layout(op)
+    out.append(op_map[op])
+    if kind in ('u16', 'u32', 'morph'):
+        target = instr[1]
+        if isinstance(target, str):
+            target = label_offsets.get(target, 0)
+        # struct raises rather than truncate an operand that does not fit
+        out.extend(struct.pack('<I' if kind == 'u32' else '<H', target))
+        if kind == 'morph':
+            out.append(instr[2] & 0xFF)  # mask
+    elif kind == 'u16u16':
+        out.extend(struct.pack('<HH', *instr[1:]))
+    elif kind == 'u8':
+        out.extend(struct.pack('<B', instr[1]))
+    elif kind in ('u8u8', 'u8u8u8'):
+        out.extend(struct.pack(f'<{len(instr) - 1}B', *instr[1:]))
 
+
+def _resolve_segment(ir, op_map):
     label_offsets = {}
     offset = 0
     for instr in ir:
         if instr[0] == 'LABEL':
             label_offsets[instr[1]] = offset
             continue
-        op = instr[0]
-        if op == 'MORPH':
-            offset += 4  # opcode + u16 target + u8 mask
-        elif op in no_op or op in xfer_no:
-            offset += 1
-        elif op in u8_op or op in xfer_u8:
-            offset += 2
-        elif op in u16_op or op in xfer_u16:
-            offset += 3
-        elif op in u8u8_op or op in reg_u8u8:
-            offset += 3
-        else:
-            offset += 1
+        offset += instr_size(instr)
 
     out = bytearray()
     for instr in ir:
@@ -183,36 +235,19 @@ def _resolve_segment(ir, op_map, no_op, u8_op, u16_op, u8u8_op):
         op = instr[0]
         if op not in op_map:
             continue
-        out.append(op_map[op])
-        if op == 'MORPH':
-            target = instr[1]
-            if isinstance(target, str):
-                target = label_offsets.get(target, 0)
-            out.extend(struct.pack('<H', target))
-            out.append(instr[2] & 0xFF)  # mask
-        elif op in u8_op or op in xfer_u8:
-            out.append(instr[1] & 0xFF)
-        elif op in u16_op or op in xfer_u16:
-            target = instr[1]
-            if isinstance(target, str):
-                target = label_offsets.get(target, 0)
-            out.extend(struct.pack('<H', target))
-        elif op in u8u8_op or op in reg_u8u8:
-            out.append(instr[1] & 0xFF)
-            out.append(instr[2] & 0xFF)
+        if compound_parts(op):
+            # the parts back to back, the first opcode byte replaced
+            start = len(out)
+            for part in instr[1:]:
+                _encode_instr(out, part, op_map, label_offsets)
+            out[start] = op_map[op]
+        else:
+            _encode_instr(out, instr, op_map, label_offsets)
 
     return bytes(out)
 
 
-def _apply_permutation(bytecode, ir, op_map, inverse_table, no_op, u8_op, u16_op, u8u8_op):
-    xfer_no = {'VM_YIELD', 'HALT', 'POP_EXCEPT'}
-    xfer_u8 = {'XFER_PUSH_SHARED', 'XFER_POP_SHARED', 'XFER_STORE_GREG', 'XFER_LOAD_GREG',
-                'REG_PUSH', 'REG_POP',
-                'LOAD_ADD', 'LOAD_SUB', 'DUP_STORE', 'LOAD_CMP'}
-    xfer_u16 = {'SETUP_EXCEPT'}
-    reg_u8u8 = {'REG_LOAD', 'REG_STORE', 'REG_MOV', 'REG_ADD', 'REG_SUB',
-                 'PUSH_STORE', 'LOAD2'}
-
+def _apply_permutation(bytecode, ir, op_map, inverse_table):
     out = bytearray(bytecode)
     pos = 0
     for instr in ir:
@@ -221,20 +256,11 @@ def _apply_permutation(bytecode, ir, op_map, inverse_table, no_op, u8_op, u16_op
         op = instr[0]
         if op not in op_map or pos >= len(out):
             continue
-        # permute the opcode byte
-        out[pos] = inverse_table[out[pos]] & 0xFF
-        if op == 'MORPH':
-            pos += 4
-        elif op in no_op or op in xfer_no:
-            pos += 1
-        elif op in u8_op or op in xfer_u8:
-            pos += 2
-        elif op in u16_op or op in xfer_u16:
-            pos += 3
-        elif op in u8u8_op or op in reg_u8u8:
-            pos += 3
-        else:
-            pos += 1
+        # permute the opcode byte; inner superinstruction parts too, so
+        # they look like any other instruction
+        for part in (instr[1:] if compound_parts(op) else (instr,)):
+            out[pos] = inverse_table[out[pos]] & 0xFF
+            pos += instr_size(part)
     return bytes(out)
 
 
@@ -264,15 +290,8 @@ def _insert_morph_preamble(ir, rng):
     return morph_preamble + new_ir
 
 
-def _apply_morph_corruption(bytecode, ir, op_map, no_op, u8_op, u16_op, u8u8_op):
+def _apply_morph_corruption(bytecode, ir, op_map):
     """Pre-XOR MORPH target bytes so runtime MORPH restores them."""
-    xfer_no = {'VM_YIELD', 'HALT', 'NOP', 'POP_EXCEPT'}
-    xfer_u8 = {'XFER_PUSH_SHARED', 'XFER_POP_SHARED', 'XFER_STORE_GREG', 'XFER_LOAD_GREG',
-                'REG_PUSH', 'REG_POP', 'LOAD_ADD', 'LOAD_SUB', 'DUP_STORE', 'LOAD_CMP'}
-    xfer_u16 = {'SETUP_EXCEPT'}
-    reg_u8u8 = {'REG_LOAD', 'REG_STORE', 'REG_MOV', 'REG_ADD', 'REG_SUB',
-                 'PUSH_STORE', 'LOAD2'}
-
     out = bytearray(bytecode)
     pos = 0
     for instr in ir:
@@ -286,17 +305,7 @@ def _apply_morph_corruption(bytecode, ir, op_map, no_op, u8_op, u16_op, u8u8_op)
             mask = out[pos + 3]
             if target < len(out):
                 out[target] ^= mask
-            pos += 4
-        elif op in no_op or op in xfer_no:
-            pos += 1
-        elif op in u8_op or op in xfer_u8:
-            pos += 2
-        elif op in u16_op or op in xfer_u16:
-            pos += 3
-        elif op in u8u8_op or op in reg_u8u8:
-            pos += 3
-        else:
-            pos += 1
+        pos += instr_size(instr)
     return bytes(out)
 
 
@@ -316,16 +325,6 @@ def _insert_nop_padding(ir, rng):
     return out
 
 
-def _chain_encrypt(code, chain_state):
-    from vm_crypto import xoshiro256_next
-    out = bytearray(len(code))
-    state = list(chain_state)
-    for i in range(len(code)):
-        keystream = xoshiro256_next(state)
-        out[i] = code[i] ^ (keystream & 0xFF)
-    return bytes(out)
-
-
 def _select_withheld_ops(opcode_defs, used_ops, fraction=0.3):
     candidates = [op for op in opcode_defs if op in _SAFE_TO_WITHHOLD and op in used_ops]
     if not candidates:
@@ -358,8 +357,7 @@ def _make_dynamic_handler(op_name, func_name):
         'PUSH_CONST': f" s.append(c[{u8}]);return p+2",
         'LOAD_LOCAL': f" s.append(l[{u8}]);return p+2",
         'STORE_LOCAL': f" l[{u8}]=s.pop();return p+2",
-        'LOAD_GLOBAL': f" s.append(g[n[{u8}]]);return p+2",
-        'STORE_GLOBAL': f" g[n[{u8}]]=s.pop();return p+2",
+        'LOAD_GLOBAL': f" k=n[{u8}];s.append(g[k] if k in g else __builtins__[k]);return p+2",
         'DUP': " s.append(s[-1]);return p+1",
         'POP': " s.pop();return p+1",
         'ROT2': " s[-1],s[-2]=s[-2],s[-1];return p+1",
@@ -381,20 +379,17 @@ def _make_dynamic_handler(op_name, func_name):
         'REG_MOV': " r[d[p+1]]=r[d[p+2]];return p+3",
         'REG_ADD': " r[d[p+1]]=r[d[p+1]]+r[d[p+2]];return p+3",
         'REG_SUB': " r[d[p+1]]=r[d[p+1]]-r[d[p+2]];return p+3",
+        'REG_CONST': " r[d[p+1]]=c[d[p+2]];return p+3",
         'XFER_PUSH_SHARED': f" h[{u8}].append(s.pop());return p+2",
         'XFER_POP_SHARED': f" s.append(h[{u8}].pop());return p+2",
         'XFER_STORE_GREG': f" x[{u8}]=s.pop();return p+2",
         'XFER_LOAD_GREG': f" s.append(x[{u8}]);return p+2",
-        'LOAD_ADD': f" s.append(l[{u8}]);b=s.pop();a=s.pop();s.append(a+b);return p+2",
-        'LOAD_SUB': f" s.append(l[{u8}]);b=s.pop();a=s.pop();s.append(a-b);return p+2",
-        'PUSH_STORE': " l[d[p+2]]=c[d[p+1]];return p+3",
-        'LOAD2': " s.append(l[d[p+1]]);s.append(l[d[p+2]]);return p+3",
-        'DUP_STORE': f" s.append(s[-1]);l[{u8}]=s.pop();return p+2",
-        'LOAD_CMP': f" s.append(l[{u8}]);b=s.pop();a=s.pop();s.append(a<b);return p+2",
     }
     body = simple.get(op_name)
     if body is not None:
         return sig + body
+    if op_name in REG3_OPS:
+        return sig + f" r[d[p+1]]=r[d[p+2]]{_PY_BINOPS[op_name[5:]]}r[d[p+3]];return p+4"
 
     # multi-line (control flow)
     if op_name == 'BUILD_LIST':
@@ -407,10 +402,26 @@ def _make_dynamic_handler(op_name, func_name):
     return None
 
 
+def _xtea_decode_lines(v, uid, i):
+    # _ed{i} is a bytes constant, so calls allocate only the plaintext
+    return [
+        f"    for {v['bi']} in range(0, len(_ed{i}), 8):",
+        f"        {v['v0']},{v['v1']} = _xd{uid}(int.from_bytes(_ed{i}[{v['bi']}:{v['bi']}+4], 'big'),"
+        f"int.from_bytes(_ed{i}[{v['bi']}+4:{v['bi']}+8], 'big'),_ek{i})",
+        f"        _c{i} += ({v['v0']}<<32|{v['v1']}).to_bytes(8, 'big')",
+    ]
+
+
 def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
                             num_locals, num_args, dispatch_order,
-                            n_shared_stacks, n_global_regs, seg_instr_counts=None):
-    uid = random.randint(1000, 9999)
+                            n_shared_stacks, n_global_regs, seg_instr_counts=None,
+                            code_cache=False, cache_recheck=0, dispatch=None, uid=None,
+                            func_name=None, instrument=False):
+    from vm_crypto import CHAIN_BYTEWISE
+    # callers emitting several VMs into one module pass distinct uids; the
+    # draw happens either way so the rest of the output does not depend on it
+    drawn = random.randint(1000, 9999)
+    uid = drawn if uid is None else uid
     n_vms = len(vm_data)
 
     v = {k: f'_{k}{random.randint(10, 99)}' for k in [
@@ -418,7 +429,7 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
         'op', 'sh', 'co', 'f', 'pc', 'code', 'stk', 'loc', 'consts',
         'names', 'gl', 'ot', 'cs', 'seg', 'seg_vm', 'seg_n', 'r',
         'shared', 'gregs', 'codes', 'pcs', 'stks', 'ots',
-        'q1', 'q2']}
+        'q1', 'q2', 'gc', 'gm', 'bt']}
 
     lines = []
     _a = lines.append
@@ -456,9 +467,6 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
     _a(f"    {v['tmp']} |= (len({v['code']}) & 0xFF) << 56; {sv}[3] ^= {v['tmp']}; _sr(); _sr(); {sv}[0] ^= {v['tmp']}; {sv}[2] ^= 0xFF; _sr(); _sr(); _sr(); _sr()")
     _a(f"    return ({sv}[0] ^ {sv}[1] ^ {sv}[2] ^ {sv}[3]) & 0xFFFFFFFFFFFFFFFF")
 
-    # vm entry
-    _a(f"def _vm{uid}(*{v['a']}):")
-
     # spaghetti init (real + decoy VMs interleaved)
     n_decoys = random.randint(1, 2)
     init_blocks = []
@@ -467,16 +475,17 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
         block = []
         block.append(f"    _c{i} = bytearray()")
         block.append(f"    _ek{i} = {vd['xtea_key']!r}")
-        block.append(f"    _ed{i} = {vd['bytecode']}")
-        block.append(f"    for {v['bi']} in range(0, len(_ed{i}), 8):")
-        block.append(f"        {v['v0']} = (_ed{i}[{v['bi']}]<<24)|(_ed{i}[{v['bi']}+1]<<16)|(_ed{i}[{v['bi']}+2]<<8)|_ed{i}[{v['bi']}+3]")
-        block.append(f"        {v['v1']} = (_ed{i}[{v['bi']}+4]<<24)|(_ed{i}[{v['bi']}+5]<<16)|(_ed{i}[{v['bi']}+6]<<8)|_ed{i}[{v['bi']}+7]")
-        block.append(f"        {v['v0']},{v['v1']} = _xd{uid}({v['v0']},{v['v1']},_ek{i})")
-        block.append(f"        _c{i}.extend([({v['v0']}>>24)&0xFF,({v['v0']}>>16)&0xFF,({v['v0']}>>8)&0xFF,{v['v0']}&0xFF,({v['v1']}>>24)&0xFF,({v['v1']}>>16)&0xFF,({v['v1']}>>8)&0xFF,{v['v1']}&0xFF])")
+        block.append(f"    _ed{i} = {vd['bytecode']!r}")
+        block.extend(_xtea_decode_lines(v, uid, i))
         block.append(f"    _c{i} = _c{i}[:{vd['code_len']}]")
         block.append(f"    if _sh{uid}({siphash_key!r}, bytes(_c{i})) != {vd['integrity']}: raise MemoryError()")
         block.append(f"    _cs{i} = {vd['chain_seed']!r}")
-        block.append(f"    for {v['bi']} in range(len(_c{i})): _c{i}[{v['bi']}] ^= _xn{uid}(_cs{i}) & 0xFF")
+        if vd['chain_format'] == CHAIN_BYTEWISE:
+            block.append(f"    for {v['bi']} in range(len(_c{i})): _c{i}[{v['bi']}] ^= _xn{uid}(_cs{i}) & 0xFF")
+        else:
+            # CHAIN_BLOCK: 8 keystream bytes per output, xored as one integer
+            block.append(f"    {v['tmp']} = b''.join(_xn{uid}(_cs{i}).to_bytes(8, 'little') for {v['bi']} in range(0, len(_c{i}), 8))")
+            block.append(f"    _c{i} = bytearray((int.from_bytes(_c{i}, 'little') ^ int.from_bytes({v['tmp']}[:len(_c{i})], 'little')).to_bytes(len(_c{i}), 'little'))")
         init_blocks.append((True, block))
 
     # decoy VMs
@@ -488,25 +497,11 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
         block = []
         block.append(f"    _c{fake_id} = bytearray()")
         block.append(f"    _ek{fake_id} = {fake_key!r}")
-        block.append(f"    _ed{fake_id} = {list(fake_data)}")
-        block.append(f"    for {v['bi']} in range(0, len(_ed{fake_id}), 8):")
-        block.append(f"        {v['v0']} = (_ed{fake_id}[{v['bi']}]<<24)|(_ed{fake_id}[{v['bi']}+1]<<16)|(_ed{fake_id}[{v['bi']}+2]<<8)|_ed{fake_id}[{v['bi']}+3]")
-        block.append(f"        {v['v1']} = (_ed{fake_id}[{v['bi']}+4]<<24)|(_ed{fake_id}[{v['bi']}+5]<<16)|(_ed{fake_id}[{v['bi']}+6]<<8)|_ed{fake_id}[{v['bi']}+7]")
-        block.append(f"        {v['v0']},{v['v1']} = _xd{uid}({v['v0']},{v['v1']},_ek{fake_id})")
-        block.append(f"        _c{fake_id}.extend([({v['v0']}>>24)&0xFF,({v['v0']}>>16)&0xFF,({v['v0']}>>8)&0xFF,{v['v0']}&0xFF,({v['v1']}>>24)&0xFF,({v['v1']}>>16)&0xFF,({v['v1']}>>8)&0xFF,{v['v1']}&0xFF])")
+        block.append(f"    _ed{fake_id} = {fake_data!r}")
+        block.extend(_xtea_decode_lines(v, uid, fake_id))
         init_blocks.append((False, block))
 
     random.shuffle(init_blocks)
-    for _, block in init_blocks:
-        lines.extend(block)
-
-    _a(f"    {v['shared']} = [[] for _ in range({n_shared_stacks})]")
-    _a(f"    {v['gregs']} = [None] * {n_global_regs}")
-    _a(f"    {v['loc']} = list({v['a']}[:{num_args}]) + [None] * {num_locals - num_args}")
-    _a(f"    {v['consts']} = {constants!r}")
-    _a(f"    {v['names']} = {names!r}")
-    _a(f"    {v['gl']} = globals()")
-    _a(f"    {v['gl']}.update(__builtins__ if isinstance(__builtins__, dict) else vars(__builtins__))")
 
     # dynamic preamble: withheld ops
     vm_withheld = []
@@ -514,17 +509,14 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
     for i in range(n_vms):
         withheld = _select_withheld_ops(opcode_defs, vm_data[i].get('used_ops', set()))
         vm_withheld.append(withheld)
-        vm_static_ops.append({k: val for k, val in opcode_defs.items() if k not in withheld})
+        # superinstruction and wide opcodes are per VM
+        vm_ops = dict(opcode_defs, **vm_data[i].get('wide', {}), **vm_data[i].get('compounds', {}))
+        vm_static_ops.append({k: val for k, val in vm_ops.items() if k not in withheld})
 
-    # per-VM init + dynamic handler preamble
+    # encrypted handler preamble
+    dh_blocks = []
     for i in range(n_vms):
-        _a(f"    _ot{i} = {list(vm_data[i]['opcode_table'])}")
-        _a(f"    _stk{i} = []")
-        _a(f"    _pc{i} = 0")
-        _a(f"    _regs{i} = [None] * 8")
-        _a(f"    _eh{i} = []")
-
-        # encrypted handler preamble
+        block = []
         if vm_withheld[i]:
             handler_code = ""
             handler_map = {}
@@ -537,17 +529,110 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
                 handler_map[op_name] = (fname, opcode_defs[op_name])
             if handler_code:
                 xor_key = random.randint(1, 255)
-                encrypted = [b ^ xor_key for b in handler_code.encode()]
+                encrypted = bytes(b ^ xor_key for b in handler_code.encode())
                 ns_var = f'_ns{i}'
-                _a(f"    {ns_var} = {{}}")
-                _a(f"    exec(bytes(b^{xor_key} for b in {encrypted}).decode(),{ns_var})")
+                block.append(f"    {ns_var} = {{}}")
+                block.append(f"    exec(bytes(b^{xor_key} for b in {encrypted!r}).decode(),{ns_var})")
                 dh_entries = ', '.join(f"{oval}: {ns_var}['{fname}']"
                                        for fname, oval in handler_map.values())
-                _a(f"    _dh{i} = {{{dh_entries}}}")
+                block.append(f"    _dh{i} = {{{dh_entries}}}")
             else:
-                _a(f"    _dh{i} = {{}}")
+                block.append(f"    _dh{i} = {{}}")
         else:
-            _a(f"    _dh{i} = {{}}")
+            block.append(f"    _dh{i} = {{}}")
+        dh_blocks.append(block)
+
+    # the profiler draws no random numbers, so builds without it stay
+    # byte-identical
+    pv = f'_pv{uid}'
+    if instrument:
+        vm_ops = [dict(opcode_defs, **vd.get('wide', {}), **vd.get('compounds', {})) for vd in vm_data]
+        _emit_profiler(lines, uid, func_name or f'_vm{uid}',
+                       [{val: name for name, val in ops.items()} for ops in vm_ops], dispatch_order)
+
+    # vm entry
+    if code_cache:
+        # decrypt once: materialize segments and withheld handlers on first
+        # call, keep the pre-MORPH plaintext and hand each call a fresh copy
+        cc = f'_cc{random.randint(10, 99)}'
+        cn = f'_cn{random.randint(10, 99)}'
+        vm_start = len(lines)
+        _a(f"def _ld{uid}():")
+        for _, block in init_blocks:
+            lines.extend(block)
+        for block in dh_blocks:
+            lines.extend(block)
+        cached = [f'bytes(_c{i})' for i in range(n_vms)] + [f'_dh{i}' for i in range(n_vms)]
+        ld_return = len(lines)
+        _a(f"    return [{', '.join(cached)}]")
+        _a(f"def _vm{uid}(*{v['a']}):")
+        _a(f"    if not {cc}: {cc}.extend(_ld{uid}())")
+        if cache_recheck > 0:
+            _a(f"    {cn}[0] += 1")
+            _a(f"    if {cn}[0] >= {cache_recheck}:")
+            _a(f"        {cn}[0] = 0")
+            _a(f"        if _ld{uid}()[:{n_vms}] != {cc}[:{n_vms}]: raise MemoryError()")
+        for i in range(n_vms):
+            _a(f"    _c{i} = bytearray({cc}[{i}])")
+    else:
+        _a(f"def _vm{uid}(*{v['a']}):")
+        for _, block in init_blocks:
+            lines.extend(block)
+
+    _a(f"    {v['shared']} = [[] for _ in range({n_shared_stacks})]")
+    _a(f"    {v['gregs']} = [None] * {n_global_regs}")
+    _a(f"    {v['loc']} = list({v['a']}[:{num_args}]) + [None] * {num_locals - num_args}")
+    _a(f"    {v['consts']} = {tuple(constants)!r}")
+    _a(f"    {v['names']} = {tuple(names)!r}")
+    _a(f"    {v['gl']} = globals()")
+    # globals-then-builtins lookup; builtin hits are cached per name slot
+    # (module globals are always read live), the last slot holds
+    # len(globals) as the guard against a new global shadowing a builtin
+    _a(f"    {v['bt']} = __builtins__ if isinstance(__builtins__, dict) else vars(__builtins__)")
+    _a(f"    {v['gm']} = object()")
+    _a(f"    {v['gc']} = [{v['gm']}] * {len(names)} + [len({v['gl']})]")
+
+    # polymorphic dispatch (4 styles); the draw is made even when a style is
+    # forced so the generated bytecode does not depend on it
+    dispatch_styles = [random.choice(DEFAULT_DISPATCH_STYLES) for _ in range(n_vms)]
+    if dispatch:
+        dispatch_styles = [dispatch] * n_vms
+    dispatch_steps = {}
+    decoders = []
+    if code_cache and 'threaded' in dispatch_styles:
+        # threaded VMs keep their decoded segments next to the plaintext
+        cached += [f'_dq{uid}_{i}(_c{i})' if style == 'threaded' else 'None' for i, style in enumerate(dispatch_styles)]
+        lines[ld_return] = f"    return [{', '.join(cached)}]"
+
+    # per-VM init + dynamic handler preamble
+    for i in range(n_vms):
+        _a(f"    _ot{i} = {bytes(vm_data[i]['opcode_table'])!r}")
+        _a(f"    _stk{i} = []")
+        _a(f"    _pc{i} = 0")
+        _a(f"    _regs{i} = [None] * 8")
+        _a(f"    _eh{i} = []")
+        if code_cache:
+            _a(f"    _dh{i} = {cc}[{n_vms + i}]")
+        else:
+            lines.extend(dh_blocks[i])
+        if instrument:
+            _a(f"    _dh{i} = {{_k: _pw{uid}(_f, {pv}['dyn_ns'], {i}) for _k, _f in _dh{i}.items()}}")
+            _a(f"    _po{i} = {pv}['ops'][{i}]")
+
+        # table-driven styles build their handler table once per entry
+        if dispatch_styles[i] in ('dict', 'array', 'threaded'):
+            args = (lines, v, f'_c{i}', f'_stk{i}', f'_regs{i}',
+                    v['loc'], v['consts'], v['names'], v['gl'],
+                    v['shared'], v['gregs'], vm_static_ops[i], uid, i)
+            if dispatch_styles[i] == 'dict':
+                dispatch_steps[i] = _emit_dict_dispatch(*args)
+            elif dispatch_styles[i] == 'threaded':
+                decoded = f'{cc}[{2 * n_vms + i}]' if code_cache else f'_dq{uid}_{i}(_c{i})'
+                dispatch_steps[i] = _emit_threaded_dispatch(
+                    *args, {op: opcode_defs[op] for op in vm_withheld[i]}, vm_data[i]['opcode_table'],
+                    decoded, decoders)
+            else:
+                dispatch_steps[i] = _emit_array_dispatch(*args)
 
     # timing + canaries
     tc = f'_tc{random.randint(10, 99)}'
@@ -563,7 +648,11 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
         _a(f"    {canary_var} = []")
     seg_idx_var = f'_si{random.randint(10, 99)}'
     _a(f"    {seg_idx_var} = 0")
+    if instrument:
+        _a(f"    {pv}['calls'] += 1")
+        _a(f"    _pk = -1")
 
+    loop_start = len(lines)
     _a(f"    for {v['seg_vm']}, {v['seg_n']} in _segs:")
 
     #
@@ -571,19 +660,38 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
     _a(f"        {td} = {tc}() - _tprev")
     _a(f"        if {td} > 5000000000: return None")
     _a(f"        _tprev = {tc}()")
-
-    # polymorphic dispatch (4 styles)
-    dispatch_styles = [random.choice(['elif', 'dict', 'array', 'tree']) for _ in range(n_vms)]
+    if instrument:
+        # close the previous segment and time this one
+        _a(f"        if _pk >= 0: {pv}['seg_ns'][_pk] += {tc}() - _pst")
+        _a(f"        _pk = {seg_idx_var}; {pv}['seg_n'][_pk] += 1; _pst = {tc}()")
 
     for i in range(n_vms):
         ic = f'_ic{i}'
         kw = 'if' if i == 0 else 'elif'
         _a(f"        {kw} {v['seg_vm']} == {i}:")
+
+        if i in dispatch_steps:
+            # handlers return the next pc; RET/HALT leave their value in
+            # _rv and VM_YIELD returns ~pc to leave the loop
+            _a(f"            while _pc{i} >= 0:")
+            _a(f"              try:")
+            if instrument:
+                _a(f"                _po{i}[_ot{i}[_c{i}[_pc{i}]]] += 1")
+            _a(f"                _pc{i} = {dispatch_steps[i]}")
+            _a(f"              except Exception as _exc:")
+            _a(f"                if _eh{i}: _pc{i} = _eh{i}.pop(); _stk{i}.append(_exc)")
+            _a(f"                else: raise")
+            _a(f"            if _rv{i}: return _rv{i}[0]")
+            _a(f"            _pc{i} = ~_pc{i}")
+            continue
+
         _a(f"            {ic} = 0")
         _a(f"            while _pc{i} < len(_c{i}):")
         _a(f"              try:")
         _a(f"                {ic} += 1")
         _a(f"                {v['op']} = _ot{i}[_c{i}[_pc{i}] & 0xFF]")
+        if instrument:
+            _a(f"                _po{i}[{v['op']}] += 1")
 
         # dynamic handler check
         if vm_withheld[i]:
@@ -595,12 +703,7 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
         args = (lines, v, f'_c{i}', f'_stk{i}', f'_pc{i}', f'_regs{i}',
                 v['loc'], v['consts'], v['names'], v['gl'],
                 v['shared'], v['gregs'], vm_static_ops[i], uid)
-        style = dispatch_styles[i]
-        if style == 'dict':
-            _emit_dict_dispatch(*args, i)
-        elif style == 'array':
-            _emit_array_dispatch(*args, i)
-        elif style == 'tree':
+        if dispatch_styles[i] == 'tree':
             _emit_tree_dispatch(*args, i)
         else:
             _emit_handlers(*args)
@@ -621,31 +724,75 @@ def _generate_multi_interp(vm_data, opcode_defs, siphash_key, constants, names,
     #
     _a(f"        if len({v['loc']}) != {num_locals}: return None")
     _a(f"        {seg_idx_var} += 1")
+    if instrument:
+        # every exit (RET handlers, guards) leaves through the finally
+        lines[loop_start:] = ['    try:'] + ['    ' + line for line in lines[loop_start:]]
+        _a(f"    finally:")
+        _a(f"        if _pk >= 0: {pv}['seg_ns'][_pk] += {tc}() - _pst")
 
     _a(f"    return _stk0[-1] if _stk0 else None")
+    lines.extend(decoders)
+
+    if code_cache:
+        lines[vm_start:] = ['    ' + line for line in lines[vm_start:]]
+        lines.insert(vm_start, f"def _mk{uid}():")
+        lines.insert(vm_start + 1, f"    {cc} = []")
+        if cache_recheck > 0:
+            lines.insert(vm_start + 2, f"    {cn} = [0]")
+        _a(f"    return _vm{uid}")
+        _a(f"_vm{uid} = _mk{uid}()")
 
     return '\n'.join(lines), f'_vm{uid}'
 
 
-def _emit_array_dispatch(lines, v, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx):
-    """Array-indexed dispatch variant."""
+def _emit_profiler(lines, uid, func_name, opnames, dispatch_order):
+    """Emit the execution profiler's counters for one function.
+
+    The counters live in the `maskpy_vm_profile` module, registered in
+    sys.modules by the first instrumented function that loads: `functions`
+    holds the raw counters per function, report() summarizes them (calls,
+    segment switches, per VM instructions by opcode and time in withheld
+    dynamic handlers, per segment entries and time) and dump(path) writes
+    that as JSON. dump runs at exit, to $MASKPY_VM_PROFILE or
+    vm_profile.json.
+    """
     _a = lines.append
-    arr = f'_ha{vm_idx}{random.randint(10,99)}'
-    hi = f'_ai{vm_idx}{random.randint(10,99)}'
-    sorted_ops = sorted(op_defs.items(), key=lambda x: x[1])
-    #
-    mapping = [255] * 256
-    for idx, (_, op_val) in enumerate(sorted_ops):
-        mapping[op_val] = idx
-    _a(f"                {arr} = {mapping}")
-    _a(f"                {hi} = {arr}[{v['op']}]")
-    first = True
-    for handler_idx, (op_name, _) in enumerate(sorted_ops):
-        kw = 'if' if first else 'elif'
-        first = False
-        _a(f"                {kw} {hi} == {handler_idx}:")
-        _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid)
-    _a(f"                else: {pc} += 1")
+    _a(f"def _pr{uid}(name, opnames, order):")
+    _a(f"    import sys, types, atexit, os, json")
+    _a(f"    reg = sys.modules.get('maskpy_vm_profile')")
+    _a(f"    if reg is None:")
+    _a(f"        reg = sys.modules['maskpy_vm_profile'] = types.ModuleType('maskpy_vm_profile')")
+    _a(f"        reg.functions = {{}}")
+    _a(f"        def report():")
+    _a(f"            out = {{}}")
+    _a(f"            for fname, st in reg.functions.items():")
+    _a(f"                vms = []")
+    _a(f"                for vm, (ops, names) in enumerate(zip(st['ops'], st['opnames'])):")
+    _a(f"                    counts = {{names.get(op, f'op{{op}}'): n for op, n in enumerate(ops) if n}}")
+    _a(f"                    vms.append({{'vm': vm, 'instructions': sum(ops), 'dynamic_ns': st['dyn_ns'][vm],")
+    _a(f"                                'opcodes': dict(sorted(counts.items(), key=lambda item: -item[1]))}})")
+    _a(f"                segs = [{{'vm': vm, 'entries': n, 'ns': ns}}")
+    _a(f"                        for (vm, _), n, ns in zip(st['order'], st['seg_n'], st['seg_ns'])]")
+    _a(f"                entries = sum(st['seg_n'])")
+    _a(f"                out[fname] = {{'calls': st['calls'], 'switches': max(entries - st['calls'], 0),")
+    _a(f"                               'vms': vms, 'segments': segs}}")
+    _a(f"            return {{'functions': out}}")
+    _a(f"        def dump(path=None):")
+    _a(f"            path = path or os.environ.get('MASKPY_VM_PROFILE') or 'vm_profile.json'")
+    _a(f"            with open(path, 'w') as f: json.dump(report(), f, indent=1)")
+    _a(f"        reg.report, reg.dump = report, dump")
+    _a(f"        atexit.register(dump)")
+    _a(f"    reg.functions[name] = st = {{'calls': 0, 'opnames': opnames, 'order': order,")
+    _a(f"                                'ops': [[0] * 256 for _ in opnames], 'dyn_ns': [0] * len(opnames),")
+    _a(f"                                'seg_n': [0] * len(order), 'seg_ns': [0] * len(order)}}")
+    _a(f"    return st")
+    _a(f"def _pw{uid}(f, ns, vm, tc=__import__('time').perf_counter_ns):")
+    _a(f"    def w(*a):")
+    _a(f"        t = tc()")
+    _a(f"        try: return f(*a)")
+    _a(f"        finally: ns[vm] += tc() - t")
+    _a(f"    return w")
+    _a(f"_pv{uid} = _pr{uid}({func_name!r}, {opnames!r}, {list(dispatch_order)!r})")
 
 
 def _emit_tree_dispatch(lines, v, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx):
@@ -692,49 +839,211 @@ def _emit_tree_dispatch(lines, v, code, stk, pc, regs, loc, consts, names, gl, s
     emit_tree(sorted_ops, '                ')
 
 
-def _emit_dict_dispatch(lines, v, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx):
-    """Dict-based dispatch variant."""
+def _emit_closure_handlers(lines, v, code, stk, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx):
+    """Emit one closure per opcode at VM entry; returns the {op_val: handler} dict name."""
     _a = lines.append
-    #
-    dt = f'_dt{vm_idx}{random.randint(10,99)}'
-    hi = f'_hi{vm_idx}{random.randint(10,99)}'
+    rv = f'_rv{vm_idx}'
+    hm = f'_hm{vm_idx}{random.randint(10,99)}'
+    _a(f"    {rv} = []")
+    _a(f"    def _hx{vm_idx}(p): return p + 1")
+    entries = []
+    for handler_idx, (op_name, op_val) in enumerate(sorted(op_defs.items(), key=lambda x: x[1])):
+        fname = f'_h{vm_idx}_{handler_idx}'
+        _a(f"    def {fname}(p):")
+        if op_name == 'RET':
+            _a(f"        {rv}.append({stk}.pop()); return -1")
+        elif op_name == 'HALT':
+            _a(f"        {rv}.append({stk}[-1] if {stk} else None); return -1")
+        elif op_name == 'VM_YIELD':
+            _a(f"        return ~(p + 1)")
+        else:
+            _gen_single_handler(lines, v, op_name, code, stk, 'p', regs, loc, consts, names, gl, shared, gregs, uid, indent='        ')
+            _a(f"        return p")
+        entries.append(f"{op_val}: {fname}")
+    _a(f"    {hm} = {{{', '.join(entries)}}}")
+    # withheld ops come from the decrypted dynamic handlers
+    _a(f"    for _k, _f in _dh{vm_idx}.items(): {hm}[_k] = (lambda f: lambda p: f({stk}, {loc}, {consts}, {names}, {gl}, {code}, p, {regs}, {shared}, {gregs}))(_f)")
+    return hm
+
+
+def _emit_array_dispatch(lines, v, code, stk, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx):
+    """Jump-table dispatch: 256 handler closures indexed by the raw opcode byte."""
+    hm = _emit_closure_handlers(lines, v, code, stk, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx)
+    arr = f'_ha{vm_idx}{random.randint(10,99)}'
+    # fold the opcode permutation into the table
+    lines.append(f"    {arr} = [{hm}.get(_o, _hx{vm_idx}) for _o in _ot{vm_idx}]")
+    return f"{arr}[{code}[_pc{vm_idx}]](_pc{vm_idx})"
 
-    #
-    sorted_ops = sorted(op_defs.items(), key=lambda x: x[1])
-    mapping = {op_val: idx for idx, (_, op_val) in enumerate(sorted_ops)}
-    _a(f"                {dt} = {mapping!r}")
-    _a(f"                {hi} = {dt}.get({v['op']}, -1)")
 
-    #
-    first = True
-    for handler_idx, (op_name, op_val) in enumerate(sorted_ops):
-        kw = 'if' if first else 'elif'
-        first = False
-        _a(f"                {kw} {hi} == {handler_idx}:")
-        # emit the same handler body — reuse _gen_single_handler
-        _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid)
-    _a(f"                else: {pc} += 1")
+def _emit_dict_dispatch(lines, v, code, stk, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx):
+    """Dict dispatch: handler closures keyed by the logical opcode."""
+    hm = _emit_closure_handlers(lines, v, code, stk, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx)
+    return f"{hm}.get(_ot{vm_idx}[{code}[_pc{vm_idx}]], _hx{vm_idx})(_pc{vm_idx})"
 
 
-def _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid, indent='                    '):
+def _emit_threaded_dispatch(lines, v, code, stk, regs, loc, consts, names, gl, shared, gregs, op_defs, uid, vm_idx,
+                            withheld, opcode_table, decoded, decoders):
+    """Threaded dispatch: a per-pc table of handlers over operands decoded once per segment.
+
+    _dq{uid}_{vm}, emitted into decoders, sweeps the segment once, applying
+    the MORPH preamble to a scratch copy, into the handler index and operand
+    lists of every instruction; decoded is the expression that yields them
+    (from the code cache when there is one). Each entry only maps the
+    indices onto this call's handler closures. Handler order and indices,
+    the layout codes, the decoder branch order and which list carries which
+    operand are drawn per VM.
+    """
+    _a = lines.append
+    rv, tf, hx = f'_rv{vm_idx}', f'_tf{vm_idx}', f'_hx{vm_idx}'
+    _a(f"    {rv} = []")
+    _a(f"    def {hx}(p): return p + 1")
+
+    handlers = sorted(op_defs.items(), key=lambda x: x[1])
+    random.shuffle(handlers)
+    kinds = ['u8', 'u16', 'u8u8', 'u8u8u8', 'morph']
+    kinds += [kind for kind in ('u16u16', 'u32') if any(operand_layout(op) == kind for op in op_defs)]
+    kind_codes = dict(zip(kinds, random.sample(range(1, 16), len(kinds))))
+    # operand i of every instruction lives in list slots[i]
+    lists = [f'_q{vm_idx}{c}' for c in random.sample('abcdefgh', 3)]
+    slots = random.sample(lists, 3)
+
+    def size(op_name):
+        parts = compound_parts(op_name)
+        return sum(LAYOUT_SIZES[operand_layout(p)] for p in parts) if parts else LAYOUT_SIZES[operand_layout(op_name)]
+
+    n_ops = {'': 0, 'u8': 1, 'u16': 1, 'u8u8': 2, 'u8u8u8': 3, 'morph': 2, 'u16u16': 2, 'u32': 1}
+    table = {}
+    fnames = []
+    for handler_idx, (op_name, op_val) in enumerate(handlers):
+        kind = operand_layout(op_name)
+        table[op_val] = (handler_idx, kind_codes.get(kind, 0), size(op_name))
+        fname = f'_t{vm_idx}_{handler_idx}'
+        fnames.append(fname)
+        _a(f"    def {fname}(p):")
+        if n_ops[kind]:
+            fetch = [f"{name} = {slot}[p]" for name, slot in zip('abc', slots[:n_ops[kind]])]
+            random.shuffle(fetch)
+            _a(f"        {'; '.join(fetch)}")
+        if op_name == 'RET':
+            _a(f"        {rv}.append({stk}.pop()); return -1")
+        elif op_name == 'HALT':
+            _a(f"        {rv}.append({stk}[-1] if {stk} else None); return -1")
+        elif op_name == 'VM_YIELD':
+            _a(f"        return ~(p + 1)")
+        elif op_name == 'MORPH':
+            # compound and withheld handlers read their operands from the bytes
+            _a(f"        {code}[a] ^= b; return p + 4")
+        else:
+            _gen_single_handler(lines, v, op_name, code, stk, 'p', regs, loc, consts, names, gl, shared, gregs, uid,
+                                indent='        ', operands=('a', 'b', 'c') if kind else None)
+            _a(f"        return p")
+    # unknown bytes step over themselves; withheld ops decode their own operands
+    dyn = sorted(withheld.items(), key=lambda x: x[1])
+    for j, (op_name, op_val) in enumerate(dyn):
+        table[op_val] = (len(handlers) + 1 + j, 0, size(op_name))
+    hs = ', '.join(fnames + [hx])
+    if dyn:
+        hs += (f", *[(lambda f: lambda p: f({stk}, {loc}, {consts}, {names}, {gl}, {code}, p, {regs}, {shared}, {gregs}))"
+               f"(_dh{vm_idx}[_k]) if _k in _dh{vm_idx} else {hx} for _k in {tuple(val for _, val in dyn)!r}]")
+    hi = f'_qh{vm_idx}'
+    _a(f"    {hi}, {', '.join(lists)} = {decoded}")
+    _a(f"    {tf} = [*map([{hs}].__getitem__, {hi})]")
+
+    # the decoder is keyed by the encoded byte, so it needs no opcode table
+    unknown = (len(handlers), 0, 1)
+    raw = {byte: table[logical] for byte, logical in enumerate(opcode_table) if logical in table}
+    fields = {
+        'u8': ["c[p+1]"],
+        'u16': ["c[p+1] | (c[p+2] << 8)"],
+        'u8u8': ["c[p+1]", "c[p+2]"],
+        'u8u8u8': ["c[p+1]", "c[p+2]", "c[p+3]"],
+        'morph': ["c[p+1] | (c[p+2] << 8)", "c[p+3]"],
+        'u16u16': ["c[p+1] | (c[p+2] << 8)", "c[p+3] | (c[p+4] << 8)"],
+        'u32': ["int.from_bytes(c[p+1:p+5], 'little')"],
+    }
+    d = decoders.append
+    d(f"def _dq{uid}_{vm_idx}(c, _t={{{', '.join(f'{b}: {e!r}' for b, e in sorted(raw.items()))}}}):")
+    d(f"    c = bytearray(c); n = len(c); p = 0")
+    d(f"    {hi} = [{unknown[0]}] * n; {'; '.join(f'{name} = [0] * n' for name in lists)}")
+    d(f"    while p < n:")
+    d(f"        h, k, z = _t.get(c[p], {unknown!r}); {hi}[p] = h")
+    for j, kind in enumerate(random.sample(kinds, len(kinds))):
+        d(f"        {'if' if j == 0 else 'elif'} k == {kind_codes[kind]}:")
+        d(f"            {'; '.join(f'{slot}[p] = {field}' for slot, field in zip(slots, fields[kind]))}")
+        if kind == 'morph':
+            d(f"            if {slots[0]}[p] < n: c[{slots[0]}[p]] ^= {slots[1]}[p]")
+    d(f"        p += z")
+    d(f"    return {hi}, {', '.join(lists)}")
+    return f"{tf}[_pc{vm_idx}](_pc{vm_idx})"
+
+
+def _gen_global_guard(lines, v, gl, indent):
+    """Drop cached builtins once globals() has grown or shrunk.
+
+    LOAD_GLOBAL runs this before trusting a cached slot, so a builtin
+    shadowed by any new global (a callee, globals()[...] = ..., a withheld
+    STORE_GLOBAL handler) is seen at its next lookup. Python has no dict
+    version tag: a global deleted and another added in its place between
+    two lookups keep the length, and a shadowed builtin stays cached.
+    """
+    gc = v['gc']
+    lines.append(f"{indent}if {gc}[-1] != len({gl}): {gc}[:-1] = [{v['gm']}] * (len({gc}) - 1); {gc}[-1] = len({gl})")
+
+
+def _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid, indent='                    ',
+                        operands=None, grow=0):
     _a = lines.append
     I = indent  # shorthand
 
+    # operands=(a, b, c) names already-decoded operand variables (threaded
+    # dispatch); grow is how much longer than the op itself its wide form is
     def u8():
-        return f"{code}[{pc}+1]"
+        return operands[0] if operands else f"{code}[{pc}+1]"
+    def u8b():
+        return operands[1] if operands else f"{code}[{pc}+2]"
+    def u8c():
+        return operands[2] if operands else f"{code}[{pc}+3]"
     def u16():
-        return f"({code}[{pc}+1] | ({code}[{pc}+2] << 8))"
-
-    if op_name == 'PUSH_CONST':
+        return operands[0] if operands else f"({code}[{pc}+1] | ({code}[{pc}+2] << 8))"
+
+    parts = compound_parts(op_name)
+    if parts:
+        # superinstruction: the parts' handlers back to back, each reading
+        # its operands at its own offset and moving pc past itself
+        for part in parts:
+            _gen_single_handler(lines, v, part, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid,
+                                indent=indent)
+    elif wide_base(op_name):
+        # the base op's handler on operands decoded here, then past the wider encoding
+        base = wide_base(op_name)
+        kind = operand_layout(op_name)
+        if not operands:
+            fields = {'u16': [f"({code}[{pc}+1] | ({code}[{pc}+2] << 8))"],
+                      'u16u16': [f"({code}[{pc}+1] | ({code}[{pc}+2] << 8))",
+                                 f"({code}[{pc}+3] | ({code}[{pc}+4] << 8))"],
+                      'u32': [f"int.from_bytes({code}[{pc}+1:{pc}+5], 'little')"]}[kind]
+            operands = (v['q1'], v['q2'])[:len(fields)]
+            _a(f"{I}{'; '.join(f'{name} = {field}' for name, field in zip(operands, fields))}")
+        grow = LAYOUT_SIZES[kind] - LAYOUT_SIZES[operand_layout(base)]
+        _gen_single_handler(lines, v, base, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid,
+                            indent=indent, operands=operands, grow=grow)
+        if base not in ('JMP', 'JT', 'JF', 'ITER_NEXT'):
+            _a(f"{I}{pc} += {grow}")
+    elif op_name == 'PUSH_CONST':
         _a(f"{I}{stk}.append({consts}[{u8()}]); {pc} += 2")
     elif op_name == 'LOAD_LOCAL':
         _a(f"{I}{stk}.append({loc}[{u8()}]); {pc} += 2")
     elif op_name == 'STORE_LOCAL':
         _a(f"{I}{loc}[{u8()}] = {stk}.pop(); {pc} += 2")
     elif op_name == 'LOAD_GLOBAL':
-        _a(f"{I}{stk}.append({gl}[{names}[{u8()}]]); {pc} += 2")
+        _a(f"{I}{v['val']} = {v['gc']}[{u8()}]")
+        _a(f"{I}if {v['val']} is {v['gm']} or {v['gc']}[-1] != len({gl}):")
+        _gen_global_guard(lines, v, gl, I + '    ')
+        _a(f"{I}    try: {v['val']} = {gl}[{names}[{u8()}]]")
+        _a(f"{I}    except KeyError: {v['val']} = {v['gc']}[{u8()}] = {v['bt']}[{names}[{u8()}]]")
+        _a(f"{I}{stk}.append({v['val']}); {pc} += 2")
     elif op_name == 'STORE_GLOBAL':
-        _a(f"{I}{gl}[{names}[{u8()}]] = {stk}.pop(); {pc} += 2")
+        _a(f"{I}{gl}[{names}[{u8()}]] = {stk}.pop(); {v['gc']}[{u8()}] = {v['gm']}; {pc} += 2")
     elif op_name == 'DUP':
         _a(f"{I}{stk}.append({stk}[-1]); {pc} += 1")
     elif op_name == 'POP':
@@ -758,18 +1067,18 @@ def _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, nam
     elif op_name == 'JMP':
         _a(f"{I}{pc} = {u16()}")
     elif op_name == 'JT':
-        _a(f"{I}{pc} = {u16()} if {stk}.pop() else {pc} + 3")
+        _a(f"{I}{pc} = {u16()} if {stk}.pop() else {pc} + {3 + grow}")
     elif op_name == 'JF':
-        _a(f"{I}{pc} = {u16()} if not {stk}.pop() else {pc} + 3")
+        _a(f"{I}{pc} = {u16()} if not {stk}.pop() else {pc} + {3 + grow}")
     elif op_name == 'CALL_FUNC':
         _a(f"{I}{v['tmp']} = {u8()}")
         _a(f"{I}if {v['tmp']}: {v['val']} = {stk}[-{v['tmp']}:]; del {stk}[-{v['tmp']}:]")
         _a(f"{I}else: {v['val']} = []")
         _a(f"{I}{stk}.append({stk}.pop()(*{v['val']})); {pc} += 2")
     elif op_name == 'CALL_METHOD':
-        _a(f"{I}{v['tmp']} = {code}[{pc}+2]")
+        _a(f"{I}{v['tmp']} = {u8b()}")
         _a(f"{I}{v['val']} = [{stk}.pop() for _ in range({v['tmp']})][::-1]")
-        _a(f"{I}{stk}.append(getattr({stk}.pop(), {names}[{code}[{pc}+1]])(*{v['val']})); {pc} += 3")
+        _a(f"{I}{stk}.append(getattr({stk}.pop(), {names}[{u8()}])(*{v['val']})); {pc} += 3")
     elif op_name == 'LOAD_ATTR':
         _a(f"{I}{stk}.append(getattr({stk}.pop(), {names}[{u8()}])); {pc} += 2")
     elif op_name == 'STORE_ATTR':
@@ -801,7 +1110,7 @@ def _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, nam
     elif op_name == 'ITER_NEXT':
         _a(f"{I}{v['val']} = next({stk}[-1], None)")
         _a(f"{I}if {v['val']} is None: {stk}.pop(); {pc} = {u16()}")
-        _a(f"{I}else: {stk}.append({v['val']}); {pc} += 3")
+        _a(f"{I}else: {stk}.append({v['val']}); {pc} += {3 + grow}")
     elif op_name == 'RET':
         _a(f"{I}return {stk}.pop()")
     elif op_name == 'HALT':
@@ -817,35 +1126,28 @@ def _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, nam
     elif op_name == 'VM_YIELD':
         _a(f"{I}{pc} += 1; break")
     elif op_name == 'REG_LOAD':
-        _a(f"{I}{regs}[{code}[{pc}+1]] = {loc}[{code}[{pc}+2]]; {pc} += 3")
+        _a(f"{I}{regs}[{u8()}] = {loc}[{u8b()}]; {pc} += 3")
     elif op_name == 'REG_STORE':
-        _a(f"{I}{loc}[{code}[{pc}+2]] = {regs}[{code}[{pc}+1]]; {pc} += 3")
+        _a(f"{I}{loc}[{u8b()}] = {regs}[{u8()}]; {pc} += 3")
     elif op_name == 'REG_PUSH':
         _a(f"{I}{stk}.append({regs}[{u8()}]); {pc} += 2")
     elif op_name == 'REG_POP':
         _a(f"{I}{regs}[{u8()}] = {stk}.pop(); {pc} += 2")
     elif op_name == 'REG_MOV':
-        _a(f"{I}{regs}[{code}[{pc}+1]] = {regs}[{code}[{pc}+2]]; {pc} += 3")
+        _a(f"{I}{regs}[{u8()}] = {regs}[{u8b()}]; {pc} += 3")
     elif op_name == 'REG_ADD':
-        _a(f"{I}{regs}[{code}[{pc}+1]] = {regs}[{code}[{pc}+1]] + {regs}[{code}[{pc}+2]]; {pc} += 3")
+        _a(f"{I}{regs}[{u8()}] = {regs}[{u8()}] + {regs}[{u8b()}]; {pc} += 3")
     elif op_name == 'REG_SUB':
-        _a(f"{I}{regs}[{code}[{pc}+1]] = {regs}[{code}[{pc}+1]] - {regs}[{code}[{pc}+2]]; {pc} += 3")
-    elif op_name in ('LOAD_ADD', 'LOAD_SUB'):
-        py_op = '+' if op_name == 'LOAD_ADD' else '-'
-        _a(f"{I}{stk}.append({loc}[{u8()}]); {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} {py_op} {v['b']}); {pc} += 2")
-    elif op_name == 'PUSH_STORE':
-        _a(f"{I}{loc}[{code}[{pc}+2]] = {consts}[{code}[{pc}+1]]; {pc} += 3")
-    elif op_name == 'LOAD2':
-        _a(f"{I}{stk}.append({loc}[{code}[{pc}+1]]); {stk}.append({loc}[{code}[{pc}+2]]); {pc} += 3")
-    elif op_name == 'DUP_STORE':
-        _a(f"{I}{stk}.append({stk}[-1]); {loc}[{u8()}] = {stk}.pop(); {pc} += 2")
-    elif op_name == 'LOAD_CMP':
-        _a(f"{I}{stk}.append({loc}[{u8()}]); {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} < {v['b']}); {pc} += 2")
+        _a(f"{I}{regs}[{u8()}] = {regs}[{u8()}] - {regs}[{u8b()}]; {pc} += 3")
+    elif op_name == 'REG_CONST':
+        _a(f"{I}{regs}[{u8()}] = {consts}[{u8b()}]; {pc} += 3")
+    elif op_name in REG3_OPS:
+        _a(f"{I}{regs}[{u8()}] = {regs}[{u8b()}] {_PY_BINOPS[op_name[5:]]} {regs}[{u8c()}]; {pc} += 4")
     elif op_name == 'NOP':
         _a(f"{I}{pc} += 1")
     elif op_name == 'SETUP_EXCEPT':
         eh_var = regs.replace('_regs', '_eh')
-        _a(f"{I}{eh_var}.append({code}[{pc}+1] | ({code}[{pc}+2] << 8)); {pc} += 3")
+        _a(f"{I}{eh_var}.append({u16()}); {pc} += 3")
     elif op_name == 'POP_EXCEPT':
         eh_var = regs.replace('_regs', '_eh')
         _a(f"{I}{eh_var}.pop(); {pc} += 1")
@@ -856,149 +1158,9 @@ def _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, nam
 
 
 def _emit_handlers(lines, v, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, op_defs, uid):
-    _a = lines.append
-
-    def u8():
-        return f"{code}[{pc}+1]"
-    def u16():
-        return f"({code}[{pc}+1] | ({code}[{pc}+2] << 8))"
-
     first = True
     for op_name, op_val in sorted(op_defs.items(), key=lambda x: x[1]):
         kw = 'if' if first else 'elif'
         first = False
-        _a(f"                {kw} {v['op']} == {op_val}:")
-
-        if op_name == 'PUSH_CONST':
-            _a(f"                    {stk}.append({consts}[{u8()}]); {pc} += 2")
-        elif op_name == 'LOAD_LOCAL':
-            _a(f"                    {stk}.append({loc}[{u8()}]); {pc} += 2")
-        elif op_name == 'STORE_LOCAL':
-            _a(f"                    {loc}[{u8()}] = {stk}.pop(); {pc} += 2")
-        elif op_name == 'LOAD_GLOBAL':
-            _a(f"                    {stk}.append({gl}[{names}[{u8()}]]); {pc} += 2")
-        elif op_name == 'STORE_GLOBAL':
-            _a(f"                    {gl}[{names}[{u8()}]] = {stk}.pop(); {pc} += 2")
-        elif op_name == 'DUP':
-            _a(f"                    {stk}.append({stk}[-1]); {pc} += 1")
-        elif op_name == 'POP':
-            _a(f"                    {stk}.pop(); {pc} += 1")
-        elif op_name == 'ROT2':
-            _a(f"                    {stk}[-1], {stk}[-2] = {stk}[-2], {stk}[-1]; {pc} += 1")
-        elif op_name in ('ADD', 'SUB', 'MUL', 'MOD', 'FLOORDIV', 'POW',
-                          'BITXOR', 'BITAND', 'BITOR', 'LSHIFT', 'RSHIFT'):
-            py_op = {'ADD':'+','SUB':'-','MUL':'*','MOD':'%','FLOORDIV':'//','POW':'**',
-                      'BITXOR':'^','BITAND':'&','BITOR':'|','LSHIFT':'<<','RSHIFT':'>>'}[op_name]
-            _a(f"                    {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} {py_op} {v['b']}); {pc} += 1")
-        elif op_name == 'NEG':
-            _a(f"                    {stk}.append(-{stk}.pop()); {pc} += 1")
-        elif op_name == 'INVERT':
-            _a(f"                    {stk}.append(~{stk}.pop()); {pc} += 1")
-        elif op_name == 'BOOL_NOT':
-            _a(f"                    {stk}.append(not {stk}.pop()); {pc} += 1")
-        elif op_name in ('CMP_EQ','CMP_NE','CMP_LT','CMP_GT','CMP_LE','CMP_GE','CMP_IS','CMP_ISNOT','CMP_IN'):
-            py_op = {'CMP_EQ':'==','CMP_NE':'!=','CMP_LT':'<','CMP_GT':'>',
-                      'CMP_LE':'<=','CMP_GE':'>=','CMP_IS':'is','CMP_ISNOT':'is not','CMP_IN':'in'}[op_name]
-            _a(f"                    {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} {py_op} {v['b']}); {pc} += 1")
-        elif op_name == 'JMP':
-            _a(f"                    {pc} = {u16()}")
-        elif op_name == 'JT':
-            _a(f"                    {pc} = {u16()} if {stk}.pop() else {pc} + 3")
-        elif op_name == 'JF':
-            _a(f"                    {pc} = {u16()} if not {stk}.pop() else {pc} + 3")
-        elif op_name == 'CALL_FUNC':
-            _a(f"                    {v['tmp']} = {u8()}")
-            _a(f"                    if {v['tmp']}: {v['val']} = {stk}[-{v['tmp']}:]; del {stk}[-{v['tmp']}:]")
-            _a(f"                    else: {v['val']} = []")
-            _a(f"                    {stk}.append({stk}.pop()(*{v['val']})); {pc} += 2")
-        elif op_name == 'CALL_METHOD':
-            _a(f"                    {v['tmp']} = {code}[{pc}+2]")
-            _a(f"                    {v['val']} = [{stk}.pop() for _ in range({v['tmp']})][::-1]")
-            _a(f"                    {stk}.append(getattr({stk}.pop(), {names}[{code}[{pc}+1]])(*{v['val']})); {pc} += 3")
-        elif op_name == 'LOAD_ATTR':
-            _a(f"                    {stk}.append(getattr({stk}.pop(), {names}[{u8()}])); {pc} += 2")
-        elif op_name == 'STORE_ATTR':
-            _a(f"                    {v['val']} = {stk}.pop(); setattr({stk}.pop(), {names}[{u8()}], {v['val']}); {pc} += 2")
-        elif op_name == 'BUILD_LIST':
-            _a(f"                    {v['tmp']} = {u8()}")
-            _a(f"                    if {v['tmp']}: {v['val']} = {stk}[-{v['tmp']}:]; del {stk}[-{v['tmp']}:]")
-            _a(f"                    else: {v['val']} = []")
-            _a(f"                    {stk}.append({v['val']}); {pc} += 2")
-        elif op_name == 'BUILD_TUPLE':
-            _a(f"                    {v['tmp']} = {u8()}")
-            _a(f"                    if {v['tmp']}: {v['val']} = tuple({stk}[-{v['tmp']}:]); del {stk}[-{v['tmp']}:]")
-            _a(f"                    else: {v['val']} = ()")
-            _a(f"                    {stk}.append({v['val']}); {pc} += 2")
-        elif op_name == 'BUILD_DICT':
-            _a(f"                    {v['tmp']} = {u8()}")
-            _a(f"                    {v['val']} = {{}}")
-            _a(f"                    for _ in range({v['tmp']}): {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {v['val']}[{v['a']}] = {v['b']}")
-            _a(f"                    {stk}.append({v['val']}); {pc} += 2")
-        elif op_name == 'SUBSCRIPT':
-            _a(f"                    {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']}[{v['b']}]); {pc} += 1")
-        elif op_name == 'STORE_SUBSCRIPT':
-            _a(f"                    {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {v['val']} = {stk}.pop(); {v['a']}[{v['b']}] = {v['val']}; {pc} += 1")
-        elif op_name == 'UNPACK':
-            _a(f"                    {v['val']} = list({stk}.pop())[:{u8()}]; {stk}.extend(reversed({v['val']})); {pc} += 2")
-        elif op_name == 'BUILD_SLICE':
-            _a(f"                    {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append(slice({v['a']}, {v['b']})); {pc} += 1")
-        elif op_name == 'ITER_NEW':
-            _a(f"                    {stk}.append(iter({stk}.pop())); {pc} += 1")
-        elif op_name == 'ITER_NEXT':
-            _a(f"                    {v['val']} = next({stk}[-1], None)")
-            _a(f"                    if {v['val']} is None: {stk}.pop(); {pc} = {u16()}")
-            _a(f"                    else: {stk}.append({v['val']}); {pc} += 3")
-        elif op_name == 'RET':
-            _a(f"                    return {stk}.pop()")
-        elif op_name == 'HALT':
-            _a(f"                    return {stk}[-1] if {stk} else None")
-        #
-        elif op_name == 'XFER_PUSH_SHARED':
-            _a(f"                    {shared}[{u8()}].append({stk}.pop()); {pc} += 2")
-        elif op_name == 'XFER_POP_SHARED':
-            _a(f"                    {stk}.append({shared}[{u8()}].pop()); {pc} += 2")
-        elif op_name == 'XFER_STORE_GREG':
-            _a(f"                    {gregs}[{u8()}] = {stk}.pop(); {pc} += 2")
-        elif op_name == 'XFER_LOAD_GREG':
-            _a(f"                    {stk}.append({gregs}[{u8()}]); {pc} += 2")
-        elif op_name == 'VM_YIELD':
-            _a(f"                    {pc} += 1; break")
-        #
-        elif op_name == 'REG_LOAD':
-            _a(f"                    {regs}[{code}[{pc}+1]] = {loc}[{code}[{pc}+2]]; {pc} += 3")
-        elif op_name == 'REG_STORE':
-            _a(f"                    {loc}[{code}[{pc}+2]] = {regs}[{code}[{pc}+1]]; {pc} += 3")
-        elif op_name == 'REG_PUSH':
-            _a(f"                    {stk}.append({regs}[{u8()}]); {pc} += 2")
-        elif op_name == 'REG_POP':
-            _a(f"                    {regs}[{u8()}] = {stk}.pop(); {pc} += 2")
-        elif op_name == 'REG_MOV':
-            _a(f"                    {regs}[{code}[{pc}+1]] = {regs}[{code}[{pc}+2]]; {pc} += 3")
-        elif op_name == 'REG_ADD':
-            _a(f"                    {regs}[{code}[{pc}+1]] = {regs}[{code}[{pc}+1]] + {regs}[{code}[{pc}+2]]; {pc} += 3")
-        elif op_name == 'REG_SUB':
-            _a(f"                    {regs}[{code}[{pc}+1]] = {regs}[{code}[{pc}+1]] - {regs}[{code}[{pc}+2]]; {pc} += 3")
-        elif op_name == 'LOAD_ADD':
-            _a(f"                    {stk}.append({loc}[{u8()}]); {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} + {v['b']}); {pc} += 2")
-        elif op_name == 'LOAD_SUB':
-            _a(f"                    {stk}.append({loc}[{u8()}]); {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} - {v['b']}); {pc} += 2")
-        elif op_name == 'PUSH_STORE':
-            _a(f"                    {loc}[{code}[{pc}+2]] = {consts}[{code}[{pc}+1]]; {pc} += 3")
-        elif op_name == 'LOAD2':
-            _a(f"                    {stk}.append({loc}[{code}[{pc}+1]]); {stk}.append({loc}[{code}[{pc}+2]]); {pc} += 3")
-        elif op_name == 'DUP_STORE':
-            _a(f"                    {stk}.append({stk}[-1]); {loc}[{u8()}] = {stk}.pop(); {pc} += 2")
-        elif op_name == 'LOAD_CMP':
-            _a(f"                    {stk}.append({loc}[{u8()}]); {v['b']} = {stk}.pop(); {v['a']} = {stk}.pop(); {stk}.append({v['a']} < {v['b']}); {pc} += 2")
-        elif op_name == 'NOP':
-            _a(f"                    {pc} += 1")
-        elif op_name == 'SETUP_EXCEPT':
-            eh_var = regs.replace('_regs', '_eh')
-            _a(f"                    {eh_var}.append({code}[{pc}+1] | ({code}[{pc}+2] << 8)); {pc} += 3")
-        elif op_name == 'POP_EXCEPT':
-            eh_var = regs.replace('_regs', '_eh')
-            _a(f"                    {eh_var}.pop(); {pc} += 1")
-        elif op_name == 'MORPH':
-            _a(f"                    {v['tmp']} = {code}[{pc}+1] | ({code}[{pc}+2] << 8); {code}[{v['tmp']}] ^= {code}[{pc}+3]; {pc} += 4")
-        else:
-            _a(f"                    {pc} += 1")
+        lines.append(f"                {kw} {v['op']} == {op_val}:")
+        _gen_single_handler(lines, v, op_name, code, stk, pc, regs, loc, consts, names, gl, shared, gregs, uid)
@@ -0,0 +1,484 @@
+import math
+import operator
+
+from vm_isa import instr_size
+from vm_compiler import POOL_LIMIT, const_index
+
+# ops that end a basic block, and those that never fall through
+_JUMPS = {'JMP', 'JT', 'JF', 'ITER_NEXT', 'SETUP_EXCEPT'}
+_EXITS = {'JMP', 'RET', 'HALT'}
+
+_BINARY = {
+    'ADD': operator.add, 'SUB': operator.sub, 'MUL': operator.mul, 'MOD': operator.mod,
+    'FLOORDIV': operator.floordiv, 'POW': operator.pow,
+    'BITXOR': operator.xor, 'BITAND': operator.and_, 'BITOR': operator.or_,
+    'LSHIFT': operator.lshift, 'RSHIFT': operator.rshift,
+    'CMP_EQ': operator.eq, 'CMP_NE': operator.ne, 'CMP_LT': operator.lt,
+    'CMP_GT': operator.gt, 'CMP_LE': operator.le, 'CMP_GE': operator.ge,
+}
+_UNARY = {'NEG': operator.neg, 'INVERT': operator.invert, 'BOOL_NOT': operator.not_}
+# pushes with no side effect, dropped by a following POP
+_PURE_PUSH = {'PUSH_CONST', 'LOAD_LOCAL', 'DUP'}
+
+MAX_ROUNDS = 8
+
+
+class BasicBlock:
+    def __init__(self, labels, instrs):
+        self.labels = labels
+        self.instrs = instrs
+        self.succs = []
+
+
+def build_cfg(ir):
+    """Basic blocks of `ir`, entry first; `succs` are block indices.
+
+    A block starts at a label and ends after a branch, RET or HALT.
+    SETUP_EXCEPT ends a block too, with its handler as a successor.
+    """
+    blocks = []
+    labels = []
+    instrs = []
+    for instr in ir:
+        if instr[0] == 'LABEL':
+            if instrs:
+                blocks.append(BasicBlock(labels, instrs))
+                labels, instrs = [], []
+            labels.append(instr[1])
+            continue
+        instrs.append(instr)
+        if instr[0] in _JUMPS or instr[0] in _EXITS:
+            blocks.append(BasicBlock(labels, instrs))
+            labels, instrs = [], []
+    if labels or instrs:
+        blocks.append(BasicBlock(labels, instrs))
+
+    index = {label: i for i, block in enumerate(blocks) for label in block.labels}
+    for i, block in enumerate(blocks):
+        last = block.instrs[-1] if block.instrs else ('LABEL',)
+        if last[0] in _JUMPS:
+            block.succs.append(index[last[1]])
+        if last[0] not in _EXITS and i + 1 < len(blocks):
+            block.succs.append(i + 1)
+    return blocks
+
+
+def flatten(blocks):
+    ir = []
+    for block in blocks:
+        ir.extend(('LABEL', label) for label in block.labels)
+        ir.extend(block.instrs)
+    return ir
+
+
+def code_size(ir):
+    """Encoded bytes of `ir`; labels take none."""
+    return sum(instr_size(instr) for instr in ir if instr[0] != 'LABEL')
+
+
+def live_locals(blocks):
+    """Local slots live on exit from each block."""
+    uses = []
+    defs = []
+    for block in blocks:
+        use, kill = set(), set()
+        for instr in block.instrs:
+            if instr[0] == 'LOAD_LOCAL' and instr[1] not in kill:
+                use.add(instr[1])
+            elif instr[0] == 'STORE_LOCAL':
+                kill.add(instr[1])
+        uses.append(use)
+        defs.append(kill)
+    live_in = [set() for _ in blocks]
+    live_out = [set() for _ in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(blocks) - 1, -1, -1):
+            out = set()
+            for succ in blocks[i].succs:
+                out |= live_in[succ]
+            new_in = uses[i] | (out - defs[i])
+            if out != live_out[i] or new_in != live_in[i]:
+                live_out[i], live_in[i] = out, new_in
+                changed = True
+    return live_out
+
+
+def _const_index(constants, ids, value):
+    # VMCompiler.add_const's pool; None once it is full
+    if len(constants) < POOL_LIMIT:
+        return const_index(constants, ids, value)
+    try:
+        return ids.get((type(value), value))
+    except TypeError:
+        return None
+
+
+def _fold(op, args):
+    if not all(type(a) in (int, float, bool) for a in args):
+        return None
+    # keep folding cheap and the constant pool small and repr-able
+    if op == 'POW' and not (isinstance(args[1], int) and 0 <= args[1] <= 64):
+        return None
+    if op == 'LSHIFT' and isinstance(args[1], int) and args[1] > 128:
+        return None
+    try:
+        value = (_UNARY[op] if len(args) == 1 else _BINARY[op])(*args)
+    except (ArithmeticError, TypeError, ValueError):
+        # raised at run time instead, as before
+        return None
+    # the pool keys floats by value, so -0.0 would share the slot of 0.0
+    if isinstance(value, float) and (not math.isfinite(value) or value == 0.0):
+        return None
+    if isinstance(value, int) and value.bit_length() > 256:
+        return None
+    return value
+
+
+def fold_constants(ir, constants):
+    """Evaluate operators over constants and branches on them; drop pushes that are popped."""
+    ids = {}
+    for i, c in enumerate(constants):
+        try:
+            ids.setdefault((type(c), c), i)
+        except TypeError:
+            pass
+    out = []
+    for instr in ir:
+        op = instr[0]
+        if op in _BINARY and len(out) >= 2 and out[-1][0] == out[-2][0] == 'PUSH_CONST':
+            value = _fold(op, (constants[out[-2][1]], constants[out[-1][1]]))
+            idx = None if value is None else _const_index(constants, ids, value)
+            if idx is not None:
+                out[-2:] = [('PUSH_CONST', idx)]
+                continue
+        elif op in _UNARY and out and out[-1][0] == 'PUSH_CONST':
+            value = _fold(op, (constants[out[-1][1]],))
+            idx = None if value is None else _const_index(constants, ids, value)
+            if idx is not None:
+                out[-1] = ('PUSH_CONST', idx)
+                continue
+        elif op in ('JT', 'JF') and out and out[-1][0] == 'PUSH_CONST':
+            taken = bool(constants[out.pop()[1]]) == (op == 'JT')
+            if taken:
+                out.append(('JMP', instr[1]))
+            continue
+        elif op == 'POP' and out and out[-1][0] in _PURE_PUSH:
+            out.pop()
+            continue
+        out.append(instr)
+    return out
+
+
+def _known_test(ir, i):
+    # DUP; Jc L; POP: the value reaching L is known truthy (JT) or falsy (JF)
+    return (ir[i][0] in ('JT', 'JF') and 0 < i < len(ir) - 1
+            and ir[i - 1] == ('DUP',) and ir[i + 1] == ('POP',))
+
+
+def _falls_to(ir, i, label):
+    # whether `label` is placed among the labels starting at i
+    while i < len(ir) and ir[i][0] == 'LABEL':
+        if ir[i][1] == label:
+            return True
+        i += 1
+    return False
+
+
+def thread_jumps(ir, constants=None):
+    """Retarget branches that land on a JMP or on a test of the value they just tested.
+
+    `a and b` leaves DUP; JF end; POP, and `end:` often tests the same value
+    again (`if a and b:`); its outcome is known, so the first branch goes
+    straight to where the second one would. Jumps to the next instruction
+    are dropped.
+    """
+    ir = list(ir)
+    starts = {}
+    for i in range(len(ir) - 1, -1, -1):
+        if ir[i][0] == 'LABEL':
+            starts[ir[i][1]] = starts.get(ir[i + 1][1], i + 1) if ir[i + 1][0] == 'LABEL' else i + 1
+    # dropped instructions stay as None until the end, so indices hold
+    new_labels = {}
+
+    def head(label, n):
+        i = starts[label]
+        found = []
+        while i < len(ir) and len(found) < n:
+            if ir[i] is not None and ir[i][0] != 'LABEL':
+                found.append((i, ir[i]))
+            i += 1
+        return found
+
+    def label_at(i):
+        if ir[i - 1][0] == 'LABEL':
+            return ir[i - 1][1]
+        if i not in new_labels:
+            new_labels[i] = f'__T{len(starts)}'
+            while new_labels[i] in starts:
+                new_labels[i] += '_'
+            starts[new_labels[i]] = i
+        return new_labels[i]
+
+    for i, instr in enumerate(ir):
+        if instr is None or instr[0] not in ('JMP', 'JT', 'JF', 'ITER_NEXT'):
+            continue
+        op = instr[0]
+        known = _known_test(ir, i)
+        target = instr[1]
+        seen = set()
+        while target not in seen:
+            seen.add(target)
+            first = head(target, 3)
+            ops = [x[0] for _, x in first]
+            if ops[:1] == ['JMP']:
+                target = first[0][1][1]
+                continue
+            if not known:
+                break
+            if ops[:1] in (['JT'], ['JF']):
+                # L: Jd M, which pops the value
+                (j, tested), = first[:1]
+                after = j + 1
+                consumed = True
+            elif len(ops) == 3 and ops[0] == 'DUP' and ops[1] in ('JT', 'JF') and ops[2] == 'POP':
+                # L: DUP; Jd M; POP
+                tested = first[1][1]
+                after = first[2][0] + 1
+                consumed = False
+            else:
+                break
+            if tested[0] == op and not consumed:
+                target = tested[1]
+                continue
+            # the value is tested here instead of at L
+            ir[i - 1] = ir[i + 1] = None
+            known = False
+            target = tested[1] if tested[0] == op else label_at(after)
+        ir[i] = (op, target) + instr[2:]
+
+    out = []
+    for i, instr in enumerate(ir):
+        if i in new_labels:
+            out.append(('LABEL', new_labels[i]))
+        if instr is not None:
+            out.append(instr)
+    result = []
+    for i, instr in enumerate(out):
+        if instr[0] in ('JMP', 'JT', 'JF') and _falls_to(out, i + 1, instr[1]):
+            # a jump to the next instruction
+            if instr[0] != 'JMP':
+                result.append(('POP',))
+            continue
+        if (instr[0] in ('JT', 'JF') and i + 1 < len(out) and out[i + 1][0] == 'JMP'
+                and _falls_to(out, i + 2, instr[1])):
+            # Jc L; JMP M; L: becomes J(not c) M
+            result.append(('JF' if instr[0] == 'JT' else 'JT', out[i + 1][1]))
+            out[i + 1] = ('LABEL', None)
+            continue
+        if instr != ('LABEL', None):
+            result.append(instr)
+    return result
+
+
+def eliminate_dead_code(ir, constants=None):
+    """Drop blocks no path reaches and labels no branch names."""
+    blocks = build_cfg(ir)
+    reached = {0} if blocks else set()
+    work = list(reached)
+    while work:
+        for succ in blocks[work.pop()].succs:
+            if succ not in reached:
+                reached.add(succ)
+                work.append(succ)
+    ir = flatten(block for i, block in enumerate(blocks) if i in reached)
+    targets = {instr[1] for instr in ir if instr[0] in _JUMPS}
+    return [instr for instr in ir if instr[0] != 'LABEL' or instr[1] in targets]
+
+
+def forward_stores(ir, constants=None):
+    """Copy propagation and store/load forwarding within blocks, then dead stores.
+
+    After `x = y` or `x = <const>`, loads of x in the same block read y or
+    the constant. STORE x; LOAD x with x dead afterwards leaves the value on
+    the stack; any other store nothing reads becomes a POP for
+    fold_constants to clean up.
+    """
+    blocks = build_cfg(ir)
+    for block in blocks:
+        known = {}
+        out = []
+        for instr in block.instrs:
+            op = instr[0]
+            if op == 'LOAD_LOCAL' and instr[1] in known:
+                instr = known[instr[1]]
+            if op == 'STORE_LOCAL':
+                slot = instr[1]
+                # a copy of slot is stale once slot changes
+                known = {k: src for k, src in known.items() if k != slot and src != ('LOAD_LOCAL', slot)}
+                if out and out[-1] == ('LOAD_LOCAL', slot):
+                    out.pop()
+                    continue
+                if out and out[-1][0] in ('LOAD_LOCAL', 'PUSH_CONST'):
+                    known[slot] = out[-1]
+            out.append(instr)
+        block.instrs = out
+
+    # a handler may read what the try body stored: keep every store there
+    if any(instr[0] == 'SETUP_EXCEPT' for instr in ir):
+        return flatten(blocks)
+    for block, live in zip(blocks, live_locals(blocks)):
+        live = set(live)
+        instrs = block.instrs
+        for j in range(len(instrs) - 1, -1, -1):
+            instr = instrs[j]
+            if instr[0] == 'STORE_LOCAL':
+                if j + 1 < len(instrs) and instrs[j + 1] == ('LOAD_LOCAL', instr[1]) and instr[1] not in after:
+                    instrs[j] = instrs[j + 1] = None
+                elif instr[1] not in live:
+                    instrs[j] = ('POP',)
+                live.discard(instr[1])
+            after = set(live)
+            if instr[0] == 'LOAD_LOCAL':
+                live.add(instr[1])
+        block.instrs = [instr for instr in instrs if instr is not None]
+    return flatten(blocks)
+
+
+PASSES = {
+    'fold': fold_constants,
+    'forward': forward_stores,
+    'thread': thread_jumps,
+    'dce': eliminate_dead_code,
+}
+IR_PASSES = tuple(PASSES)
+
+
+def optimize_ir(ir, constants, passes=IR_PASSES, stats=None):
+    """Run `passes` over `ir`, in order, until none of them changes it.
+
+    Folding may add entries to `constants`. Pass a dict as `stats` to
+    collect the bytes each pass saved.
+    """
+    for name in passes:
+        if name not in PASSES:
+            raise ValueError(f'unknown IR pass: {name}')
+    for _ in range(MAX_ROUNDS):
+        changed = False
+        for name in passes:
+            new_ir = PASSES[name](ir, constants)
+            if new_ir != ir:
+                changed = True
+                if stats is not None:
+                    stats[name] = stats.get(name, 0) + code_size(ir) - code_size(new_ir)
+                ir = new_ir
+        if not changed:
+            break
+    return ir
+
+
+if __name__ == '__main__':
+    import ast
+    from vm_compiler import VMCompiler
+
+    def compile_ir(src):
+        result = VMCompiler().compile_function(ast.parse(src).body[0])
+        return result.ir, result.constants
+
+    def run(ir, constants, args):
+        # a small reference interpreter for the ops these tests use
+        labels = {instr[1]: i for i, instr in enumerate(ir) if instr[0] == 'LABEL'}
+        loc = list(args) + [None] * 16
+        stk = []
+        pc = 0
+        steps = 0
+        while True:
+            op, *a = ir[pc]
+            pc += 1
+            if op != 'LABEL':
+                steps += 1
+            if op == 'PUSH_CONST':
+                stk.append(constants[a[0]])
+            elif op == 'LOAD_LOCAL':
+                stk.append(loc[a[0]])
+            elif op == 'STORE_LOCAL':
+                loc[a[0]] = stk.pop()
+            elif op == 'DUP':
+                stk.append(stk[-1])
+            elif op == 'POP':
+                stk.pop()
+            elif op in _BINARY:
+                b = stk.pop()
+                stk.append(_BINARY[op](stk.pop(), b))
+            elif op in _UNARY:
+                stk.append(_UNARY[op](stk.pop()))
+            elif op == 'JMP':
+                pc = labels[a[0]]
+            elif op in ('JT', 'JF'):
+                if bool(stk.pop()) == (op == 'JT'):
+                    pc = labels[a[0]]
+            elif op == 'RET':
+                return stk.pop(), steps
+
+    src = '''def f(a, b):
+    k = 3 * 4 + 1
+    c = a
+    if a > 0 and b > 0:
+        r = c + k
+    elif a < 0 or b < 0:
+        r = c - k
+    else:
+        r = 0
+    while True:
+        if r > 100 or r < -100:
+            break
+        r = r * 2 + 1
+    return r
+    return 0'''
+    ir, constants = compile_ir(src)
+    stats = {}
+    opt = optimize_ir(list(ir), list(constants), stats=stats)
+    opt_consts = list(constants)
+    opt = optimize_ir(list(ir), opt_consts)
+    print(f'size: {code_size(ir)} -> {code_size(opt)} bytes, per pass {stats}')
+    assert code_size(opt) < code_size(ir)
+    for args in [(1, 1), (1, -1), (-1, 5), (0, 0), (5, 0), (0, -3), (200, 1)]:
+        want, n_before = run(ir, constants, args)
+        got, n_after = run(opt, opt_consts, args)
+        assert got == want, (args, got, want)
+        assert n_after <= n_before, (args, n_after, n_before)
+    print(f'dispatched for (1, 1): {run(ir, constants, (1, 1))[1]} -> {run(opt, opt_consts, (1, 1))[1]}')
+
+    # 3 * 4 + 1 is one constant, the while True test is gone
+    assert ('PUSH_CONST', opt_consts.index(13)) in opt
+    assert not any(instr[0] == 'PUSH_CONST' and opt_consts[instr[1]] is True for instr in opt)
+    # a second return is unreachable
+    assert sum(instr[0] == 'RET' for instr in opt) == 1
+
+    # copies and single-use stores vanish
+    ir, constants = compile_ir('def f(a):\n    x = a\n    y = x * 2\n    return y')
+    opt = optimize_ir(ir, constants, passes=('forward', 'fold'))
+    assert opt == [('LOAD_LOCAL', 0), ('PUSH_CONST', constants.index(2)), ('MUL',), ('RET',)], opt
+
+    # folding leaves what would raise for run time
+    div = [('PUSH_CONST', 0), ('PUSH_CONST', 1), ('FLOORDIV',)]
+    assert fold_constants(div, [1, 0]) == div
+    # and float zeros, whose sign the constant pool does not keep
+    for src in ('def f():\n    x = -0.0\n    return x', 'def f():\n    return 0.0 * -1.0',
+                'def f():\n    return 0.0 + -0.0'):
+        ir, constants = compile_ir(src)
+        opt_consts = list(constants)
+        opt = optimize_ir(list(ir), opt_consts)
+        assert math.copysign(1, run(opt, opt_consts, ())[0]) == math.copysign(1, run(ir, constants, ())[0]), src
+
+    # each pass can be switched off
+    assert optimize_ir(list(ir), list(constants), passes=()) == ir
+    try:
+        optimize_ir(ir, constants, passes=('nope',))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('unknown pass accepted')
+
+    print('all optimizer tests passed')
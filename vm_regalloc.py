@@ -0,0 +1,246 @@
+from vm_compound import loop_weights
+from vm_isa import STACK_ONLY, HYBRID, REG3_BASE_OPS
+
+N_REGS = 8
+# registers kept free for expression temporaries
+N_TEMPS = 2
+
+_JUMPS = {'JMP', 'JT', 'JF', 'ITER_NEXT'}
+
+
+def _regions(seg):
+    # a VM segment is one region per dispatch entry, each ending in VM_YIELD
+    regions = []
+    current = []
+    for instr in seg:
+        current.append(instr)
+        if instr[0] == 'VM_YIELD':
+            regions.append(current)
+            current = []
+    if current:
+        regions.append(current)
+    return regions
+
+
+def live_in(region, live_out):
+    """Local slots live on entry to `region`, given the slots live after its VM_YIELD."""
+    labels = {instr[1]: i for i, instr in enumerate(region) if instr[0] == 'LABEL'}
+    live = [set() for _ in range(len(region) + 1)]
+    live[len(region)] = set(live_out)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(region) - 1, -1, -1):
+            instr = region[i]
+            op = instr[0]
+            if op in ('RET', 'HALT'):
+                out = set()
+            elif op == 'VM_YIELD':
+                out = set(live_out)
+            else:
+                out = set(live[i + 1]) if op != 'JMP' else set()
+                if op in _JUMPS:
+                    out |= live[labels[instr[1]]] if instr[1] in labels else live_out
+            if op == 'STORE_LOCAL':
+                out.discard(instr[1])
+            elif op == 'LOAD_LOCAL':
+                out.add(instr[1])
+            if out != live[i]:
+                live[i] = out
+                changed = True
+    return live[0]
+
+
+def _allocate(region, vm_type, rng):
+    # hot locals and loop-invariant constants, by loop-weighted use count
+    weights = loop_weights(region)
+    uses = {}
+    for instr, w in zip(region, weights):
+        if instr[0] in ('LOAD_LOCAL', 'STORE_LOCAL'):
+            uses[('local', instr[1])] = uses.get(('local', instr[1]), 0) + w
+        elif instr[0] == 'PUSH_CONST':
+            uses[('const', instr[1])] = uses.get(('const', instr[1]), 0) + w
+    # a constant costs a load, so it only pays off inside a loop; HYBRID VMs
+    # keep straight-line code on the stack
+    min_local = 8 if vm_type == HYBRID else 3
+    hot = [key for key, w in uses.items() if w >= (min_local if key[0] == 'local' else 8)]
+    hot.sort(key=lambda key: (-uses[key], key))
+    regs = rng.sample(range(N_REGS), N_REGS)
+    hot = hot[:N_REGS - N_TEMPS]
+    return dict(zip(hot, regs)), regs[len(hot):]
+
+
+class _RegionLowering:
+    """Rewrite one region's stack code into register code.
+
+    LOAD_LOCAL/PUSH_CONST of an allocated value push a virtual entry instead
+    of touching the stack; a binary op over two virtual entries becomes a
+    pending REG3 instruction that is written straight into its destination
+    register on the following store. Anything else flushes the virtual
+    entries onto the real stack first.
+    """
+
+    def __init__(self, alloc, temps):
+        self.alloc = alloc
+        self.temps = list(temps)
+        self.temp_set = set(temps)
+        self.out = []
+        self.vstack = []
+
+    def _free(self, reg):
+        if reg in self.temp_set:
+            self.temps.append(reg)
+
+    def _refs(self, entry):
+        return (entry[1],) if entry[0] == 'reg' else entry[2:]
+
+    def _emit_expr(self, dst, entry):
+        _, op, a, b = entry
+        self._free(a)
+        self._free(b)
+        self.out.append((f'REG3_{op}', dst, a, b))
+
+    def to_reg(self, entry):
+        if entry[0] == 'reg':
+            return entry[1]
+        if not self.temps and not (set(entry[2:]) & self.temp_set):
+            return None
+        self._free(entry[2])
+        self._free(entry[3])
+        dst = self.temps.pop()
+        self.out.append((f'REG3_{entry[1]}', dst, entry[2], entry[3]))
+        return dst
+
+    def to_stack(self, entry):
+        reg = self.to_reg(entry)
+        if reg is None:
+            _, op, a, b = entry
+            self.out.extend([('REG_PUSH', a), ('REG_PUSH', b), (op,)])
+            self._free(a)
+            self._free(b)
+            return
+        self.out.append(('REG_PUSH', reg))
+        self._free(reg)
+
+    def flush(self):
+        for entry in self.vstack:
+            self.to_stack(entry)
+        self.vstack = []
+
+    def write_reg(self, dst, entry):
+        # pending entries must read dst before it changes
+        if any(dst in self._refs(e) for e in self.vstack):
+            self.flush()
+        if entry[0] == 'expr':
+            self._emit_expr(dst, entry)
+        elif entry[1] != dst:
+            self.out.append(('REG_MOV', dst, entry[1]))
+            self._free(entry[1])
+
+    def lower(self, instr):
+        op = instr[0]
+        vs = self.vstack
+        key = None
+        if op in ('LOAD_LOCAL', 'STORE_LOCAL'):
+            key = ('local', instr[1])
+        elif op == 'PUSH_CONST':
+            key = ('const', instr[1])
+
+        if op in ('LOAD_LOCAL', 'PUSH_CONST') and key in self.alloc:
+            vs.append(('reg', self.alloc[key]))
+        elif op == 'STORE_LOCAL' and key in self.alloc:
+            if vs:
+                self.write_reg(self.alloc[key], vs.pop())
+            else:
+                self.out.append(('REG_POP', self.alloc[key]))
+        elif op == 'STORE_LOCAL' and vs:
+            reg = self.to_reg(vs[-1])
+            if reg is None:
+                self.flush()
+                self.out.append(instr)
+            else:
+                vs.pop()
+                self.out.append(('REG_STORE', reg, instr[1]))
+                self._free(reg)
+        elif op in REG3_BASE_OPS and len(vs) >= 2:
+            ra = self.to_reg(vs[-2])
+            if ra is not None:
+                vs[-2] = ('reg', ra)
+            rb = self.to_reg(vs[-1]) if ra is not None else None
+            if rb is None:
+                self.flush()
+                self.out.append(instr)
+            else:
+                vs[-2:] = [('expr', op, ra, rb)]
+        elif op == 'DUP' and vs and vs[-1][0] == 'reg' and vs[-1][1] not in self.temp_set:
+            vs.append(vs[-1])
+        elif op == 'ROT2' and len(vs) >= 2:
+            vs[-1], vs[-2] = vs[-2], vs[-1]
+        elif op == 'POP' and vs and vs[-1][0] == 'reg':
+            self._free(vs.pop()[1])
+        else:
+            self.flush()
+            self.out.append(instr)
+
+
+def lower_region(region, vm_type, live_after, rng):
+    """Register code for one region of a REGISTER or HYBRID VM."""
+    if any(instr[0] in ('SETUP_EXCEPT', 'POP_EXCEPT') for instr in region):
+        return region
+    alloc, temps = _allocate(region, vm_type, rng)
+    if not alloc:
+        return region
+    stored = {instr[1] for instr in region if instr[0] == 'STORE_LOCAL'}
+    entry_live = live_in(region, live_after)
+    lowering = _RegionLowering(alloc, temps)
+    # a promoted local is loaded if it is read, or written back on exit
+    # (a conditional write must not store a stale register)
+    written_back = {slot for kind, slot in alloc if kind == 'local' and slot in stored and slot in live_after}
+    prologue = []
+    for (kind, idx), reg in sorted(alloc.items()):
+        if kind == 'const':
+            prologue.append(('REG_CONST', reg, idx))
+        elif idx in entry_live or idx in written_back:
+            prologue.append(('REG_LOAD', reg, idx))
+    for instr in region:
+        if instr[0] == 'VM_YIELD':
+            lowering.flush()
+            for (kind, idx), reg in sorted(alloc.items()):
+                if kind == 'local' and idx in written_back:
+                    lowering.out.append(('REG_STORE', reg, idx))
+            lowering.out.append(instr)
+        else:
+            lowering.lower(instr)
+    lowering.flush()
+    return prologue + lowering.out
+
+
+def lower_registers(segments, dispatch_order, vm_types, rng):
+    """Lower REGISTER and HYBRID segments to register code, region by region.
+
+    Each region (one dispatch entry) keeps its hot locals and constants in
+    registers: loaded on entry, written back before its VM_YIELD when a later
+    region may read them.
+    """
+    regions = [_regions(seg) for seg in segments]
+    # regions in execution order, to know what later regions read
+    order = []
+    taken = [0] * len(segments)
+    for vm_id, _ in dispatch_order:
+        if taken[vm_id] < len(regions[vm_id]):
+            order.append((vm_id, taken[vm_id]))
+            taken[vm_id] += 1
+    live_after = {}
+    later = set()
+    for vm_id, idx in reversed(order):
+        live_after[(vm_id, idx)] = set(later)
+        later |= {instr[1] for instr in regions[vm_id][idx] if instr[0] == 'LOAD_LOCAL'}
+
+    for vm_id, seg_regions in enumerate(regions):
+        if vm_types[vm_id] == STACK_ONLY:
+            continue
+        new_seg = []
+        for idx, region in enumerate(seg_regions):
+            # a region missing from the dispatch order never runs
+            new_seg.extend(lower_region(region, vm_types[vm_id], live_after.get((vm_id, idx), later), rng))
+        segments[vm_id] = new_seg
@@ -1,4 +1,6 @@
 import random
+from vm_compound import loop_weights
+from vm_regalloc import lower_registers
 
 STACK_ONLY = 0
 REGISTER = 1
@@ -36,6 +38,8 @@ class SplitResult:
         self.n_shared_stacks = 0
         self.n_global_regs = 0
         self.vm_types = []
+        # expected VM switches per call under the split's cost model
+        self.est_switches = 0.0
 
 
 def _stack_effect(instr):
@@ -58,27 +62,12 @@ def _stack_effect(instr):
     return STACK_EFFECTS.get(op, 0)
 
 
-def split_instructions(ir, n_vms, rng):
-    # find control flow targets (loops, branches — can't split these)
-    jump_targets = set()
-    for instr in ir:
-        if instr[0] in ('JMP', 'JF', 'JT', 'ITER_NEXT') and len(instr) > 1:
-            if isinstance(instr[1], str):
-                jump_targets.add(instr[1])
-
-    # identify safe regions: sequential code between control flow points
-    # unsafe = anything between a jump target LABEL and its back-edge JMP
-    in_control = 0
-    safe = []  # list of bools, one per instruction
-    for instr in ir:
-        if instr[0] == 'LABEL' and instr[1] in jump_targets:
-            in_control += 1
-        if instr[0] in ('JMP', 'JF', 'JT', 'RET', 'HALT') and in_control > 0:
-            safe.append(False)
-            in_control -= 1
-            continue
-        safe.append(in_control == 0)
+def split_instructions(ir, n_vms, rng, weights=None):
+    """Split `ir` over `n_vms` VMs, cutting where control passes least often.
 
+    `weights` is an execution count per IR instruction, e.g. from a profile;
+    without one, loop nesting depth stands in (see _assign_vms).
+    """
     vm_types = [rng.choice([STACK_ONLY, REGISTER, HYBRID]) for _ in range(n_vms)]
     vm_types[0] = STACK_ONLY
     if n_vms > 1:
@@ -87,13 +76,13 @@ def split_instructions(ir, n_vms, rng):
         vm_types[2] = HYBRID
 
     # block-level splitting at statement boundaries
-    segments, dispatch_order = _block_split(ir, n_vms, rng)
+    segments, dispatch_order, est_switches = _block_split(ir, n_vms, rng, weights)
 
     # insert cross-VM shared stack transfers at VM boundaries
     _insert_shared_transfers(segments, dispatch_order, n_vms, rng)
 
-    # rewrite segments for register-type VMs (ISA variety)
-    _rewrite_for_vm_types(segments, vm_types, rng)
+    # register-type VMs keep hot locals and constants in registers
+    lower_registers(segments, dispatch_order, vm_types, rng)
 
     # register/stack aliasing: link some register writes to global registers
     _insert_register_aliases(segments, vm_types, n_vms, rng)
@@ -104,6 +93,7 @@ def split_instructions(ir, n_vms, rng):
     result.n_shared_stacks = max(n_vms - 1, 1)
     result.n_global_regs = 4
     result.vm_types = vm_types
+    result.est_switches = est_switches
     return result
 
 
@@ -188,7 +178,8 @@ def _insert_shared_transfers(segments, dispatch_order, n_vms, rng):
         for i in range(b_start, min(b_end, b_start + 5)):
             if i >= len(seg_b):
                 break
-            if seg_b[i][0] in ('LABEL', 'XFER_POP_SHARED', 'POP'):
+            # not past a label: a load at a loop head runs again on every pass
+            if seg_b[i][0] in ('XFER_POP_SHARED', 'POP'):
                 continue
             if seg_b[i][0] == 'LOAD_LOCAL' and seg_b[i][1] == slot:
                 load_idx = i
@@ -209,40 +200,6 @@ def _insert_shared_transfers(segments, dispatch_order, n_vms, rng):
             seg_b[load_idx] = ('XFER_POP_SHARED', shared_id)
 
 
-def _rewrite_for_vm_types(segments, vm_types, rng):
-    """
-    Rewrite LOAD_LOCAL/STORE_LOCAL to register ops for register-type VMs.
-    This gives real ISA variety — register VMs use REG_LOAD/REG_PUSH instead of LOAD_LOCAL.
-    """
-    for vm_id, seg in enumerate(segments):
-        if vm_types[vm_id] == STACK_ONLY:
-            continue
-        # for REGISTER and HYBRID VMs, rewrite some LOAD_LOCAL → REG_LOAD + REG_PUSH
-        new_seg = []
-        reg_alloc = {}  # local_slot → register (0-7)
-        next_reg = 0
-        for instr in seg:
-            if instr[0] == 'LOAD_LOCAL' and rng.random() < 0.5 and next_reg < 8:
-                slot = instr[1]
-                if slot not in reg_alloc:
-                    reg_alloc[slot] = next_reg
-                    next_reg = min(next_reg + 1, 7)
-                reg = reg_alloc[slot]
-                new_seg.append(('REG_LOAD', reg, slot))
-                new_seg.append(('REG_PUSH', reg))
-            elif instr[0] == 'STORE_LOCAL' and rng.random() < 0.3 and next_reg < 8:
-                slot = instr[1]
-                if slot not in reg_alloc:
-                    reg_alloc[slot] = next_reg
-                    next_reg = min(next_reg + 1, 7)
-                reg = reg_alloc[slot]
-                new_seg.append(('REG_POP', reg))
-                new_seg.append(('REG_STORE', reg, slot))
-            else:
-                new_seg.append(instr)
-        segments[vm_id] = new_seg
-
-
 def _insert_register_aliases(segments, vm_types, n_vms, rng):
     """
     When a register-type VM writes to a register (REG_STORE), also write the value
@@ -270,15 +227,10 @@ def _insert_register_aliases(segments, vm_types, n_vms, rng):
 
 
 def _find_basic_blocks(ir):
-    jump_targets = set()
-    for instr in ir:
-        if instr[0] in ('JMP', 'JF', 'JT', 'ITER_NEXT') and len(instr) > 1:
-            if isinstance(instr[1], str):
-                jump_targets.add(instr[1])
+    # statement-sized blocks; _find_jump_constraints keeps control flow together
     blocks = []
     current = []
     depth = 0
-    in_control = 0
     for instr in ir:
         if instr[0] == 'LABEL':
             if current:
@@ -286,20 +238,15 @@ def _find_basic_blocks(ir):
                 current = []
                 depth = 0
             current.append(instr)
-            if instr[1] in jump_targets:
-                in_control += 1
         elif instr[0] in ('JMP', 'JF', 'JT', 'RET', 'HALT'):
             current.append(instr)
             blocks.append(current)
             current = []
             depth = 0
-            if in_control > 0:
-                in_control -= 1
         else:
             current.append(instr)
             depth += _stack_effect(instr)
-            if (in_control == 0 and depth <= 0
-                    and instr[0] in ('STORE_LOCAL', 'STORE_GLOBAL')
+            if (depth <= 0 and instr[0] in ('STORE_LOCAL', 'STORE_GLOBAL')
                     and len(current) >= 2):
                 blocks.append(current)
                 current = []
@@ -322,8 +269,11 @@ def _find_jump_constraints(blocks):
                 target = instr[1]
                 if isinstance(target, str) and target in label_to_block:
                     j = label_to_block[target]
-                    if i != j:
-                        constraints.append((i, j))
+                    # everything a jump spans runs in one VM: a segment only
+                    # holds its own blocks, so a loop body or a skipped branch
+                    # elsewhere would be jumped over or run out of order
+                    for k in range(min(i, j), max(i, j)):
+                        constraints.append((k, k + 1))
         last = block[-1] if block else None
         if last:
             if last[0] in ('JF', 'JT') and i + 1 < len(blocks):
@@ -358,17 +308,40 @@ def _merge_constrained(blocks, constraints):
     return groups
 
 
-def _assign_vms(groups, n_vms, rng):
-    group_list = sorted(groups.values(), key=lambda g: min(g))
-    assignments = {}
-    vm_idx = 0
-    for group in group_list:
-        if rng.random() < 0.3 and n_vms > 2:
-            vm_idx = (vm_idx + rng.randint(1, 2)) % n_vms
-        for block_idx in group:
-            assignments[block_idx] = vm_idx
-        vm_idx = (vm_idx + 1) % n_vms
-    return assignments
+def _assign_vms(groups, blocks, n_vms, rng, weights):
+    """One VM per run of groups, with the n_vms - 1 cheapest cuts between runs.
+
+    Every VM switch goes through the outer dispatcher (timing check,
+    heartbeat, locals check), so a cut costs how often control passes it:
+    the weight of the group it starts, relative to the function entry.
+    Jump spans are merged into groups, so loops never straddle a cut. Ties
+    are broken at random to keep the layout per build. The heaviest run
+    goes to the REGISTER VM. Returns (assignments, expected switches per call).
+    """
+    group_list = sorted(groups.values(), key=min)
+    starts = []
+    pos = 0
+    for block in blocks:
+        starts.append(pos)
+        pos += len(block)
+    entry = weights[0] if weights and weights[0] else 1
+    cost = [weights[starts[min(group)]] / entry for group in group_list]
+
+    n_cuts = min(n_vms - 1, len(group_list) - 1)
+    candidates = sorted(range(1, len(group_list)), key=lambda g: (cost[g], rng.random()))
+    cuts = sorted(candidates[:n_cuts])
+    runs = []
+    for lo, hi in zip([0] + cuts, cuts + [len(group_list)]):
+        runs.append([b for group in group_list[lo:hi] for b in group])
+
+    vms = rng.sample(range(n_vms), len(runs))
+    if n_vms > 1 and 1 in vms:
+        heat = [sum(weights[starts[b]] * len(blocks[b]) for b in run) for run in runs]
+        hot = heat.index(max(heat))
+        other = vms.index(1)
+        vms[hot], vms[other] = vms[other], vms[hot]
+    assignments = {b: vm for run, vm in zip(runs, vms) for b in run}
+    return assignments, sum(cost[g] for g in cuts)
 
 
 def _build_segments_with_transfers(blocks, assignments, n_vms, rng):
@@ -392,12 +365,15 @@ def _build_segments_with_transfers(blocks, assignments, n_vms, rng):
     return segments, dispatch_order
 
 
-def _block_split(ir, n_vms, rng):
+def _block_split(ir, n_vms, rng, weights=None):
+    if weights is None:
+        weights = loop_weights(ir)
     blocks = _find_basic_blocks(ir)
     constraints = _find_jump_constraints(blocks)
     groups = _merge_constrained(blocks, constraints)
-    assignments = _assign_vms(groups, n_vms, rng)
-    return _build_segments_with_transfers(blocks, assignments, n_vms, rng)
+    assignments, est_switches = _assign_vms(groups, blocks, n_vms, rng, weights)
+    segments, dispatch_order = _build_segments_with_transfers(blocks, assignments, n_vms, rng)
+    return segments, dispatch_order, est_switches
 
 
 if __name__ == '__main__':